@@ -0,0 +1,249 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Horizontal sharding of the encrypted database over several search nodes.
+
+A search node is a QueryService (see pse.service), usually started empty with
+`python -m pse.service` and no store, that holds the key. The database is cut
+into shards, ranges [start, end) of records each saved in a store file indexed
+from zero, such as the files written by ProximitySearch.encrypt_dataset_parallel.
+A node that loads a shard keys its records from start, as augment_search does
+with start_index, so every node answers with global record ids.
+
+A ClusterCoordinator places the shards on the nodes, each on the node holding
+the fewest records, and fans every search out to the nodes, merging their
+matches as they come back. The nodes must be able to read the shard files at
+the paths the coordinator gives, on one host or a shared file system.
+
+A node that fails a health check, or a request, is dropped and its shards are
+loaded by the remaining nodes; a search that lost a node is run again once the
+shards have been reassigned. rebalance moves shards to nodes that joined
+later. A shard is loaded on its new node before it is unloaded from the old
+one, and matches are deduplicated, so searches stay complete while shards move.
+"""
+
+import asyncio
+import sys, os
+
+# Path hack
+sys.path.insert(0, os.path.abspath('charm'))
+sys.path.insert(1, os.path.abspath('../charm'))
+
+from pse.service import ServiceClient
+
+DEFAULT_HEALTH_INTERVAL = 5.0
+DEFAULT_HEALTH_TIMEOUT = 2.0
+
+
+def shard_files(prox_scheme):
+    """
+    Returns the (start, end, path) shards of a database encrypted with
+    encrypt_dataset_parallel.
+    """
+    return [(start, end, os.path.abspath(prox_scheme.shard_path(start, end)))
+            for (start, end) in prox_scheme.shards if start < end]
+
+
+async def connect(address):
+    """
+    Connects to the node at address, a Unix socket path or a (host, port) pair.
+    """
+    if isinstance(address, str):
+        return await ServiceClient.connect_unix(address)
+    return await ServiceClient.connect_tcp(address[0], address[1])
+
+
+class ClusterCoordinator():
+    def __init__(self, shards, health_interval=DEFAULT_HEALTH_INTERVAL, health_timeout=DEFAULT_HEALTH_TIMEOUT):
+        """
+        Coordinates the search over shards, a list of (start, end, path)
+        ranges of records, for instance from shard_files. Nodes are checked
+        every health_interval seconds once start_health_checks is called, and
+        dropped when they do not answer within health_timeout seconds.
+        """
+        self.shards = [(int(start), int(end), path) for (start, end, path) in shards]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.nodes = {}
+        # (start, end) of a shard -> address of the node holding it
+        self.assignment = {}
+        self.lock = asyncio.Lock()
+        self.health_task = None
+
+    def node_records(self):
+        records = {address: 0 for address in self.nodes}
+        for ((start, end), address) in self.assignment.items():
+            records[address] = records[address] + end - start
+        return records
+
+    def unassigned_shards(self):
+        return [shard for shard in self.shards if (shard[0], shard[1]) not in self.assignment]
+
+    async def add_node(self, address):
+        """
+        Connects to a node. It is given shards by the next assign_shards or
+        rebalance.
+        """
+        self.nodes[address] = await connect(address)
+
+    async def assign_shards(self):
+        """
+        Loads every shard that is on no node on the node holding the fewest
+        records.
+        """
+        async with self.lock:
+            await self.place_shards(self.unassigned_shards())
+
+    async def place_shards(self, shards):
+        shards = sorted(shards, key=lambda shard: shard[0] - shard[1])
+        while shards:
+            if not self.nodes:
+                raise ConnectionError("ERROR: No search node left for " + str(len(shards)) + " shards")
+            (start, end, path) = shards.pop(0)
+            records = self.node_records()
+            address = min(records, key=records.get)
+            try:
+                await self.nodes[address].load_shard(start, path)
+            except (ConnectionError, OSError):
+                shards.append((start, end, path))
+                shards.extend(self.forget_node(address))
+                continue
+            self.assignment[(start, end)] = address
+
+    def forget_node(self, address):
+        """
+        Drops address and returns the shards it held.
+        """
+        client = self.nodes.pop(address, None)
+        if client is not None:
+            client.writer.close()
+        lost = [shard for shard in self.shards if self.assignment.get((shard[0], shard[1])) == address]
+        for (start, end, path) in lost:
+            del self.assignment[(start, end)]
+        return lost
+
+    async def drop_node(self, address):
+        """
+        Removes a failed node and reassigns its shards.
+        """
+        async with self.lock:
+            await self.place_shards(self.forget_node(address))
+
+    async def rebalance(self):
+        """
+        Moves shards from the node holding the most records to the one holding
+        the fewest for as long as that narrows the gap.
+        """
+        async with self.lock:
+            while len(self.nodes) > 1:
+                records = self.node_records()
+                source = max(records, key=records.get)
+                target = min(records, key=records.get)
+                movable = [shard for shard in self.shards
+                           if self.assignment.get((shard[0], shard[1])) == source and
+                           records[target] + shard[1] - shard[0] < records[source]]
+                if not movable:
+                    break
+                (start, end, path) = min(movable, key=lambda shard: shard[1] - shard[0])
+                await self.nodes[target].load_shard(start, path)
+                self.assignment[(start, end)] = target
+                await self.nodes[source].unload_shard(start, end)
+
+    async def responds(self, address):
+        if address not in self.nodes:
+            return False
+        try:
+            await asyncio.wait_for(self.nodes[address].info(), self.health_timeout)
+            return True
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            return False
+
+    async def check_health(self):
+        """
+        Asks every node for its counters and drops the ones that do not
+        answer. Returns the addresses that were dropped.
+        """
+        failed = [address for address in list(self.nodes) if not await self.responds(address)]
+        for address in failed:
+            await self.drop_node(address)
+        return failed
+
+    async def run_health_checks(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health()
+
+    def start_health_checks(self):
+        if self.health_task is None:
+            self.health_task = asyncio.ensure_future(self.run_health_checks())
+
+    async def search(self, packed_queries, limit=None):
+        """
+        Runs queries packed by ctstore.pack_tokens on every node holding
+        shards and returns one list of matching record ids per query, at most
+        limit of them. Nodes that fail, or that fail a health check while the
+        search waits for them for health_interval seconds, are dropped and
+        the search is run again after their shards have been reassigned.
+        """
+        num_queries = len(packed_queries[0])
+        while True:
+            if self.unassigned_shards():
+                await self.assign_shards()
+            serving = set(self.assignment.values())
+            tasks = {asyncio.ensure_future(self.nodes[address].search(packed_queries, limit)): address
+                     for address in serving}
+            results = [{} for i in range(num_queries)]
+            failed = []
+            pending = set(tasks)
+            try:
+                while pending:
+                    (done, pending) = await asyncio.wait(pending, timeout=self.health_interval,
+                                                         return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        # a node that is down may not close its connections, check the ones not done yet
+                        for task in list(pending):
+                            if not await self.responds(tasks[task]):
+                                task.cancel()
+                                pending.discard(task)
+                                failed.append(tasks[task])
+                    for task in done:
+                        try:
+                            matches = task.result()
+                        except (ConnectionError, OSError):
+                            failed.append(tasks[task])
+                            continue
+                        for (result, indices) in zip(results, matches):
+                            result.update(dict.fromkeys(indices))
+                    if not failed and limit is not None and all(len(result) >= limit for result in results):
+                        break
+            finally:
+                for task in pending:
+                    task.cancel()
+            if not failed:
+                return [list(result)[:limit] if limit is not None else list(result) for result in results]
+            for address in failed:
+                if address in self.nodes:
+                    await self.drop_node(address)
+
+    async def close(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
+        for client in self.nodes.values():
+            await client.close()
+        self.nodes = {}
+        self.assignment = {}
@@ -0,0 +1,565 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Compact storage of an encrypted database.
+
+Group elements are stored raw: Charm serializes a point compressed, as its x
+coordinate and a sign bit, wrapped in a type tag and base64. The store keeps
+the compressed point bytes without the wrapping, a quarter smaller, and the
+type tag once for the whole store. Every element of one type takes the same
+number of bytes, so records have a fixed width and record i lives at offset
+i * record_size.
+A CiphertextStore reads records out of any buffer with that layout and behaves
+as a read-only mapping from record index to ciphertext, which is what
+ProximitySearch.enc_data is. Records are decoded lazily, on first access.
+
+The same layout is kept in a shared memory segment (SharedCiphertextStore) or
+in a file (CiphertextFile). A file is laid out as
+
+    header | records | record id index | metadata
+
+The header has a fixed size and gives the element width, the record count and
+the offsets of the other sections. The index lists the record id of every slot
+as 8-byte integers. The metadata is JSON describing the scheme, group, vector
+length and number of bases the ciphertexts belong to. Index and metadata come
+last so that records can be appended without moving the data.
+"""
+
+import sys, os, json, mmap, struct, base64
+from collections import OrderedDict
+from math import ceil
+from multiprocessing import shared_memory
+
+# Path hack
+sys.path.insert(0, os.path.abspath('charm'))
+sys.path.insert(1, os.path.abspath('../charm'))
+
+from pse import metrics
+
+
+def ciphertext_shape(ct):
+    """
+    Returns (nested, component_lengths) describing a ciphertext: a flat list of
+    elements for BarbosaIPEScheme, a list of per-basis lists for
+    MultiBasesPredScheme.
+    """
+    if isinstance(ct[0], list):
+        return (True, [len(component) for component in ct])
+    return (False, [len(ct)])
+
+
+def element_tag(group, element):
+    """
+    Returns the type tag Charm puts in front of serialized elements of the
+    type of element.
+    """
+    return group.serialize(element).split(b":", 1)[0]
+
+
+def encode_element(group, element):
+    return base64.b64decode(group.serialize(element).split(b":", 1)[1])
+
+
+def decode_elements(group, tag, data, width):
+    """
+    Decodes the elements of type tag laid out back to back in data, width
+    bytes each.
+    """
+    prefix = tag + b":"
+    return [group.deserialize(prefix + base64.b64encode(data[i:i + width])) for i in range(0, len(data), width)]
+
+
+def element_width(group, element):
+    """
+    Returns the number of bytes element takes in a store. Stored elements of
+    one type of a group all have the same width.
+    """
+    return len(encode_element(group, element))
+
+
+def flat_elements(ct):
+    return [item for subl in ct for item in subl] if isinstance(ct[0], list) else ct
+
+
+def ciphertext_tag(group, ct):
+    return element_tag(group, flat_elements(ct)[0])
+
+
+def encode_ciphertext(group, ct):
+    elements = flat_elements(ct)
+    if metrics.ENABLED:
+        metrics.count("serializations", len(elements))
+    return b"".join(encode_element(group, elem) for elem in elements)
+
+
+def pack_records(group, records):
+    """
+    Packs records, a dict of ciphertexts or of tokens of one shape, to be
+    sent to another process as (shape, tag, element width, ids, data), with
+    the raw elements of every record back to back in data. unpack_records
+    turns it back into a CiphertextStore.
+    """
+    record_ids = list(records)
+    if not record_ids:
+        return ((False, []), b"", 0, [], b"")
+    first = records[record_ids[0]]
+    shape = ciphertext_shape(first)
+    data = b"".join(encode_ciphertext(group, records[x]) for x in record_ids)
+    return (shape, ciphertext_tag(group, first), len(data) // (len(record_ids) * sum(shape[1])), record_ids, data)
+
+
+def unpack_records(group, packed, cache=True):
+    (shape, tag, width, record_ids, data) = packed
+    return CiphertextStore(group, shape, width, data, record_ids, 0, cache, tag)
+
+
+def pack_tokens(group, queries):
+    """
+    Packs queries, lists of tokens from ProximitySearch.generate_query, with
+    pack_records as (number of tokens of every query, packed tokens).
+    """
+    tokens = [token for query in queries for token in query]
+    return ([len(query) for query in queries], pack_records(group, dict(enumerate(tokens))))
+
+
+def merge_packed_tokens(packed_list):
+    """
+    Joins the queries of several pack_tokens results, in order, into one
+    without decoding their elements. All tokens must have the same shape.
+    """
+    counts = []
+    first = None
+    data = []
+    for (query_counts, (shape, tag, width, record_ids, query_data)) in packed_list:
+        counts.extend(query_counts)
+        if not record_ids:
+            continue
+        if first is None:
+            first = (shape, tag, width)
+        elif (shape, tag, width) != first:
+            raise ValueError("ERROR: Tokens of different shapes cannot be merged")
+        data.append(query_data)
+    if first is None:
+        return (counts, ((False, []), b"", 0, [], b""))
+    return (counts, (first[0], first[1], first[2], list(range(sum(counts))), b"".join(data)))
+
+
+def unpack_tokens(group, packed):
+    (counts, packed_tokens) = packed
+    store = unpack_records(group, packed_tokens, False)
+    queries = []
+    start = 0
+    for count in counts:
+        queries.append([store[i] for i in range(start, start + count)])
+        start = start + count
+    return queries
+
+
+FILE_MAGIC = b"PSECTSTR"
+FILE_VERSION = 2
+# magic, version, flags (reserved, 0), element width, record size, metadata length, count, data, index and
+# metadata offsets
+FILE_HEADER = struct.Struct("<8sHHIIIQQQQ")
+FILE_HEADER_SIZE = 64
+
+# Records a store decodes together when a record that is not decoded yet is accessed
+DECODE_BATCH = 64
+
+
+class CiphertextStore():
+    def __init__(self, group, shape, element_width, buffer, record_ids, data_offset=0, cache=True, tag=None):
+        """
+        Wraps buffer, in which the records listed in record_ids are laid out
+        back to back from data_offset, with raw elements of type tag. With
+        cache, decoded records are kept so that every record is only decoded
+        once; a number for cache keeps only that many of the most recently used
+        records. A record that is not decoded yet is decoded together with the
+        records of the next slots, up to DECODE_BATCH of them or the size of
+        the cache, so that a scan reads and decodes the buffer in runs.
+        """
+        self.group = group
+        (self.nested, self.component_lengths) = shape
+        self.element_width = element_width
+        self.elements_per_record = sum(self.component_lengths)
+        self.record_size = self.elements_per_record * element_width
+        # views share the memoryview so that closing the owner releases every reference to the buffer
+        self.buffer = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+        self.record_ids = list(record_ids)
+        self.slots = {self.record_ids[i]: i for i in range(len(self.record_ids))}
+        self.data_offset = data_offset
+        self.tag = tag
+        self.cache = cache
+        self.decoded = {} if cache is True else OrderedDict()
+
+    def view(self, start, end):
+        """
+        Returns a store over slots [start, end) sharing this store's buffer.
+        """
+        return CiphertextStore(self.group, (self.nested, self.component_lengths), self.element_width,
+                               self.buffer, self.record_ids[start:end],
+                               self.data_offset + start * self.record_size, self.cache, self.tag)
+
+    def shard_ranges(self, num_shards):
+        """
+        Splits the slots into num_shards contiguous [start, end) ranges.
+        """
+        num_slots = len(self.record_ids)
+        ranges = [(ceil(j * num_slots / num_shards), min(ceil((j + 1) * num_slots / num_shards), num_slots))
+                  for j in range(num_shards)]
+        return [(start, end) for (start, end) in ranges if start < end]
+
+    def record_bytes(self, record_id):
+        offset = self.data_offset + self.slots[record_id] * self.record_size
+        return self.buffer[offset:offset + self.record_size]
+
+    def decode_slots(self, start, end):
+        """
+        Decodes the records in slots [start, end) from one read of the buffer
+        and returns them in slot order.
+        """
+        offset = self.data_offset + start * self.record_size
+        data = bytes(self.buffer[offset:offset + (end - start) * self.record_size])
+        if metrics.ENABLED:
+            metrics.count("deserializations", (end - start) * self.elements_per_record)
+        elements = decode_elements(self.group, self.tag, data, self.element_width)
+        size = self.elements_per_record
+        cts = [elements[i * size:(i + 1) * size] for i in range(end - start)]
+        if not self.nested:
+            return cts
+        nested_cts = []
+        for elements in cts:
+            ct = []
+            component_start = 0
+            for length in self.component_lengths:
+                ct.append(elements[component_start:component_start + length])
+                component_start = component_start + length
+            nested_cts.append(ct)
+        return nested_cts
+
+    def decode(self, record_id):
+        slot = self.slots[record_id]
+        return self.decode_slots(slot, slot + 1)[0]
+
+    def __getitem__(self, record_id):
+        ct = self.decoded.get(record_id)
+        if ct is not None:
+            if self.cache is not True:
+                self.decoded.move_to_end(record_id)
+            return ct
+        if not self.cache:
+            return self.decode(record_id)
+        start = self.slots[record_id]
+        end = min(start + (DECODE_BATCH if self.cache is True else min(DECODE_BATCH, self.cache)),
+                  len(self.record_ids))
+        # stop before the first record decoded already, so no record is decoded twice
+        for slot in range(start + 1, end):
+            if self.record_ids[slot] in self.decoded:
+                end = slot
+                break
+        cts = self.decode_slots(start, end)
+        for slot in range(start, end):
+            self.decoded[self.record_ids[slot]] = cts[slot - start]
+        if self.cache is not True:
+            while len(self.decoded) > self.cache:
+                self.decoded.popitem(last=False)
+        return cts[0]
+
+    def __iter__(self):
+        return iter(self.record_ids)
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def __contains__(self, record_id):
+        return record_id in self.slots
+
+    def keys(self):
+        return list(self.record_ids)
+
+    def items(self):
+        return [(x, self[x]) for x in self.record_ids]
+
+
+class SharedCiphertextStore(CiphertextStore):
+    """
+    CiphertextStore kept in a multiprocessing.shared_memory segment. The
+    process that creates it owns the segment; worker processes attach to it
+    by name with the descriptor and only read from it.
+    """
+
+    @staticmethod
+    def create(group, enc_data):
+        record_ids = list(enc_data)
+        (shape, element_width, tag) = ((False, []), 0, b"")
+        if record_ids:
+            first = enc_data[record_ids[0]]
+            shape = ciphertext_shape(first)
+            element_width = len(encode_ciphertext(group, first)) // sum(shape[1])
+            tag = ciphertext_tag(group, first)
+        record_size = sum(shape[1]) * element_width
+        segment = shared_memory.SharedMemory(create=True, size=max(1, record_size * len(record_ids)))
+        for i in range(len(record_ids)):
+            segment.buf[i * record_size:(i + 1) * record_size] = encode_ciphertext(group, enc_data[record_ids[i]])
+        store = SharedCiphertextStore(group, shape, element_width, segment.buf, record_ids, 0, True, tag)
+        store.segment = segment
+        return store
+
+    @staticmethod
+    def attach(group, descriptor, cache=True):
+        (kind, name, shape, element_width, tag, record_ids) = descriptor
+        segment = shared_memory.SharedMemory(name=name)
+        store = SharedCiphertextStore(group, shape, element_width, segment.buf, record_ids, 0, cache, tag)
+        store.segment = segment
+        return store
+
+    def descriptor(self):
+        return ("shm", self.segment.name, (self.nested, self.component_lengths), self.element_width, self.tag,
+                self.record_ids)
+
+    def nbytes(self):
+        return self.record_size * len(self.record_ids)
+
+    def close(self):
+        self.decoded = {}
+        self.buffer.release()
+        self.segment.close()
+
+    def unlink(self):
+        self.segment.unlink()
+
+
+class CiphertextFile(CiphertextStore):
+    """
+    CiphertextStore over a store file mapped read-only with mmap. Opening the
+    file only reads the header, index and metadata; records are paged in and
+    decoded when they are accessed.
+    """
+
+    @staticmethod
+    def open(filename, group, cache=True):
+        with open(filename, "rb") as store_file:
+            mapping = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+            store_file.close()
+        (magic, version, flags, element_width, record_size, metadata_length, count, data_offset, index_offset,
+         metadata_offset) = FILE_HEADER.unpack_from(mapping, 0)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            mapping.close()
+            raise ValueError("Not a ciphertext store: " + filename)
+        metadata = json.loads(mapping[metadata_offset:metadata_offset + metadata_length].decode())
+        record_ids = list(struct.unpack_from("<%dq" % count, mapping, index_offset))
+        tag = (metadata.get('element_tag') or "").encode()
+        store = CiphertextFile(group, (metadata['nested'], metadata['component_lengths']), element_width,
+                               memoryview(mapping), record_ids, data_offset, cache, tag)
+        store.filename = filename
+        store.mapping = mapping
+        store.metadata = metadata
+        return store
+
+    def descriptor(self):
+        return ("file", self.filename)
+
+    def next_id(self):
+        """
+        Returns the first record id never used in this store.
+        """
+        return max(self.metadata.get('next_id', 0), max(self.record_ids) + 1 if self.record_ids else 0)
+
+    def nbytes(self):
+        return self.record_size * len(self.record_ids)
+
+    def close(self):
+        self.decoded = {}
+        self.buffer.release()
+        self.mapping.close()
+
+
+class CiphertextFileWriter():
+    def __init__(self, filename, group, metadata, append=False):
+        """
+        Creates the store file filename for ciphertexts described by metadata,
+        a dict with at least the scheme, group, n and bases entries. With
+        append, records are added to the existing store instead, which must
+        have the same metadata. Records are appended with append and the file
+        is complete once close is called.
+        """
+        self.filename = filename
+        self.group = group
+        self.metadata = dict(metadata)
+        self.metadata.setdefault('nested', False)
+        self.metadata.setdefault('component_lengths', [])
+        self.record_ids = []
+        self.element_width = 0
+        self.record_size = 0
+        self.next_id = self.metadata.get('next_id', 0)
+        if append and os.path.exists(filename):
+            store = CiphertextFile.open(filename, group)
+            for key in metadata:
+                if store.metadata.get(key) != metadata[key]:
+                    store.close()
+                    raise ValueError("Store " + filename + " has " + key + " " + str(store.metadata.get(key)) +
+                                     ", expected " + str(metadata[key]))
+            self.metadata = store.metadata
+            self.next_id = max(self.next_id, store.next_id())
+            self.record_ids = store.record_ids
+            self.element_width = store.element_width
+            self.record_size = store.record_size
+            store.close()
+            # drop the index and metadata, they are written again after the new records
+            self.store_file = open(filename, "r+b")
+            self.store_file.truncate(FILE_HEADER_SIZE + len(self.record_ids) * self.record_size)
+            self.store_file.seek(0, os.SEEK_END)
+        else:
+            self.store_file = open(filename, "wb")
+            self.store_file.write(bytes(FILE_HEADER_SIZE))
+
+    def append(self, record_id, ct):
+        self.append_encoded(record_id, encode_ciphertext(self.group, ct), ciphertext_shape(ct),
+                            ciphertext_tag(self.group, ct))
+
+    def append_encoded(self, record_id, data, shape, tag):
+        """
+        Appends a record already encoded with encode_ciphertext, shape and tag
+        are the ciphertext_shape and ciphertext_tag of the record.
+        """
+        if not self.record_ids:
+            (self.metadata['nested'], self.metadata['component_lengths']) = shape
+            self.metadata['element_tag'] = tag.decode() if tag is not None else None
+            self.record_size = len(data)
+            self.element_width = self.record_size // sum(self.metadata['component_lengths'])
+        if len(data) != self.record_size:
+            raise ValueError("Improper Record Size")
+        self.store_file.write(data)
+        self.record_ids.append(record_id)
+        self.next_id = max(self.next_id, record_id + 1)
+
+    def close(self):
+        count = len(self.record_ids)
+        index_offset = FILE_HEADER_SIZE + count * self.record_size
+        self.metadata['next_id'] = self.next_id
+        metadata_bytes = json.dumps(self.metadata).encode()
+        self.store_file.write(struct.pack("<%dq" % count, *self.record_ids))
+        self.store_file.write(metadata_bytes)
+        self.store_file.seek(0)
+        self.store_file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, 0,
+                                               self.element_width, self.record_size,
+                                               len(metadata_bytes), count, FILE_HEADER_SIZE, index_offset,
+                                               index_offset + 8 * count))
+        self.store_file.close()
+
+    def discard(self):
+        """
+        Closes and removes the file without completing it.
+        """
+        self.store_file.close()
+        os.remove(self.filename)
+
+
+def write_store_file(filename, group, enc_data, metadata):
+    writer = CiphertextFileWriter(filename, group, metadata)
+    for x in enc_data:
+        writer.append(x, enc_data[x])
+    writer.close()
+
+
+def read_store_file(filename, group):
+    """
+    Returns the records of the store file filename, decoded, as a dict.
+    """
+    store = CiphertextFile.open(filename, group, False)
+    records = dict(zip(store.record_ids, store.decode_slots(0, len(store))))
+    store.close()
+    return records
+
+
+def attach_store(group, descriptor, cache=True):
+    """
+    Opens the store named by the descriptor of a SharedCiphertextStore or a
+    CiphertextFile, e.g. in a worker process.
+    """
+    if descriptor[0] == "file":
+        return CiphertextFile.open(descriptor[1], group, cache)
+    return SharedCiphertextStore.attach(group, descriptor, cache)
+
+
+class LayeredStore():
+    def __init__(self, base):
+        """
+        Mutable view of a read-only store: records added since the store was
+        written are kept in memory in added, and removed records are
+        tombstoned in removed until the store is compacted. Record ids are
+        never reused, so a tombstone only ever hides the record it was made
+        for. Overwriting a record of the store tombstones the stored one and
+        adds the new one, so every id is in at most one of base and added.
+        """
+        self.base = base
+        self.added = {}
+        self.removed = set()
+
+    def __setitem__(self, record_id, ct):
+        if record_id in self.base:
+            self.removed.add(record_id)
+        self.added[record_id] = ct
+
+    def __delitem__(self, record_id):
+        self.added.pop(record_id, None)
+        self.removed.add(record_id)
+
+    def __getitem__(self, record_id):
+        ct = self.added.get(record_id)
+        if ct is not None:
+            return ct
+        if record_id in self.removed:
+            raise KeyError(record_id)
+        return self.base[record_id]
+
+    def __iter__(self):
+        for x in self.base:
+            if x not in self.removed:
+                yield x
+        for x in list(self.added):
+            yield x
+
+    def __len__(self):
+        return len(self.base) - sum(1 for x in self.removed if x in self.base) + len(self.added)
+
+    def __contains__(self, record_id):
+        return record_id in self.added or (record_id not in self.removed and record_id in self.base)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(x, self[x]) for x in self]
+
+
+def compact_store_file(filename, group, layered, next_id=0):
+    """
+    Rewrites the store file of layered.base to filename with the removed
+    records dropped and the added ones appended. Live records of the base are
+    copied as they are, without decoding them. next_id is recorded so that ids
+    of records removed here are not handed out again.
+    """
+    base = layered.base
+    writer = CiphertextFileWriter(filename, group, base.metadata)
+    writer.next_id = max(writer.next_id, next_id)
+    shape = (base.nested, base.component_lengths)
+    for x in base:
+        if x not in layered.removed:
+            writer.append_encoded(x, bytes(base.record_bytes(x)), shape, base.tag)
+    for x in list(layered.added):
+        writer.append(x, layered.added[x])
+    writer.close()
@@ -0,0 +1,174 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Group backends of the predicate schemes.
+
+The schemes get their group from pairing_group(group_name). A Charm curve name
+such as 'MNT159' gives a Charm PairingGroup. SIMULATED_GROUP gives a
+SimulatedPairingGroup, which stands for every element g^a of G1, G2 and GT by
+its exponent a mod p, so that exponentiation is a multiplication, the group
+operation an addition and a pairing e(g1^a, g2^b) = gt^(ab) a product of
+exponents. Elements serialize like Charm's, as a type tag and the base64 of a
+fixed width value.
+
+The simulated group gives the same decryptions, hence the same matches, as a
+real curve at a small fraction of the cost, which is meant for load testing the
+layers around the schemes (scheduling, sharding, storage) at scale. It is not
+secure: discrete logarithms are free in it.
+"""
+
+import sys, os, base64, secrets
+
+# Path hack
+sys.path.insert(0, os.path.abspath('charm'))
+sys.path.insert(1, os.path.abspath('../charm'))
+
+from charm.toolbox.pairinggroup import PairingGroup, ZR, G1, G2, GT
+
+SIMULATED_GROUP = 'SIMULATED'
+# largest prime below 2^160, the size of the MNT159 group order
+SIMULATED_ORDER = 2 ** 160 - 47
+SIMULATED_WIDTH = 20
+
+
+def pairing_group(group_name):
+    if group_name == SIMULATED_GROUP:
+        return SimulatedPairingGroup()
+    return PairingGroup(group_name)
+
+
+def element_type(group, element):
+    """
+    Returns which of ZR, G1, G2 and GT element belongs to, read from the type
+    tag of its serialization.
+    """
+    return int(group.serialize(element).split(b":", 1)[0])
+
+
+def other_source_group(source_group):
+    return G2 if source_group == G1 else G1
+
+
+class SimulatedElement():
+    __slots__ = ('type', 'value', 'pp')
+
+    def __init__(self, element_type, value):
+        self.type = element_type
+        self.value = value % SIMULATED_ORDER
+        self.pp = False
+
+    @staticmethod
+    def exponent(other):
+        return other.value if isinstance(other, SimulatedElement) else int(other)
+
+    def __add__(self, other):
+        return SimulatedElement(ZR, self.value + self.exponent(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return SimulatedElement(ZR, self.value - self.exponent(other))
+
+    def __rsub__(self, other):
+        return SimulatedElement(ZR, self.exponent(other) - self.value)
+
+    def __neg__(self):
+        return SimulatedElement(self.type, -self.value)
+
+    def __mul__(self, other):
+        if self.type == ZR:
+            if isinstance(other, SimulatedElement) and other.type != ZR:
+                raise TypeError("Cannot multiply ZR and group elements")
+            return SimulatedElement(ZR, self.value * self.exponent(other))
+        if not isinstance(other, SimulatedElement) or other.type != self.type:
+            raise TypeError("Group elements of different types")
+        return SimulatedElement(self.type, self.value + other.value)
+
+    def __rmul__(self, other):
+        return SimulatedElement(ZR, self.exponent(other) * self.value)
+
+    def __truediv__(self, other):
+        if self.type == ZR:
+            return SimulatedElement(ZR, self.value * pow(self.exponent(other), -1, SIMULATED_ORDER))
+        return SimulatedElement(self.type, self.value - other.value)
+
+    def __rtruediv__(self, other):
+        return SimulatedElement(ZR, self.exponent(other) * pow(self.value, -1, SIMULATED_ORDER))
+
+    def __pow__(self, other):
+        if self.type == ZR:
+            return SimulatedElement(ZR, pow(self.value, self.exponent(other), SIMULATED_ORDER))
+        return SimulatedElement(self.type, self.value * self.exponent(other))
+
+    def __eq__(self, other):
+        if isinstance(other, SimulatedElement):
+            return self.type == other.type and self.value == other.value
+        return self.type == ZR and self.value == int(other) % SIMULATED_ORDER
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.type, self.value))
+
+    def __int__(self):
+        return self.value
+
+    def __str__(self):
+        return str(self.value) if self.type == ZR else "[" + str(self.value) + "]"
+
+    __repr__ = __str__
+
+    def initPP(self):
+        # nothing to precompute, only Charm's refusal of a second call is kept
+        if self.pp:
+            raise ValueError("Pre-processing table already initialized.")
+        self.pp = True
+        return True
+
+
+class SimulatedPairingGroup():
+    def order(self):
+        return SIMULATED_ORDER
+
+    def random(self, element_type=ZR):
+        return SimulatedElement(element_type, secrets.randbelow(SIMULATED_ORDER - 1) + 1)
+
+    def init(self, element_type, value=0):
+        """
+        Returns value in ZR; for G1, G2 and GT, as in Charm, the identity.
+        """
+        if element_type == ZR:
+            return SimulatedElement(ZR, int(value))
+        return SimulatedElement(element_type, 0)
+
+    def pair_prod(self, lhs, rhs):
+        """
+        Product of the pairings of the G1 elements of lhs with the G2
+        elements of rhs.
+        """
+        return SimulatedElement(GT, sum(a.value * b.value for (a, b) in zip(lhs, rhs)))
+
+    def ismember(self, element):
+        return isinstance(element, SimulatedElement)
+
+    def serialize(self, element, compression=True):
+        return b"%d:" % element.type + base64.b64encode(element.value.to_bytes(SIMULATED_WIDTH, 'big'))
+
+    def deserialize(self, data, compression=True):
+        (element_type, value) = data.split(b":", 1)
+        return SimulatedElement(int(element_type), int.from_bytes(base64.b64decode(value), 'big'))
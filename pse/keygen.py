@@ -0,0 +1,259 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Generation of the secret bases (B, B*) with the gen_matrices program.
+
+gen_matrices prints det(B), B and B* as decimal text. A KeyGenerator keeps a
+pool of worker processes that run it, parse its output and hand the entries
+back packed as fixed-width big-endian integers, which cross the process
+boundary as one bytes object per matrix. The bases of a multi-basis key are
+generated concurrently, and a KeyGenerator can keep bases generated ahead of
+time for the next keys.
+
+Secret keys are written in a versioned binary format: a header, then B and B*
+of every basis as fixed-width integers, while the generators g1 and g2, which
+all bases share, go once in a separate generator section.
+"""
+
+import concurrent.futures
+import sys, os, secrets, struct
+from subprocess import Popen, PIPE
+
+# Path hack
+sys.path.insert(0, os.path.abspath('charm'))
+sys.path.insert(1, os.path.abspath('../charm'))
+
+from charm.toolbox.pairinggroup import ZR
+from pse import metrics
+
+GEN_MATRICES = os.path.dirname(os.path.realpath(__file__)) + '/../fhipe/fhipe/gen_matrices'
+
+KEY_MAGIC = b"PSEKEY"
+KEY_VERSION = 1
+# magic, version, number of bases, basis dimension, width of an entry in bytes
+KEY_HEADER = struct.Struct("<6sHIII")
+# lengths of the serialized g1 and g2
+GENERATOR_HEADER = struct.Struct("<II")
+
+
+def int_width(order):
+    return (int(order).bit_length() + 7) // 8
+
+
+def pack_ints(values, width):
+    return b"".join(v.to_bytes(width, 'big') for v in values)
+
+
+def unpack_ints(data, width):
+    return [int.from_bytes(data[i:i + width], 'big') for i in range(0, len(data), width)]
+
+
+def parse_matrix_ints(matrix_str):
+    """
+    Returns the entries, row by row, of a matrix printed by gen_matrices as
+    the number of rows, the number of columns and then the entries.
+    """
+    values = matrix_str.split()
+    (rows, cols) = (int(values[0]), int(values[1]))
+    entries = [int(v) for v in values[2:]]
+    assert(len(entries) == rows * cols)
+    return entries
+
+
+@metrics.timed("gen_matrices")
+def run_gen_matrices(vector_length, order, simulated=False):
+    """
+    Runs gen_matrices once and returns (det(B), B, B*) with the matrices as
+    flat lists of integers.
+    """
+    if metrics.ENABLED:
+        metrics.count("gen_matrices_runs")
+    if not simulated:
+        matrix_seed = secrets.token_bytes(128)
+    else:
+        matrix_seed = ""
+    proc = Popen(
+        [
+            GEN_MATRICES,
+            str(vector_length),
+            str(order),
+            "1" if simulated else "0",
+            str(matrix_seed)
+        ],
+        stdout=PIPE
+    )
+    detB_str = proc.stdout.readline().decode()
+    B_str = proc.stdout.readline().decode()
+    Bstar_str = proc.stdout.readline().decode()
+    proc.stdout.close()
+    proc.wait()
+    return int(detB_str), parse_matrix_ints(B_str), parse_matrix_ints(Bstar_str)
+
+
+def normalize_dual(detB, Bstar, order):
+    """
+    Returns the entries of B* divided by det(B) modulo order, so that B* is
+    the dual basis of B. The inverse of det(B) is computed once for the matrix.
+    """
+    detB_inv = pow(detB, -1, order)
+    return [v * detB_inv % order for v in Bstar]
+
+
+def generate_int_basis(vector_length, order, simulated=False, normalize=False):
+    """
+    Returns (det(B), B, B*) as integers, with B* normalized by normalize_dual
+    if normalize is set.
+    """
+    (detB, B, Bstar) = run_gen_matrices(vector_length, order, simulated)
+    if normalize:
+        Bstar = normalize_dual(detB, Bstar, order)
+    return detB, B, Bstar
+
+
+def generate_packed_basis(vector_length, order, simulated=False, normalize=False):
+    """
+    Worker task: returns generate_int_basis with each matrix packed by pack_ints.
+    """
+    (detB, B, Bstar) = generate_int_basis(vector_length, order, simulated, normalize)
+    width = int_width(order)
+    return detB, pack_ints(B, width), pack_ints(Bstar, width)
+
+
+def matrix_from_ints(group, vector_length, entries):
+    return [[group.init(ZR, v) for v in entries[i * vector_length:(i + 1) * vector_length]]
+            for i in range(vector_length)]
+
+
+def basis_from_ints(group, vector_length, detB, B, Bstar):
+    """
+    Returns (B, B*, det(B)) as matrices of ZR elements of group.
+    """
+    return (matrix_from_ints(group, vector_length, B), matrix_from_ints(group, vector_length, Bstar),
+            group.init(ZR, detB))
+
+
+def is_binary_key(matrix_data):
+    return isinstance(matrix_data, (bytes, bytearray)) and matrix_data[:len(KEY_MAGIC)] == KEY_MAGIC
+
+
+def encode_key(group, bases):
+    """
+    Encodes the (B, B*) matrices of bases, all of the same dimension.
+    """
+    vector_length = len(bases[0][0])
+    width = int_width(group.order())
+    parts = [KEY_HEADER.pack(KEY_MAGIC, KEY_VERSION, len(bases), vector_length, width)]
+    for (B, Bstar) in bases:
+        parts.append(pack_ints([int(e) for row in B for e in row], width))
+        parts.append(pack_ints([int(e) for row in Bstar for e in row], width))
+    return b"".join(parts)
+
+
+def decode_key(group, data):
+    """
+    Returns the list of (B, B*) matrices encoded by encode_key.
+    """
+    (magic, version, num_bases, vector_length, width) = KEY_HEADER.unpack_from(data)
+    if magic != KEY_MAGIC:
+        raise ValueError("Not a secret key")
+    if version != KEY_VERSION:
+        raise ValueError("Unsupported secret key version " + str(version))
+    matrix_size = vector_length * vector_length * width
+    if len(data) != KEY_HEADER.size + 2 * num_bases * matrix_size:
+        raise ValueError("Truncated secret key")
+    bases = []
+    for i in range(num_bases):
+        offset = KEY_HEADER.size + 2 * i * matrix_size
+        B = unpack_ints(data[offset:offset + matrix_size], width)
+        Bstar = unpack_ints(data[offset + matrix_size:offset + 2 * matrix_size], width)
+        bases.append((matrix_from_ints(group, vector_length, B), matrix_from_ints(group, vector_length, Bstar)))
+    return bases
+
+
+def encode_generators(group, g1, g2):
+    g1_bytes = group.serialize(g1)
+    g2_bytes = group.serialize(g2)
+    return GENERATOR_HEADER.pack(len(g1_bytes), len(g2_bytes)) + g1_bytes + g2_bytes
+
+
+def decode_generators(group, data):
+    (g1_len, g2_len) = GENERATOR_HEADER.unpack_from(data)
+    offset = GENERATOR_HEADER.size
+    g1 = group.deserialize(bytes(data[offset:offset + g1_len]))
+    g2 = group.deserialize(bytes(data[offset + g1_len:offset + g1_len + g2_len]))
+    return g1, g2
+
+
+class KeyGenerator():
+    def __init__(self, workers=None, pool_size=0):
+        """
+        Starts workers processes (cpu_count() by default) running gen_matrices.
+        With pool_size, that many bases of every requested shape are kept
+        generated ahead of time: a request takes ready bases first and the
+        pool is refilled in the background.
+        """
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        self.pool_size = pool_size
+        self.pool = {}
+
+    def submit(self, vector_length, order, simulated=False, normalize=False):
+        return metrics.submit(self.executor, generate_packed_basis, vector_length, int(order), simulated, normalize)
+
+    def prefill(self, vector_length, order, simulated=False, count=None, normalize=False):
+        """
+        Starts generating count bases (pool_size by default) of the given shape
+        ahead of time and returns the futures of the bases pending for it.
+        """
+        pending = self.pool.setdefault((vector_length, int(order), simulated, normalize), [])
+        count = self.pool_size if count is None else count
+        while len(pending) < count:
+            pending.append(self.submit(vector_length, order, simulated, normalize))
+        return pending
+
+    def generate(self, group, vector_length, simulated=False, count=1, normalize=False):
+        """
+        Returns count bases (B, B*, det(B)) of dimension vector_length over
+        group, generated concurrently. With normalize, B* is divided by det(B)
+        on the workers.
+        """
+        order = int(group.order())
+        pending = self.pool.get((vector_length, order, simulated, normalize), [])
+        futures = pending[:count]
+        del pending[:count]
+        futures.extend(self.submit(vector_length, order, simulated, normalize) for i in range(count - len(futures)))
+        if self.pool_size:
+            self.prefill(vector_length, order, simulated, normalize=normalize)
+        width = int_width(order)
+        bases = []
+        for future in futures:
+            (detB, B, Bstar) = metrics.unwrap(future.result())
+            bases.append(basis_from_ints(group, vector_length, detB, unpack_ints(B, width),
+                                         unpack_ints(Bstar, width)))
+        return bases
+
+    def close(self):
+        for pending in self.pool.values():
+            for future in pending:
+                future.cancel()
+        self.pool = {}
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
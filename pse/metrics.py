@@ -0,0 +1,239 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Opt-in instrumentation of the schemes and the search.
+
+Counters count operations: pairings, exponentiations in G1 and G2, ZR
+multiplications, element (de)serializations, gen_matrices runs and key bytes
+read and written. Timers sum the time of whole calls such as encrypt,
+generate_query, search_many or a worker's chunk, with their number of calls
+and the longest one. Only operations done in the pairing group are counted,
+right after the statement doing them, by the number that statement did; the
+integer matrix products of encrypt_batch, for one, are not ZR
+multiplications. Everything is guarded by ENABLED, so that when
+instrumentation is off, which is the default, a counting site only pays one
+attribute test (and a timed function one extra function call).
+
+Worker processes keep their own counters. While instrumentation is on, work
+sent to a pool with submit runs under run_measured and comes back with the
+worker's counters, which unwrap adds to this process, so sharded searches and
+encryptions are accounted for in full. Every chunk is also timed under
+"worker.<function name>".
+
+snapshot returns everything as a dict, to_json and to_prometheus export it,
+and recording gives the totals of a single call:
+
+    with metrics.recording() as record:
+        database.search(query)
+    record.snapshot["counters"]["pairings"]
+"""
+
+import json, time, functools
+from collections import namedtuple
+
+ENABLED = False
+
+# name -> count
+_counters = {}
+# name -> [calls, total seconds, longest call in seconds]
+_timers = {}
+
+MeasuredResult = namedtuple('MeasuredResult', ['result', 'metrics'])
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def reset():
+    _counters.clear()
+    _timers.clear()
+
+
+def count(name, amount=1):
+    _counters[name] = _counters.get(name, 0) + amount
+
+
+def add_time(name, seconds, calls=1, longest=None):
+    timer = _timers.setdefault(name, [0, 0.0, 0.0])
+    timer[0] = timer[0] + calls
+    timer[1] = timer[1] + seconds
+    timer[2] = max(timer[2], seconds if longest is None else longest)
+
+
+class Timer():
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add_time(self.name, time.perf_counter() - self.start)
+
+
+class NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(name):
+    """
+    Returns a context manager timing its block under name, or a shared no-op
+    one when instrumentation is off.
+    """
+    return Timer(name) if ENABLED else NULL_TIMER
+
+
+def timed(name):
+    """
+    Decorator timing every call of the decorated function under name while
+    instrumentation is on.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def timed_fn(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with Timer(name):
+                return fn(*args, **kwargs)
+        return timed_fn
+    return decorate
+
+
+def snapshot():
+    return {"counters": dict(_counters),
+            "timers": {name: {"calls": t[0], "seconds": t[1], "max_seconds": t[2]} for (name, t) in _timers.items()}}
+
+
+def merge(other):
+    """
+    Adds the counters and timers of a snapshot, e.g. a worker's, to this
+    process.
+    """
+    for (name, amount) in other["counters"].items():
+        count(name, amount)
+    for (name, t) in other["timers"].items():
+        add_time(name, t["seconds"], t["calls"], t["max_seconds"])
+
+
+def difference(after, before):
+    """
+    Returns the snapshot of what was recorded between snapshots before and
+    after. The longest call of a timer is kept from after.
+    """
+    counters = {name: amount - before["counters"].get(name, 0) for (name, amount) in after["counters"].items()}
+    timers = {}
+    for (name, t) in after["timers"].items():
+        b = before["timers"].get(name, {"calls": 0, "seconds": 0.0})
+        if t["calls"] != b["calls"]:
+            timers[name] = {"calls": t["calls"] - b["calls"], "seconds": t["seconds"] - b["seconds"],
+                            "max_seconds": t["max_seconds"]}
+    return {"counters": {name: amount for (name, amount) in counters.items() if amount},
+            "timers": timers}
+
+
+class recording():
+    def __init__(self):
+        """
+        Turns instrumentation on for a block and leaves the block's own
+        counters and timers in self.snapshot.
+        """
+        self.snapshot = None
+
+    def __enter__(self):
+        self.was_enabled = ENABLED
+        enable(True)
+        self.before = snapshot()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.snapshot = difference(snapshot(), self.before)
+        enable(self.was_enabled)
+
+
+def run_measured(fn, *args):
+    """
+    Worker side of submit: runs fn(*args) with instrumentation on and returns
+    a MeasuredResult with the counters it recorded.
+    """
+    was_enabled = ENABLED
+    enable(True)
+    try:
+        before = snapshot()
+        with Timer("worker." + fn.__name__):
+            result = fn(*args)
+        return MeasuredResult(result, difference(snapshot(), before))
+    finally:
+        enable(was_enabled)
+
+
+def submit(executor, fn, *args):
+    """
+    executor.submit(fn, *args), measured in the worker by run_measured while
+    instrumentation is on. Pass the result through unwrap.
+    """
+    if ENABLED:
+        return executor.submit(run_measured, fn, *args)
+    return executor.submit(fn, *args)
+
+
+def unwrap(result):
+    """
+    Returns the result of work sent with submit, adding the counters that came
+    back with it to this process.
+    """
+    if isinstance(result, MeasuredResult):
+        merge(result.metrics)
+        return result.result
+    return result
+
+
+def to_json():
+    return json.dumps(snapshot(), sort_keys=True)
+
+
+def to_prometheus(prefix="pse"):
+    """
+    Returns the counters and timers in the Prometheus text exposition format.
+    Counters become <prefix>_<name>_total, timers the
+    <prefix>_calls_total, <prefix>_seconds_total and <prefix>_max_seconds
+    series labelled by operation.
+    """
+    lines = []
+    for name in sorted(_counters):
+        metric = prefix + "_" + name.replace(".", "_") + "_total"
+        lines.append("# TYPE " + metric + " counter")
+        lines.append(metric + " " + str(_counters[name]))
+    if _timers:
+        for (suffix, index, kind) in [("calls_total", 0, "counter"), ("seconds_total", 1, "counter"),
+                                      ("max_seconds", 2, "gauge")]:
+            metric = prefix + "_" + suffix
+            lines.append("# TYPE " + metric + " " + kind)
+            for name in sorted(_timers):
+                lines.append(metric + '{operation="' + name + '"} ' + repr(_timers[name][index]))
+    return "\n".join(lines) + "\n"
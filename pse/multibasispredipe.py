@@ -26,19 +26,25 @@ sys.path.insert(0, os.path.abspath('charm'))
 sys.path.insert(1, os.path.abspath('../charm'))
 
 from charm.toolbox.pairinggroup import PairingGroup,ZR,G1,G2,GT,pair
+from pathos.multiprocessing import cpu_count
 from pse.predipe import PredIPEScheme
 from pse.predipe import BarbosaIPEScheme
+from pse import keygen, metrics
+from pse.groups import pairing_group, element_type, other_source_group
+from pse.keygen import KeyGenerator
 from charm.core.engine.util import objectToBytes,bytesToObject
 
 
 class MultiBasesPredScheme(PredIPEScheme):
 
     def __init__(self, n, group_name='MNT159', simulated=False, num_bases=1):
-        group = PairingGroup(group_name)
+        group = pairing_group(group_name)
         self.group = group
         self.group_name = group_name
+        self.gt_identity = group.init(GT, 1)
         self.vector_length = n
         self.simulated = simulated
+        self.token_group = G1
         self.g1 = None
         self.g2 = None
 
@@ -55,58 +61,94 @@ class MultiBasesPredScheme(PredIPEScheme):
         self.component_length = ceil(self.vector_length / self.num_bases) + 1
 
 
-    def generate_keys(self):
-        self.g1 = self.group.random(G1)
-        self.g2 = self.group.random(G2)
+    def generate_keys(self, key_generator=None):
+        """
+        Samples the num_bases bases concurrently on key_generator, or on a
+        KeyGenerator started for the call when there is more than one basis.
+        """
+        self.g1 = self.group.random(self.token_group)
+        self.g2 = self.group.random(other_source_group(self.token_group))
         self.barbosa_vec = []
 
-        for i in range(self.num_bases):
+        # B* comes back divided by det(B), so that B* * B = I
+        if key_generator is not None:
+            bases = key_generator.generate(self.group, self.component_length, self.simulated, self.num_bases, True)
+        elif self.num_bases > 1:
+            with KeyGenerator(min(self.num_bases, cpu_count())) as key_generator:
+                bases = key_generator.generate(self.group, self.component_length, self.simulated, self.num_bases,
+                                               True)
+        else:
+            (detB, B, Bstar) = keygen.generate_int_basis(self.component_length, self.group.order(), self.simulated,
+                                                         True)
+            bases = [keygen.basis_from_ints(self.group, self.component_length, detB, B, Bstar)]
+
+        for (B, Bstar, detB) in bases:
             b_instance = BarbosaIPEScheme(self.component_length, self.group_name, self.simulated)
-            (B, Bstar, pp, detB) = BarbosaIPEScheme.generate_matrices(self.component_length, self.simulated, self.group)
-
-            # divide Bstar by detB inverse to have Bstar * B = I
-            for j in range(int(self.component_length)):
-                for k in range(int(self.component_length)):
-                    Bstar[j][k] = Bstar[j][k] * (1/detB)
-
-            b_instance.set_key(B, Bstar, pp, self.g1, self.g2)
+            b_instance.set_key(B, Bstar, (), self.g1, self.g2)
             self.barbosa_vec.append(b_instance)
             # print("Basis " + str(i) + " : ")
             # print(self.barbosa_vec[i].print_key())
 
+    @metrics.timed("write_key")
     def write_key_to_file(self, matrix_filename, generator_filename):
-        open(matrix_filename, 'w').close()
-
-        (matrix_str, generator_bytes)= self.serialize_key()
-        with open(matrix_filename, "a") as secret_key_file:
-            secret_key_file.write(matrix_str)
+        (matrix_bytes, generator_bytes)= self.serialize_key()
+        if metrics.ENABLED:
+            metrics.count("key_bytes_written", len(matrix_bytes) + len(generator_bytes))
+        with open(matrix_filename, "wb") as secret_key_file:
+            secret_key_file.write(matrix_bytes)
             secret_key_file.close()
 
         with open(generator_filename, "wb") as secret_key_file:
             secret_key_file.write(generator_bytes)
             secret_key_file.close()
 
+    @metrics.timed("read_key")
     def read_key_from_file(self, matrix_filename, generator_filename):
-        with open(matrix_filename, "r") as secret_key_file:
+        with open(matrix_filename, "rb") as secret_key_file:
             matrix_contents = secret_key_file.read()
             secret_key_file.close()
 
         with open(generator_filename, "rb") as secret_key_file:
             generator_bytes =secret_key_file.read()
             secret_key_file.close()
+        if metrics.ENABLED:
+            metrics.count("key_bytes_read", len(matrix_contents) + len(generator_bytes))
 
         self.deserialize_key(matrix_contents, generator_bytes)
 
     def serialize_key(self):
-        matrix_str = str(self.num_bases)
-        for binstance in self.barbosa_vec:
-            (matrix, gen) = binstance.serialize_key()
-            matrix_str = matrix_str + "\n"+matrix
-            gen_bytes = gen
+        """
+        Returns the matrices of all bases as one keygen.encode_key record and
+        the generators, which the bases share, once.
+        """
+        bases = [(binstance.B, binstance.Bstar) for binstance in self.barbosa_vec]
+        return keygen.encode_key(self.group, bases), keygen.encode_generators(self.group, self.g1, self.g2)
 
-        return matrix_str, gen_bytes
+    def deserialize_key(self, matrix_data, gen_bytes):
+        """
+        Loads a key from serialize_key, or from the text format written before
+        the binary one. The generators are loaded and precomputed once, and
+        every basis uses the same g1, g2 and precomputation tables.
+        """
+        self.barbosa_vec = []
+        if not keygen.is_binary_key(matrix_data):
+            self.deserialize_text_key(matrix_data, gen_bytes)
+            return
+        bases = keygen.decode_key(self.group, matrix_data)
+        self.set_number_bases(len(bases))
+        assert (len(bases[0][0]) == self.component_length), "ERROR: Key does not match the vector length."
+        (self.g1, self.g2) = keygen.decode_generators(self.group, gen_bytes)
+        self.token_group = element_type(self.group, self.g1)
+        assert self.g1.initPP(), "ERROR: Failed to init pre-computation table for g1."
+        assert self.g2.initPP(), "ERROR: Failed to init pre-computation table for g2."
+        for (B, Bstar) in bases:
+            b_instance = BarbosaIPEScheme(self.component_length, self.group_name, self.simulated)
+            b_instance.set_key(B, Bstar, (), self.g1, self.g2)
+            self.barbosa_vec.append(b_instance)
 
-    def deserialize_key(self, matrix_str, gen_bytes):
+    def deserialize_text_key(self, matrix_str, gen_bytes):
+        if isinstance(matrix_str, bytes):
+            matrix_str = matrix_str.decode()
         (num_bases, matrix_str_tmp) = matrix_str.split("\n",1)
         self.set_number_bases(int(matrix_str.split("\n",1)[0]))
         matrix_str_list = matrix_str_tmp.split("\n")
@@ -115,12 +157,14 @@ class MultiBasesPredScheme(PredIPEScheme):
             b_instance.deserialize_key(matrix_str_list[3*i]+"\n"+matrix_str_list[3*i+1]+"\n"
                                        +matrix_str_list[3*i+2], gen_bytes)
             self.barbosa_vec.append(b_instance)
+        self.g1 = self.barbosa_vec[0].g1
+        self.g2 = self.barbosa_vec[0].g2
+        self.token_group = self.barbosa_vec[0].token_group
 
-    def encrypt(self, x):
-        assert(len(x) == self.vector_length)
-        n = self.vector_length
-
-        # prepare secret sharing of zero
+    def zero_shares(self):
+        """
+        Returns a secret sharing of zero with one share per basis.
+        """
         zeta = []
         zeta_sigma = self.group.init(ZR, 0)
 
@@ -133,46 +177,128 @@ class MultiBasesPredScheme(PredIPEScheme):
         for z in zeta:
             zeta_sum += z
         assert(zeta_sum == self.group.init(ZR, 0))
+        return zeta
+
+    def component_vector(self, x, i, last):
+        """
+        Returns the part of x handled by basis i, padded with zeros and
+        extended with last.
+        """
+        n = self.vector_length
+        x_modified = [0] * self.component_length
+        for j in range(self.component_length-1):
+
+            if i*ceil(n/self.num_bases) + j < len(x):
+                x_modified[j] = x[i*ceil(n/self.num_bases)+j]
+            else:
+                x_modified[j] = 0
+
+        x_modified[self.component_length-1] = last
+        return x_modified
+
+    def encrypt(self, x):
+        assert(len(x) == self.vector_length)
+
+        # prepare secret sharing of zero
+        zeta = self.zero_shares()
 
         c = []
         beta = self.group.random(ZR)
         for i in range(self.num_bases):
+            c.append(self.barbosa_vec[i].encrypt(self.component_vector(x, i, zeta[i]), beta))
+        return c
 
-            x_modified = [0] * self.component_length
-            for j in range(self.component_length-1):
-
-                if i*ceil(n/self.num_bases) + j < len(x):
-                    x_modified[j] = x[i*ceil(n/self.num_bases)+j]
-                else:
-                    x_modified[j] = 0
+    def encrypt_batch(self, xs):
+        """
+        Encrypts every vector of xs, running one batched product per basis with
+        BarbosaIPEScheme.encrypt_batch. Each record keeps its own beta and
+        sharing of zero across the bases.
+        """
+        for x in xs:
+            assert(len(x) == self.vector_length)
+        betas = [self.group.random(ZR) for x in xs]
+        zetas = [self.zero_shares() for x in xs]
 
-            x_modified[self.component_length-1] = zeta[i]
-            c.append(self.barbosa_vec[i].encrypt(x_modified, beta))
-        return c
+        components = []
+        for i in range(self.num_bases):
+            components.append(self.barbosa_vec[i].encrypt_batch(
+                [self.component_vector(xs[r], i, zetas[r][i]) for r in range(len(xs))], betas))
+        return [[components[i][r] for i in range(self.num_bases)] for r in range(len(xs))]
 
     def keygen(self, y):
         """
         Performs the keygen algorithm for IPE.
         """
         assert(len(y) == self.vector_length)
-        n = self.vector_length
         tk = []
 
         alpha = self.group.random(ZR)
         for i in range(self.num_bases):
+            tk.append(self.barbosa_vec[i].keygen(self.component_vector(y, i, -1), alpha))
 
-            y_modified = [0] * self.component_length
-            for j in range(self.component_length-1):
+        return tk
 
-                if i*ceil(n/self.num_bases) + j < len(y):
-                    y_modified[j] = y[i*ceil(n/self.num_bases)+j]
-                else:
-                    y_modified[j] = 0
+    def keygen_thresholds(self, prefix, last_values):
+        """
+        Returns one token for each value v of last_values, for the vector prefix
+        extended with v. The per-basis products with B are computed once; only
+        the basis holding the last coordinate adds v times the matching row of
+        B for each token. Every token gets its own fresh alpha.
+        """
+        assert(len(prefix) + 1 == self.vector_length)
+        y = prefix + [0]
+        width = ceil(self.vector_length / self.num_bases)
+        last_basis = len(prefix) // width
+        last_row = self.barbosa_vec[last_basis].B[len(prefix) % width]
+        bases = [self.barbosa_vec[i].key_combination(self.component_vector(y, i, -1))
+                 for i in range(self.num_bases)]
+
+        tokens = []
+        for v in last_values:
+            alpha = self.group.random(ZR)
+            tk = []
+            for i in range(self.num_bases):
+                sums = bases[i]
+                if i == last_basis:
+                    sums = [sums[j] + v * last_row[j] for j in range(self.component_length)]
+                    if metrics.ENABLED:
+                        metrics.count("zr_multiplications", self.component_length)
+                tk.append(self.barbosa_vec[i].token_from_combination(sums, alpha))
+            tokens.append(tk)
+        return tokens
+
+    def aggregate_ciphertexts(self, cts, exponents):
+        """
+        Aggregates each basis component separately. The same exponent is used for
+        every component of a record so the aggregate still decrypts to the
+        product of the per-record pairings.
+        """
+        return [self.barbosa_vec[i].aggregate_ciphertexts([ct[i] for ct in cts], exponents)
+                for i in range(self.num_bases)]
 
-            y_modified[self.component_length-1] = -1
-            tk.append(self.barbosa_vec[i].keygen(y_modified, alpha))
+    def prepare_ciphertext(self, ct, precompute_tables=False):
+        """
+        Flattens the per-basis components once so that decrypt_prepared does not
+        have to do it for every token.
+        """
+        ct_flat = [item for subl in ct for item in subl]
+        return self.barbosa_vec[0].prepare_ciphertext(ct_flat, precompute_tables)
 
-        return tk
+    def set_token_group(self, token_group):
+        """
+        See BarbosaIPEScheme.set_token_group, every basis shares the placement.
+        """
+        assert (token_group in (G1, G2)), "ERROR: Tokens must be in G1 or G2."
+        self.token_group = token_group
+
+    def ciphertext_group(self):
+        return other_source_group(self.token_group)
+
+    def prepare_token(self, tk):
+        return self.barbosa_vec[0].prepare_token([item for subl in tk for item in subl])
+
+    def decrypt_prepared(self, ct, tk) -> bool:
+        return self.barbosa_vec[0].decrypt_prepared(ct, tk)
 
     def getPublicParameters(self):
         a = []
@@ -181,16 +307,23 @@ class MultiBasesPredScheme(PredIPEScheme):
         return a
 
     @staticmethod
-    def decrypt(public_params, ct, tk, group_name='MNT159') -> bool:
+    def decrypt(public_params, ct, tk, group_name='MNT159', token_group=G1) -> bool:
         """
         Performs the decrypt algorithm for IPE on a secret key skx and ciphertext cty.
         The output is the inner product <x,y>, so long as it is in the range
-        [0,max_innerprod].
+        [0,max_innerprod]. See BarbosaIPEScheme.decrypt for token_group.
         """
         ct_flat = [item for subl in ct for item in subl]
         tk_flat = [item for subl in tk for item in subl]
-        return BarbosaIPEScheme.decrypt(public_params[0], ct_flat, tk_flat)
+        return BarbosaIPEScheme.decrypt(public_params[0], ct_flat, tk_flat, group_name, token_group)
 
     def get_seckey_size(self):
         (matrix_str, gen_bytes) = self.serialize_key()
-        return len(matrix_str) + len(gen_bytes)
\ No newline at end of file
+        return len(matrix_str) + len(gen_bytes)
+
+    def ciphertext_length(self):
+        """
+        Number of group elements, of ciphertext_group, in a ciphertext, over
+        all of its components.
+        """
+        return self.num_bases * self.component_length
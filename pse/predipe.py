@@ -18,7 +18,8 @@ PERFORMANCE OF THIS SOFTWARE.
 Implementation of Barbosa et al. CT RSA Predicate IPE Scheme
 """
 
-import sys, os, math, random, time, zlib, secrets
+import sys, os, math, random, zlib, secrets
+import numpy as np
 
 # Path hack
 sys.path.insert(0, os.path.abspath('charm'))
@@ -27,8 +28,24 @@ sys.path.insert(1, os.path.abspath('../charm'))
 from charm.toolbox.pairinggroup import PairingGroup,ZR,G1,G2,GT,pair
 from subprocess import call, Popen, PIPE
 from fhipe.fhipe import ipe
+from pse import keygen, metrics
+from pse.groups import pairing_group, element_type, other_source_group
 from charm.core.engine.util import objectToBytes,bytesToObject
 
+# PairingGroup and GT identity per group name, shared by every decrypt call
+_pairing_groups = {}
+
+
+EXPONENTIATION_COUNTERS = {G1: "g1_exponentiations", G2: "g2_exponentiations"}
+
+
+def pairing_group_identity(group_name):
+    if group_name not in _pairing_groups:
+        group = pairing_group(group_name)
+        _pairing_groups[group_name] = (group, group.init(GT, 1))
+    return _pairing_groups[group_name]
+
+
 class PredIPEScheme():
     def __init__(self, n, group_name = 'MNT159', simulated = False):
         pass
@@ -36,9 +53,27 @@ class PredIPEScheme():
     def encrypt(self, x):
         pass
 
+    def encrypt_batch(self, xs):
+        pass
+
     def keygen(self, y):
         pass
 
+    def keygen_thresholds(self, prefix, last_values):
+        pass
+
+    def aggregate_ciphertexts(self, cts, exponents):
+        pass
+
+    def prepare_ciphertext(self, ct, precompute_tables=False):
+        pass
+
+    def prepare_token(self, token):
+        pass
+
+    def decrypt_prepared(self, ct, token) -> bool:
+        pass
+
     @staticmethod
     def decrypt(self, public_params, ct, token) -> bool:
         pass
@@ -58,6 +93,12 @@ class PredIPEScheme():
     def get_seckey_size(self):
         pass
 
+    def ciphertext_length(self):
+        pass
+
+    def set_token_group(self, token_group):
+        pass
+
 class BarbosaIPEScheme(PredIPEScheme):
 
     def __init__(self,n, group_name = 'MNT159', simulated = False):
@@ -66,7 +107,7 @@ class BarbosaIPEScheme(PredIPEScheme):
 
         This function samples the generators from the group, specified optionally by
         "group_name". This variable must be one of a few set of strings specified by
-        Charm.
+        Charm, or groups.SIMULATED_GROUP for the simulated backend of pse.groups.
 
         Then, it invokes the C program ./gen_matrices, which samples random matrices
         and outputs them back to this function. The dimension n is supplied, and the
@@ -76,39 +117,32 @@ class BarbosaIPEScheme(PredIPEScheme):
         Finally, the function constructs the matrices that form the secret key and
         publishes the public parameters and secret key (pp, sk).
         """
-        group = PairingGroup(group_name)
+        group = pairing_group(group_name)
         self.group = group
+        self.group_name = group_name
+        self.gt_identity = group.init(GT, 1)
         self.vector_length = n
         self.simulated = simulated
+        # g1 generates the tokens and g2 the ciphertexts; tokens are in G1 unless set_token_group swaps them
+        self.token_group = G1
         self.g1 = None
         self.g2 = None
         self.B= None
         self.Bstar = None
+        self.matrix_cache = {}
         self.public_parameters = None
 
     @staticmethod
-    def generate_matrices(vector_length, simulated, group):
-        if not simulated:
-            matrix_seed = secrets.token_bytes(128)
+    def generate_matrices(vector_length, simulated, group, key_generator=None):
+        """
+        Samples (B, B*, pp, det(B)) with gen_matrices, in this process or, given
+        a keygen.KeyGenerator, on its workers.
+        """
+        if key_generator is not None:
+            (B, Bstar, detB) = key_generator.generate(group, vector_length, simulated)[0]
         else:
-            matrix_seed=""
-        proc = Popen(
-            [
-                os.path.dirname(os.path.realpath(__file__)) + '/../fhipe/fhipe/gen_matrices',
-                str(vector_length),
-                str(group.order()),
-                "1" if simulated else "0",
-                str(matrix_seed)
-            ],
-            stdout=PIPE
-        )
-        detB_str = proc.stdout.readline().decode()
-        B_str = proc.stdout.readline().decode()
-        Bstar_str = proc.stdout.readline().decode()
-
-        detB = group.init(ZR, int(detB_str))
-        B = ipe.parse_matrix(B_str, group)
-        Bstar = ipe.parse_matrix(Bstar_str, group)
+            (detB, B, Bstar) = keygen.run_gen_matrices(vector_length, group.order(), simulated)
+            (B, Bstar, detB) = keygen.basis_from_ints(group, vector_length, detB, B, Bstar)
 
         pp = ()
         return B, Bstar, pp, detB
@@ -116,9 +150,11 @@ class BarbosaIPEScheme(PredIPEScheme):
     def set_key(self, B, Bstar, pp, g1, g2):
         self.B = B
         self.Bstar = Bstar
+        self.matrix_cache = {}
         self.public_parameters = pp
         self.g1 = g1
         self.g2 = g2
+        self.token_group = element_type(self.group, g1)
 
         # TODO: not sure if try/except is right solution here ...
         try:
@@ -129,10 +165,11 @@ class BarbosaIPEScheme(PredIPEScheme):
         # assert self.g1.initPP(), "ERROR: Failed to init pre-computation table for g1."
         # assert self.g2.initPP(), "ERROR: Failed to init pre-computation table for g2."
 
-    def generate_keys(self):
-        (self.B, self.Bstar, self.public_parameters, detB) =self.generate_matrices(self.vector_length, self.simulated, self.group)
-        self.g1 = self.group.random(G1)
-        self.g2 = self.group.random(G2)
+    def generate_keys(self, key_generator=None):
+        (self.B, self.Bstar, self.public_parameters, detB) =self.generate_matrices(self.vector_length, self.simulated, self.group, key_generator)
+        self.matrix_cache = {}
+        self.g1 = self.group.random(self.token_group)
+        self.g2 = self.group.random(other_source_group(self.token_group))
 
         try:
             self.g1.initPP()
@@ -143,22 +180,16 @@ class BarbosaIPEScheme(PredIPEScheme):
     def write_matrix_to_file(self, matrix_filename):
         serialized_matrix = self.serialize_matrices()
         with open(matrix_filename, "a") as secret_key_file:
-            secret_key_file.write(result_str)
+            secret_key_file.write(serialized_matrix)
             secret_key_file.close()
 
     def serialize_matrices(self):
         # This has the effect of putting two spaces after the dimensions.  This is to be consistent
         # with what flint is doing as we're generating matrices from flint in other places
-        serialized_matrix = ""
-        result_str = str(self.vector_length) + " " + str(self.vector_length) + " "
-        for x in self.B:
-            for y in x:
-                result_str = result_str + " " + str(y)
-        result_str = result_str + "\n" + str(self.vector_length) + " " + str(self.vector_length) + " "
-        for x in self.Bstar:
-            for y in x:
-                result_str = result_str + " " + str(y)
-        return result_str
+        dimensions = str(self.vector_length) + " " + str(self.vector_length) + "  "
+        B_str = dimensions + " ".join(str(y) for x in self.B for y in x)
+        Bstar_str = dimensions + " ".join(str(y) for x in self.Bstar for y in x)
+        return B_str + "\n" + Bstar_str
 
 
     def print_key(self):
@@ -171,11 +202,13 @@ class BarbosaIPEScheme(PredIPEScheme):
         # print("g2")
         # print(self.g2)
 
+    @metrics.timed("write_key")
     def write_key_to_file(self, matrix_filename, generator_filename):
-        print("Calling Barbosa write key to file")
-        (matrix_str, generator_bytes)= self.serialize_key()
-        with open(matrix_filename, "w") as secret_key_file:
-            secret_key_file.write(matrix_str)
+        (matrix_bytes, generator_bytes)= self.serialize_key()
+        if metrics.ENABLED:
+            metrics.count("key_bytes_written", len(matrix_bytes) + len(generator_bytes))
+        with open(matrix_filename, "wb") as secret_key_file:
+            secret_key_file.write(matrix_bytes)
             secret_key_file.close()
 
         with open(generator_filename, "wb") as secret_key_file:
@@ -183,43 +216,60 @@ class BarbosaIPEScheme(PredIPEScheme):
             secret_key_file.close()
 
     def serialize_key(self):
-        result_str = self.serialize_matrices()
-        g1bytes = objectToBytes(self.g1, self.group)
-        g2bytes = objectToBytes(self.g2, self.group)
-
-        result_str= result_str+"\n"+str(len(g1bytes))+" "+str(len(g2bytes))
-        return result_str, g1bytes + g2bytes
+        """
+        Returns the key as (matrices, generators) in the binary format of
+        keygen.encode_key and keygen.encode_generators.
+        """
+        return keygen.encode_key(self.group, [(self.B, self.Bstar)]), \
+            keygen.encode_generators(self.group, self.g1, self.g2)
 
+    @metrics.timed("read_key")
     def read_key_from_file(self, matrix_filename, generator_filename):
-        with open(matrix_filename, "r") as secret_key_file:
+        with open(matrix_filename, "rb") as secret_key_file:
             matrix_contents = secret_key_file.read()
             secret_key_file.close()
 
         with open(generator_filename, "rb") as secret_key_file:
             generator_bytes =secret_key_file.read()
             secret_key_file.close()
+        if metrics.ENABLED:
+            metrics.count("key_bytes_read", len(matrix_contents) + len(generator_bytes))
 
         self.deserialize_key(matrix_contents, generator_bytes)
 
-    def deserialize_key(self, matrix_str, generator_bytes):
-        (Bstr, Bstarstr, gparams) = str.split(matrix_str, '\n')
-        B = ipe.parse_matrix(Bstr, self.group)
-        Bstar = ipe.parse_matrix(Bstarstr, self.group)
-
-        (g1len, g2len) = str.split(gparams, ' ')
-        g1bytes = generator_bytes[:int(g1len)]
-        g2bytes = generator_bytes[int(g1len):]
-        self.g1 = bytesToObject(g1bytes, self.group)
-        self.g2 = bytesToObject(g2bytes, self.group)
+    def deserialize_key(self, matrix_data, generator_bytes):
+        """
+        Loads a key from serialize_key, or from the text format written before
+        the binary one.
+        """
+        if keygen.is_binary_key(matrix_data):
+            [(B, Bstar)] = keygen.decode_key(self.group, matrix_data)
+            (self.g1, self.g2) = keygen.decode_generators(self.group, generator_bytes)
+        else:
+            (B, Bstar, self.g1, self.g2) = self.deserialize_text_key(matrix_data, generator_bytes)
+        self.token_group = element_type(self.group, self.g1)
 
         pp = ()
         self.B = B
         self.Bstar = Bstar
+        self.matrix_cache = {}
         self.public_parameters = pp
 
         assert self.g1.initPP(), "ERROR: Failed to init pre-computation table for g1."
         assert self.g2.initPP(), "ERROR: Failed to init pre-computation table for g2."
 
+    def deserialize_text_key(self, matrix_str, generator_bytes):
+        if isinstance(matrix_str, bytes):
+            matrix_str = matrix_str.decode()
+        (Bstr, Bstarstr, gparams) = str.split(matrix_str, '\n')
+        B = ipe.parse_matrix(Bstr, self.group)
+        Bstar = ipe.parse_matrix(Bstarstr, self.group)
+
+        (g1len, g2len) = str.split(gparams, ' ')
+        g1bytes = generator_bytes[:int(g1len)]
+        g2bytes = generator_bytes[int(g1len):]
+        return B, Bstar, bytesToObject(g1bytes, self.group), bytesToObject(g2bytes, self.group)
+
     def fake_encrypt(self, x, beta=None):
         if not beta:
             beta = self.group.random(ZR)
@@ -240,15 +290,108 @@ class BarbosaIPEScheme(PredIPEScheme):
             beta = self.group.random(ZR)
         n = len(x)
 
+        if self.is_sign_vector(x):
+            sums = self.signed_row_combination(self.Bstar, x, 'Bstar')
+        else:
+            sums = self.row_combination(self.Bstar, x)
+        c = [beta * sums[j] for j in range(n)]
+        if metrics.ENABLED:
+            metrics.count("zr_multiplications", n)
+
+        for i in range(n):
+           c[i] = self.g2 ** c[i]
+        if metrics.ENABLED:
+            metrics.count(EXPONENTIATION_COUNTERS[self.ciphertext_group()], n)
+        return c
+
+    def encrypt_batch(self, xs, betas=None):
+        """
+        Encrypts every vector of xs. The products x * B* of the whole batch are
+        computed as one matrix product X * B* mod p over integers with numpy
+        object arrays; only the beta scaling and the exponentiations are done
+        per record. betas, when given, holds one ZR scalar per vector.
+        """
+        p = int(self.group.order())
+        if 'Bstar_integers' not in self.matrix_cache:
+            self.matrix_cache['Bstar_integers'] = np.array([[int(e) for e in row] for row in self.Bstar], dtype=object)
+        X = np.array([[int(xi) for xi in x] for x in xs], dtype=object)
+        products = X.dot(self.matrix_cache['Bstar_integers']) % p
+
+        cts = []
+        for r in range(len(xs)):
+            beta = betas[r] if betas else self.group.random(ZR)
+            cts.append([self.g2 ** (beta * self.group.init(ZR, int(v))) for v in products[r]])
+            if metrics.ENABLED:
+                # the integer product X * B* is not done in the group, only the beta scaling is
+                metrics.count("zr_multiplications", len(products[r]))
+                metrics.count(EXPONENTIATION_COUNTERS[self.ciphertext_group()], len(products[r]))
+        return cts
+
+    @staticmethod
+    def is_sign_vector(x):
+        """
+        True when every coordinate but the last is an integer in {-1, 0, 1}, which
+        is how ProximitySearch and MultiBasesPredScheme encode their vectors.
+        """
+        for i in range(len(x) - 1):
+            if type(x[i]) is not int or x[i] < -1 or x[i] > 1:
+                return False
+        return True
+
+    def row_combination(self, M, x):
+        """
+        Returns sum_i x[i] * M[i], the vector-matrix product x * M over ZR.
+        """
+        n = len(x)
         c = [0] * n
         for j in range(n):
             sum = 0
             for i in range(n):
-                sum += x[i] * self.Bstar[i][j]
-            c[j] = beta * sum
+                sum += x[i] * M[i][j]
+            c[j] = sum
+        if metrics.ENABLED:
+            metrics.count("zr_multiplications", n * n)
+        return c
 
-        for i in range(n):
-           c[i] = self.g2 ** c[i]
+    def signed_row_combination(self, M, x, name):
+        """
+        Same result as row_combination for vectors accepted by is_sign_vector,
+        computed with row additions instead of n^2 multiplications. The sum of
+        the first n-1 rows of M is cached per name, so a vector without zeros
+        costs the rows on its smaller sign side plus the cached sum. The last
+        coordinate takes one scalar multiplication of the last row.
+        """
+        n = len(x)
+        positive = [i for i in range(n - 1) if x[i] == 1]
+        negative = [i for i in range(n - 1) if x[i] == -1]
+
+        def rows_sum(rows):
+            acc = [self.group.init(ZR, 0)] * n
+            for i in rows:
+                row = M[i]
+                acc = [acc[j] + row[j] for j in range(n)]
+            return acc
+
+        if len(positive) + len(negative) < n - 1:
+            plus = rows_sum(positive)
+            minus = rows_sum(negative)
+            c = [plus[j] - minus[j] for j in range(n)]
+        else:
+            if name + '_column_sum' not in self.matrix_cache:
+                self.matrix_cache[name + '_column_sum'] = rows_sum(range(n - 1))
+            column_sum = self.matrix_cache[name + '_column_sum']
+            if len(negative) <= len(positive):
+                minus = rows_sum(negative)
+                c = [column_sum[j] - minus[j] - minus[j] for j in range(n)]
+            else:
+                plus = rows_sum(positive)
+                c = [plus[j] + plus[j] - column_sum[j] for j in range(n)]
+
+        if not (type(x[n - 1]) is int and x[n - 1] == 0):
+            last_row = M[n - 1]
+            c = [c[j] + x[n - 1] * last_row[j] for j in range(n)]
+            if metrics.ENABLED:
+                metrics.count("zr_multiplications", n)
         return c
 
     def fake_keygen(self, y, alpha=None):
@@ -269,38 +412,140 @@ class BarbosaIPEScheme(PredIPEScheme):
     def keygen(self, y, alpha=None):
         if not alpha:
             alpha = self.group.random(ZR)
-        n = len(y)
-
-        k = [0] * n
-        for j in range(n):
-            sum = 0
-            for i in range(n):
-                sum += y[i] * self.B[i][j]
-            k[j] = alpha * sum
+        return self.token_from_combination(self.key_combination(y), alpha)
 
-        for i in range(n):
-            k[i] = self.g1 ** k[i]
-        return k
+    def keygen_thresholds(self, prefix, last_values):
+        """
+        Returns one token for each value v of last_values, for the vector prefix
+        extended with v. The product prefix * B is computed once and each token
+        only adds v times the last row of B, then gets its own fresh alpha.
+        """
+        n = len(prefix) + 1
+        base = self.key_combination(prefix + [0])
+        last_row = self.B[n - 1]
+        tokens = []
+        for v in last_values:
+            sums = [base[j] + v * last_row[j] for j in range(n)]
+            if metrics.ENABLED:
+                metrics.count("zr_multiplications", n)
+            tokens.append(self.token_from_combination(sums, self.group.random(ZR)))
+        return tokens
+
+    def key_combination(self, y):
+        if self.is_sign_vector(y):
+            return self.signed_row_combination(self.B, y, 'B')
+        return self.row_combination(self.B, y)
+
+    def token_from_combination(self, sums, alpha):
+        token = [self.g1 ** (alpha * sums[j]) for j in range(len(sums))]
+        if metrics.ENABLED:
+            metrics.count("zr_multiplications", len(sums))
+            metrics.count(EXPONENTIATION_COUNTERS[self.token_group], len(sums))
+        return token
 
 
 
     def getPublicParameters(self):
         return self.public_parameters
 
+    def aggregate_ciphertexts(self, cts, exponents):
+        """
+        Combines the ciphertexts cts coordinate-wise as prod_r cts[r][j]^exponents[r].
+        By bilinearity, decrypting the aggregate with a token pairs to
+        prod_r e(cts[r], token)^exponents[r].
+        """
+        n = len(cts[0])
+        exponents = [self.group.init(ZR, e) for e in exponents]
+        aggregate = [cts[0][j] ** exponents[0] for j in range(n)]
+        if metrics.ENABLED:
+            metrics.count(EXPONENTIATION_COUNTERS[self.ciphertext_group()], n)
+        for r in range(1, len(cts)):
+            for j in range(n):
+                aggregate[j] = aggregate[j] * (cts[r][j] ** exponents[r])
+            if metrics.ENABLED:
+                metrics.count(EXPONENTIATION_COUNTERS[self.ciphertext_group()], n)
+        return aggregate
+
+    def prepare_ciphertext(self, ct, precompute_tables=False):
+        """
+        Returns ct in the flat form taken by decrypt_prepared. With
+        precompute_tables, a fixed-base exponentiation table is built in place
+        for every element, which speeds up later aggregate_ciphertexts calls on
+        this ciphertext at the cost of the table memory.
+        """
+        if precompute_tables:
+            for elem in ct:
+                try:
+                    elem.initPP()
+                except ValueError:
+                    # table already built for this element
+                    pass
+        return ct
+
+    def set_token_group(self, token_group):
+        """
+        Puts tokens in token_group, G1 or G2, and ciphertexts in the other one
+        for the next generate_keys; a loaded key brings its own placement. A
+        search pairs one token with every record, so the placement decides
+        which group's elements are stored and decoded for every record and which
+        are computed once per query. Only the placement changes, the pairings
+        themselves cost the same either way.
+        """
+        assert (token_group in (G1, G2)), "ERROR: Tokens must be in G1 or G2."
+        self.token_group = token_group
+
+    def ciphertext_group(self):
+        return other_source_group(self.token_group)
+
+    def prepare_token(self, token):
+        """
+        Returns token in the flat form taken by decrypt_prepared, once per
+        token before it is paired with every record. Charm does not expose
+        PBC's fixed-argument pairing (pairing_pp_init), so no pairing work is
+        precomputed and the token is returned as is.
+        """
+        return token
+
+    def decrypt_prepared(self, ct, token) -> bool:
+        """
+        Decrypts with this instance's group and GT identity. The product of the
+        pairings is computed as one multi-pairing, so the Miller loops share a
+        single final exponentiation.
+        """
+        if metrics.ENABLED:
+            metrics.count("pairings", len(token))
+            metrics.count("pairing_products")
+        # pair_prod takes the G1 elements first
+        if self.token_group == G1:
+            return self.group.pair_prod(token, ct) == self.gt_identity
+        return self.group.pair_prod(ct, token) == self.gt_identity
+
     @staticmethod
-    def decrypt(public_params, ct, token, group_name='MNT159') -> bool:
+    def decrypt(public_params, ct, token, group_name='MNT159', token_group=G1) -> bool:
         """
         Performs the decrypt algorithm for IPE on a secret key skx and ciphertext cty.
         The output is the inner product <x,y>, so long as it is in the range
-        [0,max_innerprod].
+        [0,max_innerprod]. token_group is the token_group of the key, G2 for
+        keys made after set_token_group(G2).
         """
-
-        result = ipe.innerprod_pair(ct, token)
-        return result == PairingGroup(group_name).init(GT,1)
+        (group, gt_identity) = pairing_group_identity(group_name)
+        if metrics.ENABLED:
+            metrics.count("pairings", len(token))
+            metrics.count("pairing_products")
+        # pair_prod takes the G1 elements first
+        if token_group == G2:
+            return group.pair_prod(ct, token) == gt_identity
+        return group.pair_prod(token, ct) == gt_identity
     def get_seckey_size(self):
         (matrix_str, gen_bytes) = self.serialize_key()
         return len(matrix_str) + len(gen_bytes)
 
+    def ciphertext_length(self):
+        """
+        Number of group elements, of ciphertext_group, in a ciphertext.
+        """
+        return self.vector_length
+
 
 
 
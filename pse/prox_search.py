@@ -19,7 +19,7 @@ Implementation of Ahmad et al. Proximity Search Scheme
 """
 
 import concurrent
-import sys, os, math, random, time, zlib, secrets, dill, threading, time, asyncio
+import sys, os, math, random, time, zlib, secrets, dill, threading, time, asyncio, multiprocessing, tempfile, shutil
 from math import ceil
 from charm.core.engine.util import objectToBytes, bytesToObject
 
@@ -29,7 +29,25 @@ sys.path.insert(1, os.path.abspath('../charm'))
 
 from subprocess import call, Popen, PIPE
 
-from pathos.multiprocessing import ProcessingPool as Pool, cpu_count
+from pse.scheduler import ChunkScheduler, DEFAULT_CHUNK_SIZE
+from pse import metrics
+from pse.ctstore import SharedCiphertextStore, CiphertextFile, CiphertextFileWriter, LayeredStore, attach_store, \
+    write_store_file, read_store_file, compact_store_file, ciphertext_shape, ciphertext_tag, encode_ciphertext, \
+    element_width, pack_tokens, unpack_tokens, unpack_records
+
+# Scheme resident in each encryption worker of encrypt_stream, set once by load_encrypt_worker
+_encrypt_worker = None
+
+# State resident in each worker of a parallel search, set once by load_search_worker: the keyed scheme,
+# the query tokens, the attached store and the event set once a limited search has enough matches
+_search_worker = None
+_search_tokens = None
+_search_store = None
+_search_removed = set()
+_search_stop_event = None
+
+# Number of records a scan goes through between checks of its stop event
+STOP_CHECK_INTERVAL = 16
 
 
 class ProximitySearch():
@@ -43,17 +61,40 @@ class ProximitySearch():
         self.generators_file = None
         self.group_name = group_name
         self.parallel = 0
-        self.enc_data_size = 0
         self.num_records = 0
-
-    def generate_keys(self):
-        self.predinstance.generate_keys()
+        self.ct_element_width = None
+        self.shards = []
+        self.shard_dir = None
+        self.batch_tests = 0
+        self.batch_aggregates = 0
+        self.batch_false_negative_bound = 0
+        self.batch_false_positive_bound = 0
+        self.precompute = False
+        self.precompute_table_records = 0
+        self.ct_index = {}
+        self.shared_store = None
+        self.next_id = 0
+        self.store_lock = threading.Lock()
+        self.scheduler = ChunkScheduler()
+
+    def set_token_group(self, token_group):
+        """
+        Places tokens in token_group, G1 or G2, and ciphertexts in the other
+        group for the next generate_keys, see BarbosaIPEScheme.set_token_group.
+        """
+        self.predinstance.set_token_group(token_group)
+
+    @metrics.timed("generate_keys")
+    def generate_keys(self, key_generator=None):
+        self.ct_element_width = None
+        self.predinstance.generate_keys(key_generator)
         self.public_parameters = self.predinstance.getPublicParameters()
 
     def serialize_key(self):
         return self.predinstance.serialize_key()
 
     def deserialize_key(self, matrix_str, generator_bytes):
+        self.ct_element_width = None
         self.predinstance.deserialize_key(matrix_str, generator_bytes)
         self.public_parameters = self.predinstance.getPublicParameters()
 
@@ -64,162 +105,726 @@ class ProximitySearch():
         self.predinstance.write_key_to_file(matrix_filename, generator_filename)
 
 
+    def set_scheduler(self, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Sets the number of worker processes and the chunk size, in records,
+        used by encrypt_dataset_parallel and parallel_search, see
+        pse.scheduler. With chunk_size None every worker gets one equal share.
+        """
+        self.scheduler = ChunkScheduler(workers, chunk_size)
+
+    def set_shard_directory(self, directory):
+        """
+        Sets the directory encrypt_dataset_parallel writes its shard files to.
+        By default every database gets a new ciphertexts_* directory in the
+        working directory on its first encrypt_dataset_parallel.
+        """
+        self.shard_dir = os.path.abspath(directory)
+
+    def set_precomputation(self, enabled=True, table_records=0):
+        """
+        Turns the precomputed-ciphertext index of batch_search on or off. When
+        on, every record keeps its prepared ciphertext, built at encryption time
+        or lazily on first use, and the first table_records records (all of them
+        if None) get fixed-base exponentiation tables for aggregate_ciphertexts.
+        Tables cost far more memory than the ciphertexts themselves,
+        table_records trades that memory for speed. search pairs each ciphertext
+        once per token and gains nothing from the index, so it does not use it.
+        """
+        self.precompute = enabled
+        self.precompute_table_records = table_records
+        self.ct_index = {}
+
+    def build_precomputation(self):
+        for x in self.enc_data:
+            self.prepared_ciphertext(x)
+
+    def prepared_ciphertext(self, x):
+        ct = self.ct_index.get(x)
+        if ct is None:
+            precompute_tables = self.precompute and (self.precompute_table_records is None or
+                                                     len(self.ct_index) < self.precompute_table_records)
+            ct = self.predinstance.prepare_ciphertext(self.enc_data[x], precompute_tables)
+            if self.precompute:
+                self.ct_index[x] = ct
+        return ct
+
+    def share_encrypted_data(self):
+        """
+        Copies the encrypted database, held in memory, in the shard files of
+        encrypt_dataset_parallel or in an opened store file, into a shared
+        memory segment with one fixed width record per ciphertext. Search
+        workers then map the segment and decode only their records instead of
+        reading and unpickling shard files. The segment becomes enc_data and
+        lives until release_shared_data is called.
+        """
+        store = SharedCiphertextStore.create(self.predinstance.group, self.gather_encrypted_data())
+        self.release_shared_data()
+        self.shared_store = store
+        self.enc_data = store
+        self.ct_index = {}
+        return store
+
+    def release_shared_data(self):
+        if self.shared_store is not None:
+            if self.backed_by_store():
+                self.enc_data = None
+            self.shared_store.close()
+            if isinstance(self.shared_store, SharedCiphertextStore):
+                self.shared_store.unlink()
+            self.shared_store = None
+
+    def backed_by_store(self):
+        """
+        True when enc_data is shared_store, possibly with records added and
+        removed on top of it.
+        """
+        enc_data = self.enc_data
+        if isinstance(enc_data, LayeredStore):
+            enc_data = enc_data.base
+        return self.shared_store is not None and enc_data is self.shared_store
+
+    def gather_encrypted_data(self):
+        if self.enc_data:
+            return self.enc_data
+        enc_data = {}
+        for (start, end) in self.shards:
+            shard = read_store_file(self.shard_path(start, end), self.predinstance.group)
+            enc_data.update({x + start: shard[x] for x in shard})
+        return enc_data
+
+    def store_metadata(self):
+        return {'scheme': self.predicate_scheme.__name__, 'group': self.group_name, 'n': self.vector_length,
+                'bases': getattr(self.predinstance, 'num_bases', 1)}
+
+    @metrics.timed("save_encrypted_data")
+    def save_encrypted_data(self, filename):
+        """
+        Writes the encrypted database to the store file filename, see
+        pse.ctstore. Records keep their indices.
+        """
+        write_store_file(filename, self.predinstance.group, self.gather_encrypted_data(),
+                         dict(self.store_metadata(), next_id=self.next_id))
+
+    @metrics.timed("open_encrypted_data")
+    def open_encrypted_data(self, filename, cache=True):
+        """
+        Maps the store file filename, written by save_encrypted_data with the
+        same key, as the encrypted database. Records are read and decoded on
+        first access and kept decoded, or only the cache most recently used
+        ones if cache is a number. Search workers open the file themselves and
+        each take a range of its records, whatever number of workers is used.
+        """
+        store = CiphertextFile.open(filename, self.predinstance.group, cache)
+        metadata = self.store_metadata()
+        for key in metadata:
+            if store.metadata.get(key) != metadata[key]:
+                store.close()
+                raise ValueError("Store " + filename + " has " + key + " " + str(store.metadata.get(key)) +
+                                 ", expected " + str(metadata[key]))
+        self.release_shared_data()
+        self.shared_store = store
+        self.enc_data = store
+        self.ct_index = {}
+        self.shards = []
+        self.num_records = len(store)
+        self.next_id = store.next_id()
+        return store
+
+    def mutable_data(self):
+        """
+        Returns enc_data ready to take added and removed records: a store is
+        wrapped in a LayeredStore, a database in shard files is first moved to
+        a shared memory store.
+        """
+        if not self.enc_data and self.shards:
+            self.share_encrypted_data()
+        if self.enc_data is None:
+            self.enc_data = {}
+        if not isinstance(self.enc_data, (dict, LayeredStore)):
+            self.enc_data = LayeredStore(self.enc_data)
+        return self.enc_data
+
+    @metrics.timed("add_records")
+    def add_records(self, data_set, batch=False):
+        """
+        Encrypts the records of data_set and adds them to the encrypted
+        database without touching the existing records. Returns the ids given
+        to the new records; ids are never reused, also after remove_records.
+        On a database opened from a store the records are kept in memory until
+        the next compact.
+        """
+        for data_item in data_set:
+            if len(data_item) != self.vector_length:
+                raise ValueError("Improper Vector Size")
+        if batch:
+            cts = self.predinstance.encrypt_batch([self.encode_record(x) for x in data_set])
+        else:
+            cts = [self.predinstance.encrypt(self.encode_record(x)) for x in data_set]
+        with self.store_lock:
+            record_ids = list(range(self.next_id, self.next_id + len(cts)))
+            self.next_id = self.next_id + len(cts)
+        self.insert_ciphertexts(dict(zip(record_ids, cts)))
+        return record_ids
+
+    def insert_ciphertexts(self, cts):
+        with self.store_lock:
+            enc_data = self.mutable_data()
+            for x in cts:
+                if x not in enc_data:
+                    self.num_records = self.num_records + 1
+                enc_data[x] = cts[x]
+                self.next_id = max(self.next_id, x + 1)
+                if self.precompute:
+                    self.prepared_ciphertext(x)
+
+    def remove_records(self, record_ids):
+        """
+        Removes the records with the given ids; unknown ids are ignored. On a
+        database opened from a store the records are tombstoned until the next
+        compact.
+        """
+        with self.store_lock:
+            enc_data = self.mutable_data()
+            for x in record_ids:
+                if x in enc_data:
+                    del enc_data[x]
+                    self.num_records = self.num_records - 1
+                self.ct_index.pop(x, None)
+
+    def store_changes(self):
+        """
+        Returns the records added to and the ids removed from shared_store
+        since it was written.
+        """
+        with self.store_lock:
+            if not isinstance(self.enc_data, LayeredStore):
+                return ({}, [])
+            return (dict(self.enc_data.added), sorted(self.enc_data.removed))
+
+    def compact(self, background=False):
+        """
+        Folds records added and removed since the store was written into the
+        store. A store file is rewritten next to the old one, without decoding
+        the records it keeps, and swapped in; a shared memory segment is
+        rebuilt. With background the file is rewritten in a thread, which is
+        returned, while searches, insertions and removals go on against the
+        old store.
+        """
+        if not isinstance(self.enc_data, LayeredStore):
+            return None
+        if not isinstance(self.enc_data.base, CiphertextFile):
+            self.share_encrypted_data()
+            return None
+        thread = threading.Thread(target=self.compact_store_file)
+        if background:
+            thread.start()
+            return thread
+        self.compact_store_file()
+        return None
+
+    def compact_store_file(self):
+        with self.store_lock:
+            layered = self.enc_data
+            snapshot = LayeredStore(layered.base)
+            snapshot.added = dict(layered.added)
+            snapshot.removed = set(layered.removed)
+            next_id = self.next_id
+        filename = layered.base.filename
+        compact_store_file(filename + ".compact", self.predinstance.group, snapshot, next_id)
+        with self.store_lock:
+            if self.enc_data is not layered:
+                # the database was replaced meanwhile, drop the rewrite
+                os.remove(filename + ".compact")
+                return
+            os.replace(filename + ".compact", filename)
+            store = CiphertextFile.open(filename, self.predinstance.group)
+            # keep what changed while the file was being written; the old store
+            # is left to searches still running on it and freed with them
+            current = LayeredStore(store)
+            current.removed = layered.removed - snapshot.removed
+            for x in layered.added:
+                if snapshot.added.get(x) is not layered.added[x]:
+                    current[x] = layered.added[x]
+            self.shared_store = store
+            self.enc_data = current if current.added or current.removed else store
+            self.num_records = len(self.enc_data)
+
     @staticmethod
-    def augment_encrypt(n, predicate_scheme, group_name, matrix_str, generator_bytes, pp, vec_list, start_index,
-                        end_index):
-        prox_instance = ProximitySearch(n, predicate_scheme, group_name)
-        prox_instance.deserialize_key(matrix_str, generator_bytes)
-        prox_instance.public_parameters = pp
-        prox_instance.encrypt_dataset(vec_list)
-
-        # store encrypted data chunk in file ciphertexts_pid
-        with open("ciphertexts_" + str(start_index) + "_" + str(end_index), "wb") as enc_file:
-            enc_file.write(objectToBytes(prox_instance.enc_data, prox_instance.predinstance.group))
-            enc_file.close()
-            return os.stat("ciphertexts_" + str(start_index) + "_" + str(end_index)).st_size
+    def shard_filename(start_index, end_index):
+        return "ciphertexts_" + str(start_index) + "_" + str(end_index)
+
+    def shard_path(self, start_index, end_index):
+        return os.path.join(self.shard_dir, self.shard_filename(start_index, end_index))
+
+    def remove_shard_files(self):
+        for (start, end) in self.shards:
+            if os.path.exists(self.shard_path(start, end)):
+                os.remove(self.shard_path(start, end))
+        self.shards = []
+
+    @staticmethod
+    def augment_encrypt(start_index, end_index, vec_list, batch=False, shard_dir="."):
+        _encrypt_worker.encrypt_dataset(vec_list, batch)
+
+        # store encrypted data chunk in file ciphertexts_start_end, a store file indexed from zero
+        shard_file = os.path.join(shard_dir, ProximitySearch.shard_filename(start_index, end_index))
+        write_store_file(shard_file, _encrypt_worker.predinstance.group, _encrypt_worker.enc_data, {})
+        return os.stat(shard_file).st_size
         # TODO will need to augment this to store class identifier
 
-    def encrypt_dataset_parallel(self, data_set):
+    @metrics.timed("encrypt_dataset_parallel")
+    def encrypt_dataset_parallel(self, data_set, batch=False):
+        """
+        Encrypts data_set to shard files, one per chunk of the scheduler, see
+        set_scheduler, in the shard directory, see set_shard_directory. The
+        files of a previous call are removed.
+        """
         self.parallel = 1
         for data_item in data_set:
             if len(data_item) != self.vector_length:
                 raise ValueError("Improper Vector Size")
+        self.release_shared_data()
         self.enc_data = {}
+        self.ct_index = {}
+        if self.shard_dir is None:
+            self.shard_dir = tempfile.mkdtemp(prefix="ciphertexts_", dir=os.getcwd())
+        else:
+            self.remove_shard_files()
+            os.makedirs(self.shard_dir, exist_ok=True)
 
-        processes = cpu_count()
-        data_set_split = []
         data_set_len = len(data_set)
         self.num_records = data_set_len
-        for j in range(processes):
-            start = ceil(j * data_set_len / processes)
-            end = ceil((j + 1) * data_set_len / processes)
-            if end > data_set_len:
-                end = data_set_len
-            data_set_split.append((start, end, data_set[start:end]))
-        total_data_size = 0
+        self.shards = self.scheduler.chunks(0, data_set_len)
+        self.next_id = data_set_len
         (matrix_str, generator_bytes) = self.serialize_key()
-        with Pool(processes) as p:
-            with concurrent.futures.ProcessPoolExecutor(processes) as executor:
-                future_list = {executor.submit(self.augment_encrypt, self.vector_length, self.predicate_scheme,
-                                               self.group_name, matrix_str, generator_bytes,
-                                               self.public_parameters, data_set_component, start, end)
-                               for (start, end, data_set_component) in data_set_split
-                               }
-                for future in concurrent.futures.as_completed(future_list):
-                    res = future.result()
-                    if res is not None:
-                        total_data_size = total_data_size + res
-        self.enc_data_size = total_data_size
-
-    def encrypt_dataset(self, data_set):
+        with self.scheduler.executor(self.load_encrypt_worker,
+                                     (self.vector_length, self.predicate_scheme, self.group_name, matrix_str,
+                                      generator_bytes, self.public_parameters)) as executor:
+            future_list = [metrics.submit(executor, self.augment_encrypt, start, end, data_set[start:end], batch,
+                                          self.shard_dir)
+                           for (start, end) in self.shards]
+            for future in concurrent.futures.as_completed(future_list):
+                metrics.unwrap(future.result())
+
+    @staticmethod
+    def load_encrypt_worker(n, predicate_scheme, group_name, matrix_str, generator_bytes, pp):
+        global _encrypt_worker
+        _encrypt_worker = ProximitySearch(n, predicate_scheme, group_name)
+        _encrypt_worker.deserialize_key(matrix_str, generator_bytes)
+        _encrypt_worker.public_parameters = pp
+
+    @staticmethod
+    def augment_encrypt_chunk(chunk, batch=False):
+        return _encrypt_worker.encrypt_chunk(chunk, batch)
+
+    def encrypt_chunk(self, chunk, batch=False):
+        """
+        Encrypts the records of chunk and returns their ciphertext_shape,
+        ciphertext_tag and their encodings for the store file.
+        """
+        if batch:
+            cts = self.predinstance.encrypt_batch([self.encode_record(x) for x in chunk])
+        else:
+            cts = [self.predinstance.encrypt(self.encode_record(x)) for x in chunk]
+        return (ciphertext_shape(cts[0]), ciphertext_tag(self.predinstance.group, cts[0]),
+                [encode_ciphertext(self.predinstance.group, ct) for ct in cts])
+
+    @metrics.timed("encrypt_stream")
+    def encrypt_stream(self, data_set, filename, chunk_size=256, processes=None, batch=False, append=False,
+                       first_id=None):
+        """
+        Encrypts the records of data_set, any iterable, into the store file
+        filename and opens the file as the encrypted database. Records are read
+        chunk_size at a time and encrypted by processes worker processes (as
+        many as the scheduler has by default, in this process if 0), which hold
+        the key for the whole run. At most two chunks per worker are in flight
+        and finished chunks are written out in order, so memory stays flat
+        however many records there are. With append the records are added to
+        the existing store instead of replacing it. Records are numbered from
+        first_id, by default from 0 or, when appending, after every id the store
+        and the current database have used. Appending is refused while the
+        current database has records added or removed since it was stored,
+        which opening the file would drop: compact it first. Returns the number
+        of records encrypted.
+
+        The records are written to filename.stream, a copy of the store when
+        appending, which replaces filename once every record is in. If a record
+        is invalid or encryption fails, the file is dropped and the current
+        database and filename are left as they were.
+        """
+        if append:
+            (added, removed) = self.store_changes()
+            if added or removed:
+                raise ValueError("ERROR: Database has records added or removed since it was stored, compact it "
+                                 "before appending")
+        partial_filename = filename + ".stream"
+        processes = processes if processes is not None else self.scheduler.workers
+        num_encrypted = 0
+        writer = None
+
+        def write_chunk(result):
+            nonlocal num_encrypted
+            (shape, tag, encoded) = result
+            for data in encoded:
+                writer.append_encoded(first_id + num_encrypted, data, shape, tag)
+                num_encrypted = num_encrypted + 1
+
+        def chunks():
+            chunk = []
+            for data_item in data_set:
+                if len(data_item) != self.vector_length:
+                    raise ValueError("Improper Vector Size")
+                chunk.append(data_item)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        try:
+            if append and os.path.exists(filename):
+                shutil.copyfile(filename, partial_filename)
+            writer = CiphertextFileWriter(partial_filename, self.predinstance.group, self.store_metadata(), append)
+            if first_id is None:
+                first_id = max(writer.next_id, self.next_id) if append else writer.next_id
+            if processes == 0:
+                for chunk in chunks():
+                    write_chunk(self.encrypt_chunk(chunk, batch))
+            else:
+                (matrix_str, generator_bytes) = self.serialize_key()
+                with concurrent.futures.ProcessPoolExecutor(
+                        processes, initializer=self.load_encrypt_worker,
+                        initargs=(self.vector_length, self.predicate_scheme, self.group_name, matrix_str,
+                                  generator_bytes, self.public_parameters)) as executor:
+                    pending = []
+                    for chunk in chunks():
+                        pending.append(metrics.submit(executor, self.augment_encrypt_chunk, chunk, batch))
+                        while len(pending) >= 2 * processes:
+                            write_chunk(metrics.unwrap(pending.pop(0).result()))
+                    for future in pending:
+                        write_chunk(metrics.unwrap(future.result()))
+            writer.close()
+        except BaseException:
+            if writer is not None:
+                writer.discard()
+            elif os.path.exists(partial_filename):
+                os.remove(partial_filename)
+            raise
+        os.replace(partial_filename, filename)
+        self.open_encrypted_data(filename)
+        return num_encrypted
+
+    @metrics.timed("encrypt_dataset")
+    def encrypt_dataset(self, data_set, batch=False):
+        """
+        Encrypts data_set record by record, or with batch as one bulk
+        encrypt_batch call on the whole sign matrix.
+        """
         for data_item in data_set:
             if len(data_item) != self.vector_length:
                 raise ValueError("Improper Vector Size")
+        self.release_shared_data()
         self.enc_data = {}
 
-        i = 0
-        for x in data_set:
-            x2 = [xi if xi == 1 else -1 for xi in x]
-            x2.append(-1)
-            self.enc_data[i] = self.predinstance.encrypt(x2)
-            i = i + 1
+        if batch:
+            cts = self.predinstance.encrypt_batch([self.encode_record(x) for x in data_set])
+            for i in range(len(cts)):
+                self.enc_data[i] = cts[i]
+        else:
+            i = 0
+            for x in data_set:
+                self.enc_data[i] = self.predinstance.encrypt(self.encode_record(x))
+                i = i + 1
+        self.next_id = len(self.enc_data)
+        self.num_records = len(self.enc_data)
+
+        self.ct_index = {}
+        if self.precompute:
+            self.build_precomputation()
+
+    @staticmethod
+    def encode_record(x):
+        x2 = [xi if xi == 1 else -1 for xi in x]
+        x2.append(-1)
+        return x2
 
+    @metrics.timed("generate_query")
     def generate_query(self, query, distance):
+        """
+        Returns the distance + 1 threshold tokens for query in random order. The
+        thresholds only differ in the last coordinate, so the tokens are derived
+        from one shared product with keygen_thresholds.
+        """
         encoded_query = [xi if xi == 1 else -1 for xi in query]
-        query_set = []
-        for i in range(distance + 1):
-            temp_query = list(encoded_query)
-            temp_query.append(self.vector_length - 2 * i)
-            query_set.append(temp_query)
-
-        # print("Query set is " + str(query_set))
-        encrypted_query = []
-        while (len(query_set) > 0):
-            next_to_encode = secrets.randbelow(len(query_set))
-            encrypted_query.append(self.predinstance.keygen(query_set[next_to_encode]))
-            query_set.remove(query_set[next_to_encode])
-        return encrypted_query
+        thresholds = list(range(distance + 1))
+
+        order = []
+        while (len(thresholds) > 0):
+            next_to_encode = secrets.randbelow(len(thresholds))
+            order.append(thresholds[next_to_encode])
+            thresholds.remove(thresholds[next_to_encode])
+        return self.predinstance.keygen_thresholds(encoded_query, [self.vector_length - 2 * i for i in order])
 
     @staticmethod
-    def augment_search(n, predicate_scheme, group_name, matrix_str, generator_bytes, token_bytes, pp,
-                       start_index, end_index):
-        prox_scheme = ProximitySearch(n + 1, predicate_scheme, group_name)
-        prox_scheme.deserialize_key(matrix_str, generator_bytes)
-        prox_scheme.public_parameters = pp
-        with open("ciphertexts_" + str(start_index) + "_" + str(end_index), "rb") as enc_file:
-            prox_scheme.enc_data = bytesToObject(enc_file.read(), prox_scheme.predinstance.group)
-            enc_file.close()
-        token = bytesToObject(token_bytes, prox_scheme.predinstance.group)
-        indices = prox_scheme.search(token)
-        return [x+start_index for x in indices]
-
-    def parallel_search(self, query):
+    def load_search_worker(n, predicate_scheme, group_name, matrix_str, generator_bytes, pp, packed_tokens,
+                           stop_event=None, store_descriptor=None, removed=()):
+        global _search_worker, _search_tokens, _search_store, _search_removed, _search_stop_event
+        _search_worker = ProximitySearch(n, predicate_scheme, group_name)
+        _search_worker.deserialize_key(matrix_str, generator_bytes)
+        _search_worker.public_parameters = pp
+        _search_tokens = unpack_tokens(_search_worker.predinstance.group, packed_tokens)
+        if store_descriptor is not None:
+            _search_store = attach_store(_search_worker.predinstance.group, store_descriptor)
+        _search_removed = set(removed)
+        _search_stop_event = stop_event
+
+    @staticmethod
+    def augment_search(start_index, end_index, limit=None, shard_dir="."):
+        shard_file = os.path.join(shard_dir, ProximitySearch.shard_filename(start_index, end_index))
+        _search_worker.enc_data = read_store_file(shard_file, _search_worker.predinstance.group)
+        indices_list = _search_worker.search_many(_search_tokens, limit,
+                                                  _search_stop_event if limit is not None else None)
+        return [[x+start_index for x in indices] for indices in indices_list]
+
+    @staticmethod
+    def augment_search_shared(start_slot, end_slot, limit=None):
+        _search_worker.enc_data = _search_store.view(start_slot, end_slot)
+        if _search_removed:
+            _search_worker.enc_data = LayeredStore(_search_worker.enc_data)
+            _search_worker.enc_data.removed = _search_removed
+        return _search_worker.search_many(_search_tokens, limit, _search_stop_event if limit is not None else None)
+
+    def apply_store_changes(self, packed_added, removed):
+        """
+        Brings a worker's view of the store up to date with the records added
+        and removed since it was written, see store_changes. packed_added is
+        the pack_records of the added records.
+        """
+        if removed:
+            self.remove_records(removed)
+        if packed_added is not None:
+            self.insert_ciphertexts(dict(unpack_records(self.predinstance.group, packed_added, False).items()))
+
+    @staticmethod
+    def collect_search_results(future_list, num_queries, limit=None, stop_event=None, initial=None):
+        """
+        Merges the per-chunk results of a sharded search, starting from the
+        lists in initial if given, as they complete. With limit, once every
+        query has limit matches stop_event is set so that running chunks end
+        their scans, chunks not started yet are cancelled, and the lists are
+        cut to limit.
+        """
+        overall_return_lists = [list(indices) for indices in initial] if initial is not None else \
+            [[] for j in range(num_queries)]
+
+        def enough():
+            return limit is not None and all(len(return_list) >= limit for return_list in overall_return_lists)
+
+        if not enough():
+            for future in concurrent.futures.as_completed(future_list):
+                res = metrics.unwrap(future.result())
+                if res is not None:
+                    for (overall_return_list, indices) in zip(overall_return_lists, res):
+                        overall_return_list.extend(indices)
+                if enough():
+                    break
+        if enough():
+            stop_event.set()
+            for pending in future_list:
+                pending.cancel()
+            # leave the workers idle, the chunks still scanning stop at their next check
+            concurrent.futures.wait(future_list)
+        if limit is not None:
+            return [return_list[:limit] for return_list in overall_return_lists]
+        return overall_return_lists
+
+    def parallel_search(self, query, limit=None, first_match=False):
+        """
+        Sharded version of search, see search for limit and first_match. Which
+        matches are returned under a limit depends on which chunks finish first.
+        """
+        return self.parallel_search_many([query], 1 if first_match else limit)[0]
+
+    @metrics.timed("parallel_search_many")
+    def parallel_search_many(self, queries, limit=None):
+        """
+        Sharded version of search_many. The database is cut into the chunks of
+        the scheduler, see set_scheduler, which workers holding the key and the
+        tokens take in turn. Chunks are read from the store after
+        share_encrypted_data or open_encrypted_data, otherwise every shard file
+        of encrypt_dataset_parallel is a chunk. Records added to a store since
+        it was written are searched in this process meanwhile. With limit,
+        chunks stop as soon as every query has limit matches in total.
+        """
         self.parallel = 1
 
-        processes = cpu_count()
-        data_set_split = []
-        query_filename = "query"
-        query_bytes = objectToBytes(query, self.predinstance.group)
-
-        for j in range(processes):
-            start = ceil(j * self.num_records / processes)
-            end = ceil((j + 1) * self.num_records / processes)
-            if end > self.num_records:
-                end = self.num_records
-            data_set_split.append((start, end))
-        overall_return_list = []
+        packed_queries = pack_tokens(self.predinstance.group, queries)
+        stop_event = multiprocessing.Event() if limit is not None else None
+        store_descriptor = None
+        (added, removed) = ({}, [])
+        chunk_args = (limit,)
+        if self.shared_store is not None:
+            store_descriptor = self.shared_store.descriptor()
+            (added, removed) = self.store_changes()
+            chunks = self.scheduler.chunks(0, len(self.shared_store))
+            search_chunk = self.augment_search_shared
+        else:
+            chunks = list(self.shards)
+            if not chunks:
+                processes = self.scheduler.workers
+                for j in range(processes):
+                    start = ceil(j * self.num_records / processes)
+                    end = ceil((j + 1) * self.num_records / processes)
+                    if end > self.num_records:
+                        end = self.num_records
+                    chunks.append((start, end))
+            search_chunk = self.augment_search
+            chunk_args = (limit, self.shard_dir or ".")
         (matrix_str, generator_bytes) = self.serialize_key()
-        with Pool(processes) as p:
-            with concurrent.futures.ProcessPoolExecutor(processes) as executor:
-                future_list = {
-                    executor.submit(self.augment_search, self.vector_length, self.predicate_scheme, self.group_name,
-                                    matrix_str, generator_bytes, query_bytes, self.public_parameters, start,
-                                    end)
-                    for (start, end) in data_set_split
-                    }
-                for future in concurrent.futures.as_completed(future_list):
-                    res = future.result()
-                    if res is not None and len(res) > 0:
-                        overall_return_list = overall_return_list + res
-
-        return overall_return_list
-
-    def search(self, query):
-        result_list = []
-        for x in self.enc_data:
-            index = None
-            for subquery in query:
-                if self.predinstance.decrypt(self.predinstance.getPublicParameters(), self.enc_data[x], subquery, self.group_name):
-                    index = int(x)
+        with self.scheduler.executor(self.load_search_worker,
+                                     (self.vector_length, self.predicate_scheme, self.group_name, matrix_str,
+                                      generator_bytes, self.public_parameters, packed_queries, stop_event,
+                                      store_descriptor, removed)) as executor:
+            future_list = self.scheduler.submit(executor, search_chunk, chunks, *chunk_args)
+            initial = self.search_many(queries, limit, record_ids=list(added)) if added else None
+            return self.collect_search_results(future_list, len(queries), limit, stop_event, initial)
+
+    def search(self, query, limit=None, first_match=False):
+        """
+        Returns the indices of the records matching query. With limit the scan
+        stops at the first limit matches, with first_match at the first one.
+        """
+        return self.search_many([query], 1 if first_match else limit)[0]
+
+    @metrics.timed("search_many")
+    def search_many(self, queries, limit=None, stop_event=None, record_ids=None):
+        """
+        Runs several queries from generate_query in a single pass over the
+        encrypted database: each ciphertext is prepared once and tested against
+        every pending query. Returns one list of matching indices per query.
+        With limit, a query is dropped once it has limit matches and the scan
+        ends when no query is left. The scan also ends when stop_event is set,
+        which is checked every STOP_CHECK_INTERVAL records. record_ids limits
+        the scan to the given records.
+        """
+        result_lists = [[] for query in queries]
+        prepared_queries = [[self.predinstance.prepare_token(subquery) for subquery in query]
+                            for query in queries]
+        pending = list(range(len(queries)))
+        scanned = 0
+        for x in (record_ids if record_ids is not None else self.enc_data):
+            if stop_event is not None and scanned % STOP_CHECK_INTERVAL == 0 and stop_event.is_set():
+                break
+            scanned = scanned + 1
+            ct = self.predinstance.prepare_ciphertext(self.enc_data[x])
+            matched = False
+            for j in pending:
+                for subquery in prepared_queries[j]:
+                    if self.predinstance.decrypt_prepared(ct, subquery):
+                        result_lists[j].append(int(x))
+                        matched = True
+                        break
+            if matched and limit is not None:
+                pending = [j for j in pending if len(result_lists[j]) < limit]
+                if not pending:
                     break
-            if index is not None:
-                result_list.append(index)
-        return result_list
-
-    @staticmethod
-    def get_ct_size(ct):
-        ct_sizeinbytes = 0
-        for elem in ct:
-            elem_sizeinbytes = 0
-            # extract integers from elem
-            str_rep = ''.join(filter(lambda c: c == ' ' or c.isdigit(), str(elem)))
-            delim_size = len(str(elem)) - len(str_rep)  # number of delimiter characters
-            elem_sizeinbytes += delim_size
-            L = [int(s) for s in str_rep.split()]
-            for x in L:
-                intsize = int(math.ceil(math.log2(x) / 8))
-                elem_sizeinbytes += intsize
-            ct_sizeinbytes += elem_sizeinbytes
-        return ct_sizeinbytes
+        return result_lists
+
+    @metrics.timed("batch_search")
+    def batch_search(self, query, block_size=64, exponent_bits=40, verify=False, aggregate_after=None):
+        """
+        Group-testing variant of search for galleries where matching records
+        come in runs, e.g. many enrollments of the same subject. For every
+        subquery the records are scanned in blocks of block_size. A block is
+        tested whole only after aggregate_after records (block_size if None) in
+        a row matched: its ciphertexts are combined with fresh random exponents
+        of exponent_bits bits and decrypted once. The aggregate passes when
+        every record in the block matches, and the block is then accepted with
+        a single decryption. Any other block falls back to search, one
+        decryption per record.
+
+        The pairing test can only confirm that a whole block matches. A block
+        with a few matches fails like a block with none, so sparse matches are
+        found record by record and cost what search costs, plus one decryption
+        per aggregate that fails. A lower aggregate_after tries aggregates
+        sooner, which saves more on dense runs and wastes more on sparse data.
+
+        A block of matching records always passes and every other block is
+        decided record by record, so no match is ever missed and
+        self.batch_false_negative_bound is 0. An aggregate holding a
+        non-matching record passes with probability at most 2^-exponent_bits,
+        and self.batch_false_positive_bound holds the union bound over the
+        aggregates tested. With verify, every record of a passing aggregate is
+        decrypted again, so the result is exactly the one of search and the
+        bound is 0, at the cost of the saving. self.batch_tests holds the number
+        of decryptions.
+        """
+        aggregate_after = block_size if aggregate_after is None else aggregate_after
+        self.batch_tests = 0
+        self.batch_aggregates = 0
+        matches = set()
+        for subquery in query:
+            subquery = self.predinstance.prepare_token(subquery)
+            remaining = [x for x in self.enc_data if x not in matches]
+            run = 0
+            for start in range(0, len(remaining), block_size):
+                block = remaining[start:start + block_size]
+                if run >= aggregate_after and len(block) > 1 and self.batch_test_block(block, subquery, exponent_bits):
+                    if not verify:
+                        matches.update(block)
+                        continue
+                for x in block:
+                    self.batch_tests = self.batch_tests + 1
+                    if self.predinstance.decrypt_prepared(self.prepared_ciphertext(x), subquery):
+                        matches.add(x)
+                        run = run + 1
+                    else:
+                        run = 0
+        self.batch_false_negative_bound = 0
+        self.batch_false_positive_bound = 0 if verify else self.batch_aggregates / 2 ** exponent_bits
+        return [int(x) for x in self.enc_data if x in matches]
+
+    def batch_test_block(self, block, subquery, exponent_bits):
+        self.batch_tests = self.batch_tests + 1
+        self.batch_aggregates = self.batch_aggregates + 1
+        # preparing the records builds their exponentiation tables if the index asks for them
+        for x in block:
+            self.prepared_ciphertext(x)
+        exponents = [secrets.randbelow(2 ** exponent_bits) + 1 for x in block]
+        ct = self.predinstance.prepare_ciphertext(
+            self.predinstance.aggregate_ciphertexts([self.enc_data[x] for x in block], exponents))
+        return self.predinstance.decrypt_prepared(ct, subquery)
+
+    def get_element_width(self):
+        """
+        Size in bytes of a ciphertext element as stored, the same for every
+        element, measured once on a sample element.
+        """
+        if self.ct_element_width is None:
+            self.ct_element_width = element_width(self.predinstance.group,
+                                                  self.predinstance.group.random(self.predinstance.ciphertext_group()))
+        return self.ct_element_width
+
+    def get_ct_size(self, ct=None):
+        """
+        Size in bytes of a ciphertext as stored, ct or any ciphertext of the
+        scheme, from its number of elements and the element width.
+        """
+        if ct is None:
+            return self.predinstance.ciphertext_length() * self.get_element_width()
+        return sum(ciphertext_shape(ct)[1]) * self.get_element_width()
+
+    def get_shard_sizes(self, shards=None):
+        """
+        Size in bytes of each [start, end) range of records of shards, the
+        shards of encrypt_dataset_parallel by default.
+        """
+        record_size = self.get_ct_size()
+        return [(end - start) * record_size for (start, end) in (self.shards if shards is None else shards)]
 
     def get_database_size(self):
-        if self.parallel is 0:
-            running_total = 0
-            for x in self.enc_data:
-                running_total += self.get_ct_size(self.enc_data[x])
-            return running_total
-        else:
-            return self.enc_data_size
+        return self.num_records * self.get_ct_size()
 
     def get_seckey_size(self):
         return self.predinstance.get_seckey_size()
@@ -0,0 +1,74 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Scheduling of the parallel encryption and search paths.
+
+Work is cut into chunks of chunk_size records, many more chunks than workers.
+All chunks are queued on one process pool and each worker takes the next chunk
+as soon as it is free, so a slow core or a run of expensive records holds up a
+single chunk instead of a fixed share of the whole job. Workers load the key
+once, in the pool initializer, so small chunks stay cheap.
+"""
+
+import concurrent.futures
+import sys, os
+from math import ceil
+
+# Path hack
+sys.path.insert(0, os.path.abspath('charm'))
+sys.path.insert(1, os.path.abspath('../charm'))
+
+from pathos.multiprocessing import cpu_count
+from pse import metrics
+
+DEFAULT_CHUNK_SIZE = 64
+
+
+def chunk_ranges(start, end, chunk_size):
+    """
+    Splits [start, end) into consecutive [start, end) ranges of chunk_size.
+    """
+    return [(i, min(i + chunk_size, end)) for i in range(start, end, chunk_size)]
+
+
+class ChunkScheduler():
+    def __init__(self, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Runs chunks on workers processes, cpu_count() by default. A chunk_size
+        of None gives every worker one equal contiguous share, which is how
+        work was split before chunking.
+        """
+        self.workers = workers if workers is not None else cpu_count()
+        self.chunk_size = chunk_size
+
+    def chunks(self, start, end):
+        if self.chunk_size is None:
+            chunk_size = max(1, ceil((end - start) / self.workers))
+        else:
+            chunk_size = self.chunk_size
+        return chunk_ranges(start, end, chunk_size)
+
+    def executor(self, initializer=None, initargs=()):
+        return concurrent.futures.ProcessPoolExecutor(self.workers, initializer=initializer, initargs=initargs)
+
+    def submit(self, executor, fn, chunks, *args):
+        """
+        Queues fn(start, end, *args) for every (start, end) chunk and returns
+        the futures, whose results go through metrics.unwrap. The pool hands
+        queued chunks out in order to whichever worker is free.
+        """
+        return [metrics.submit(executor, fn, start, end, *args) for (start, end) in chunks]
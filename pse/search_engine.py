@@ -0,0 +1,268 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Long-lived search engine for the Ahmad et al. Proximity Search Scheme.
+
+The engine starts one worker process per shard of the encrypted database. Each
+worker deserializes the secret key and its shard of ciphertexts once, when it
+starts, and keeps them in memory. A query then only ships the serialized token.
+With shared_memory, the ciphertexts are instead placed once in a shared memory
+segment that every worker maps, and each worker decodes its records from there.
+A database opened from a store file is mapped by the workers in the same way.
+"""
+
+import concurrent.futures
+import sys, os, multiprocessing
+from math import ceil
+
+# Path hack
+sys.path.insert(0, os.path.abspath('charm'))
+sys.path.insert(1, os.path.abspath('../charm'))
+
+from pse.prox_search import ProximitySearch
+from pse import metrics
+from pse.ctstore import SharedCiphertextStore, attach_store, read_store_file, pack_records, unpack_records, \
+    pack_tokens, unpack_tokens
+
+# State resident in each worker process, set once by load_shard
+_worker_scheme = None
+_worker_stop_event = None
+
+
+def load_shard(n, predicate_scheme, group_name, matrix_str, generator_bytes, pp, start_index, end_index,
+               packed_shard=None, store_descriptor=None, packed_added=None, removed=(), stop_event=None,
+               shard_files=None):
+    """
+    Worker initializer. Rebuilds the search scheme from the serialized key and
+    loads the shard of records [start_index, end_index): from packed_shard,
+    packed by pack_records, if given, else from those slots of the shared
+    store of store_descriptor, else from shard_files, the (start, path) pairs
+    of the files written by ProximitySearch.encrypt_dataset_parallel. The
+    records added and removed since the store was written, packed_added and
+    removed, are applied on top, see ProximitySearch.store_changes. stop_event
+    is the engine's event for ending limited searches early.
+    """
+    global _worker_scheme, _worker_stop_event
+    prox_scheme = ProximitySearch(n, predicate_scheme, group_name)
+    prox_scheme.deserialize_key(matrix_str, generator_bytes)
+    prox_scheme.public_parameters = pp
+    if store_descriptor is not None:
+        # keep the attached store referenced for as long as the worker lives
+        prox_scheme.shared_store = attach_store(prox_scheme.predinstance.group, store_descriptor)
+        prox_scheme.enc_data = prox_scheme.shared_store.view(start_index, end_index)
+        prox_scheme.apply_store_changes(packed_added, removed)
+    elif packed_shard is None:
+        prox_scheme.enc_data = {}
+        for (shard_start, path) in shard_files:
+            shard = read_store_file(path, prox_scheme.predinstance.group)
+            # shard files are indexed from zero, key the records by their global index
+            prox_scheme.enc_data.update({x + shard_start: shard[x] for x in shard})
+    else:
+        prox_scheme.enc_data = dict(unpack_records(prox_scheme.predinstance.group, packed_shard, False).items())
+    prox_scheme.num_records = len(prox_scheme.enc_data)
+    _worker_scheme = prox_scheme
+    _worker_stop_event = stop_event
+
+
+def shard_size():
+    return len(_worker_scheme.enc_data)
+
+
+def add_to_shard(packed_records):
+    _worker_scheme.insert_ciphertexts(dict(unpack_records(_worker_scheme.predinstance.group, packed_records,
+                                                          False).items()))
+    return len(_worker_scheme.enc_data)
+
+
+def remove_from_shard(record_ids):
+    _worker_scheme.remove_records(record_ids)
+    return len(_worker_scheme.enc_data)
+
+
+def search_shard(packed_tokens, limit=None):
+    tokens = unpack_tokens(_worker_scheme.predinstance.group, packed_tokens)
+    return _worker_scheme.search_many(tokens, limit, _worker_stop_event if limit is not None else None)
+
+
+class ProximitySearchEngine():
+    def __init__(self, prox_scheme, processes=None, shared_memory=False):
+        """
+        Wraps a keyed ProximitySearch whose database has been encrypted, either
+        in memory with encrypt_dataset or to shard files with
+        encrypt_dataset_parallel. The database is split into processes shards,
+        by default as many as prox_scheme's scheduler has workers. In memory it
+        is cut into equal ranges of records, shard files are handed out to the
+        workers in contiguous runs. With shared_memory, the database is copied
+        into a shared segment owned by the engine and split into ranges of
+        slots. The same is done, without a copy, when prox_scheme already has a
+        store from share_encrypted_data or open_encrypted_data.
+        """
+        self.prox_scheme = prox_scheme
+        self.group = prox_scheme.predinstance.group
+        self.processes = processes
+        self.shared_memory = shared_memory
+        self.store = None
+        self.owns_store = False
+        self.executors = []
+        self.shard_sizes = []
+        self.stop_event = None
+
+    def uses_store(self):
+        return self.shared_memory or self.prox_scheme.shared_store is not None
+
+    def shard_ranges(self):
+        if self.uses_store():
+            processes = self.processes if self.processes is not None else self.prox_scheme.scheduler.workers
+            ranges = self.store.shard_ranges(processes) or [(0, 0)]
+            return [(start, end, None, None) for (start, end) in ranges]
+        if self.prox_scheme.enc_data:
+            processes = self.processes if self.processes is not None else self.prox_scheme.scheduler.workers
+            record_ids = sorted(self.prox_scheme.enc_data)
+            ranges = []
+            for j in range(processes):
+                start = ceil(j * len(record_ids) / processes)
+                end = min(ceil((j + 1) * len(record_ids) / processes), len(record_ids))
+                if start < end:
+                    ranges.append((start, end, record_ids[start:end], None))
+            return ranges
+        # encrypt_dataset_parallel writes one file per scheduler chunk, every worker loads a run of them
+        shards = [(start, end) for (start, end) in self.prox_scheme.shards if start < end]
+        processes = self.processes if self.processes is not None else self.prox_scheme.scheduler.workers
+        ranges = []
+        for j in range(processes):
+            run = shards[ceil(j * len(shards) / processes):ceil((j + 1) * len(shards) / processes)]
+            if run:
+                ranges.append((run[0][0], run[-1][1], None,
+                               [(start, self.prox_scheme.shard_path(start, end)) for (start, end) in run]))
+        return ranges
+
+    @metrics.timed("engine_start")
+    def start(self):
+        if self.executors:
+            return
+        prox_scheme = self.prox_scheme
+        store_descriptor = None
+        (added, removed) = ({}, [])
+        if self.uses_store():
+            if prox_scheme.shared_store is None:
+                self.store = SharedCiphertextStore.create(self.group, prox_scheme.gather_encrypted_data())
+                self.owns_store = True
+            else:
+                self.store = prox_scheme.shared_store
+                # records added to the store since it was written go to the last shard
+                (added, removed) = prox_scheme.store_changes()
+            store_descriptor = self.store.descriptor()
+        packed_added = pack_records(self.group, added) if added else None
+        (matrix_str, generator_bytes) = prox_scheme.serialize_key()
+        shard_ranges = self.shard_ranges()
+        self.stop_event = multiprocessing.Event()
+        for (start, end, record_ids, shard_files) in shard_ranges:
+            packed_shard = None
+            if record_ids is not None:
+                packed_shard = pack_records(self.group, {x: prox_scheme.enc_data[x] for x in record_ids})
+            executor = concurrent.futures.ProcessPoolExecutor(
+                1, initializer=load_shard,
+                initargs=(prox_scheme.vector_length, prox_scheme.predicate_scheme, prox_scheme.group_name,
+                          matrix_str, generator_bytes, prox_scheme.public_parameters, start, end, packed_shard,
+                          store_descriptor,
+                          packed_added if start == shard_ranges[-1][0] else None, removed, self.stop_event,
+                          shard_files))
+            self.executors.append(executor)
+        # workers are spawned lazily, wait for every shard to be resident before serving queries
+        self.shard_sizes = [future.result() for future in [executor.submit(shard_size)
+                                                           for executor in self.executors]]
+
+    def add_records(self, data_set, batch=False):
+        """
+        Adds records with ProximitySearch.add_records and ships their
+        ciphertexts to the worker holding the fewest records, so that running
+        workers serve them without being restarted. Returns the new ids.
+        """
+        record_ids = self.prox_scheme.add_records(data_set, batch)
+        self.ship_records(record_ids)
+        return record_ids
+
+    def insert_ciphertexts(self, cts):
+        """
+        Adds ciphertexts keyed by record id with
+        ProximitySearch.insert_ciphertexts and ships them as add_records does.
+        """
+        self.prox_scheme.insert_ciphertexts(cts)
+        self.ship_records(list(cts))
+
+    def ship_records(self, record_ids):
+        if self.executors and record_ids:
+            j = self.shard_sizes.index(min(self.shard_sizes))
+            packed_records = pack_records(self.group, {x: self.prox_scheme.enc_data[x] for x in record_ids})
+            self.shard_sizes[j] = self.executors[j].submit(add_to_shard, packed_records).result()
+
+    def remove_records(self, record_ids):
+        """
+        Removes records with ProximitySearch.remove_records and from every
+        running worker.
+        """
+        record_ids = list(record_ids)
+        self.prox_scheme.remove_records(record_ids)
+        futures = [executor.submit(remove_from_shard, record_ids) for executor in self.executors]
+        self.shard_sizes = [future.result() for future in futures]
+
+    def search(self, query, limit=None, first_match=False):
+        """
+        Runs the query tokens from ProximitySearch.generate_query against every
+        shard and returns the indices of the matching records. With limit, or
+        first_match for a limit of one, the shards stop once that many matches
+        are found in total.
+        """
+        return self.search_many([query], 1 if first_match else limit)[0]
+
+    def search_many(self, queries, limit=None):
+        """
+        Runs a batch of queries with one pass over every shard and returns one
+        list of matching indices per query, at most limit of them.
+        """
+        return self.search_packed(pack_tokens(self.group, queries), limit)
+
+    @metrics.timed("engine_search")
+    def search_packed(self, packed_tokens, limit=None):
+        """
+        search_many for queries already packed by ctstore.pack_tokens, which
+        go to the workers as they are.
+        """
+        if not self.executors:
+            self.start()
+        query_counts = packed_tokens[0]
+        self.stop_event.clear()
+        future_list = {metrics.submit(executor, search_shard, packed_tokens, limit) for executor in self.executors}
+        return ProximitySearch.collect_search_results(future_list, len(query_counts), limit, self.stop_event)
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown()
+        self.executors = []
+        self.shard_sizes = []
+        if self.owns_store:
+            self.store.close()
+            self.store.unlink()
+            self.owns_store = False
+        self.store = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,475 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Query service: a long-running daemon around a ProximitySearchEngine.
+
+The service keeps the key, the search engine and its shard workers resident
+and answers requests over a Unix or TCP socket. Every message is a frame
+
+    header length | body length | JSON header | body
+
+with both lengths as 4-byte little-endian integers. A request header has an
+"op" and an "id" that the response header repeats, so a client can have many
+requests in flight on one connection; a failed request gets an "error"
+instead of its result. The operations are
+
+    enroll  {"records": [vector, ...]}          -> {"ids": [...]}
+    remove  {"ids": [...]}                      -> {}
+    token   {"template": vector, "distance": t} -> packed query
+    search  packed queries, {"limit": limit}    -> {"matches": [[...], ...]}
+    info    {}                                  -> engine and service counters
+    load    {"start": start, "path": path}      -> {"records": count}
+    unload  {"start": start, "end": end}        -> {}
+    metrics {"format": "json" or "prometheus"}  -> {"metrics": snapshot} or {"text": exposition}
+
+Queries travel as packed by ctstore.pack_tokens: the header has the number of
+tokens of every query, the token shape, element tag and width, and the body
+the raw token elements, so a client holding the key can also pack its own.
+load and unload add and drop a shard, the records of a store file indexed from
+zero that are served as records start, start + 1, ...; they are how a
+coordinator places shards on search nodes, see pse.cluster.
+
+Searches are not run one by one. They wait in a queue and, whenever the engine
+is free, every queued query (up to max_batch) is merged into one packed batch
+and scanned in a single pass over the shards. The more requests arrive
+together, the more of them share a scan. At most max_pending requests are
+accepted at a time; beyond that the service stops reading from its
+connections, so clients are slowed down by the socket instead of the queue
+growing without bound.
+
+The protocol has no authentication: listen on a Unix socket, or on a trusted
+interface only.
+"""
+
+import asyncio, concurrent.futures
+import sys, os, json, struct, argparse
+
+# Path hack
+sys.path.insert(0, os.path.abspath('charm'))
+sys.path.insert(1, os.path.abspath('../charm'))
+
+from pse.search_engine import ProximitySearchEngine
+from pse import metrics
+from pse.ctstore import pack_tokens, merge_packed_tokens, read_store_file
+
+# header length, body length
+FRAME_HEADER = struct.Struct("<II")
+MAX_FRAME_SIZE = 1 << 30
+
+DEFAULT_MAX_BATCH = 64
+DEFAULT_MAX_PENDING = 1024
+DEFAULT_BATCH_DELAY = 0.0
+
+
+async def read_frame(reader):
+    (header_length, body_length) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if header_length + body_length > MAX_FRAME_SIZE:
+        raise ValueError("ERROR: Frame too large")
+    header = json.loads(await reader.readexactly(header_length))
+    body = await reader.readexactly(body_length) if body_length else b""
+    return header, body
+
+
+def encode_frame(header, body=b""):
+    header_bytes = json.dumps(header).encode()
+    return FRAME_HEADER.pack(len(header_bytes), len(body)) + header_bytes + body
+
+
+def encode_query(packed_queries):
+    """
+    Returns (header fields, body) for queries packed by pack_tokens.
+    """
+    (counts, (shape, tag, width, record_ids, data)) = packed_queries
+    return {"counts": counts, "shape": [shape[0], shape[1]], "tag": tag.decode(), "width": width}, data
+
+
+def decode_query(header, body):
+    """
+    Returns the pack_tokens form of the queries sent with encode_query.
+    """
+    counts = [int(c) for c in header["counts"]]
+    shape = (bool(header["shape"][0]), [int(l) for l in header["shape"][1]])
+    width = int(header["width"])
+    if any(c <= 0 for c in counts) or len(body) != sum(counts) * sum(shape[1]) * width:
+        raise ValueError("ERROR: Malformed query")
+    return (counts, (shape, header["tag"].encode(), width, list(range(sum(counts))), body))
+
+
+class QueryService():
+    def __init__(self, prox_scheme, processes=None, shared_memory=False, max_batch=DEFAULT_MAX_BATCH,
+                 max_pending=DEFAULT_MAX_PENDING, batch_delay=DEFAULT_BATCH_DELAY):
+        """
+        Serves prox_scheme, a keyed ProximitySearch with an encrypted
+        database, through a ProximitySearchEngine started with processes and
+        shared_memory. A scan takes up to max_batch queued queries, after
+        waiting batch_delay seconds for more to arrive; max_pending bounds the
+        requests being served at once.
+        """
+        self.prox_scheme = prox_scheme
+        self.engine = ProximitySearchEngine(prox_scheme, processes, shared_memory)
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.batch_delay = batch_delay
+        # the engine and the scheme are used from this one thread only
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.queue = None
+        self.slots = None
+        self.batcher = None
+        self.query_format = None
+        self.servers = []
+        self.connections = set()
+        self.requests = 0
+        self.scans = 0
+        self.scanned_queries = 0
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def start(self):
+        if self.batcher is not None:
+            return
+        await self.run(self.engine.start)
+        self.query_format = await self.run(self.token_format)
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.max_pending)
+        self.batcher = asyncio.ensure_future(self.run_batches())
+
+    async def listen_unix(self, path):
+        await self.start()
+        if os.path.exists(path):
+            os.remove(path)
+        self.servers.append(await asyncio.start_unix_server(self.handle_connection, path))
+
+    async def listen_tcp(self, host, port):
+        """
+        Listens on host and port and returns the port, which is chosen by the
+        system when port is 0.
+        """
+        await self.start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        self.servers.append(server)
+        return server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        await asyncio.gather(*[server.serve_forever() for server in self.servers])
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers = []
+        for writer in list(self.connections):
+            writer.close()
+        if self.batcher is not None:
+            self.batcher.cancel()
+            self.batcher = None
+        await self.run(self.engine.close)
+        self.executor.shutdown()
+
+    async def handle_connection(self, reader, writer):
+        self.connections.add(writer)
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    (header, body) = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                # stop reading, and so push back on the client, while max_pending requests are being served
+                await self.slots.acquire()
+                task = asyncio.ensure_future(self.serve_request(header, body, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except ValueError:
+            pass
+        finally:
+            for task in list(tasks):
+                task.cancel()
+            self.connections.discard(writer)
+            writer.close()
+
+    async def serve_request(self, header, body, writer, write_lock):
+        self.requests = self.requests + 1
+        try:
+            (result, result_body) = await self.dispatch(header, body)
+        except Exception as e:
+            (result, result_body) = ({"error": str(e) or type(e).__name__}, b"")
+        finally:
+            self.slots.release()
+        result["id"] = header.get("id") if isinstance(header, dict) else None
+        async with write_lock:
+            try:
+                writer.write(encode_frame(result, result_body))
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def dispatch(self, header, body):
+        op = header["op"]
+        if op == "search":
+            limit = header.get("limit")
+            packed = decode_query(header, body)
+            # a query the engine cannot scan is refused here, merged into a batch it would fail every request in it
+            if packed[0] and packed[1][:3] != self.query_format:
+                raise ValueError("ERROR: Query tokens do not match the key of the service")
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((packed, None if limit is None else int(limit), future))
+            return {"matches": await future}, b""
+        if op == "token":
+            query = await self.run(self.prox_scheme.generate_query, header["template"], int(header["distance"]))
+            (fields, data) = encode_query(pack_tokens(self.engine.group, [query]))
+            return fields, data
+        if op == "enroll":
+            return {"ids": await self.run(self.engine.add_records, header["records"], True)}, b""
+        if op == "remove":
+            await self.run(self.engine.remove_records, [int(x) for x in header["ids"]])
+            return {}, b""
+        if op == "load":
+            return {"records": await self.run(self.load_shard, int(header["start"]), header["path"])}, b""
+        if op == "unload":
+            await self.run(self.engine.remove_records, range(int(header["start"]), int(header["end"])))
+            return {}, b""
+        if op == "metrics":
+            if header.get("format") == "prometheus":
+                return {"text": metrics.to_prometheus()}, b""
+            return {"metrics": metrics.snapshot()}, b""
+        if op == "info":
+            return {"records": self.prox_scheme.num_records, "shards": self.engine.shard_sizes,
+                    "requests": self.requests, "scans": self.scans, "scanned_queries": self.scanned_queries,
+                    "queued": self.queue.qsize()}, b""
+        raise ValueError("ERROR: Unknown operation " + str(op))
+
+    def token_format(self):
+        """
+        Returns the shape, element tag and width of the tokens of the key,
+        which every query sent to search must have.
+        """
+        query = self.prox_scheme.generate_query([0] * self.prox_scheme.vector_length, 0)
+        (shape, tag, width, record_ids, data) = pack_tokens(self.engine.group, [query])[1]
+        return (shape, tag, width)
+
+    def load_shard(self, start, path):
+        """
+        Adds the records of the store file path, keyed from start, and
+        returns how many there were.
+        """
+        shard = read_store_file(path, self.engine.group)
+        self.engine.insert_ciphertexts({start + x: shard[x] for x in shard})
+        return len(shard)
+
+    async def run_batches(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.batch_delay:
+                await asyncio.sleep(self.batch_delay)
+            num_queries = len(batch[0][0][0])
+            while not self.queue.empty() and num_queries < self.max_batch:
+                batch.append(self.queue.get_nowait())
+                num_queries = num_queries + len(batch[-1][0][0])
+            await self.scan(batch)
+
+    async def scan(self, batch):
+        """
+        Answers the search requests of batch with one engine scan. Requests
+        with different limits are scanned without a limit and cut afterwards.
+        """
+        limits = set(limit for (packed, limit, future) in batch)
+        limit = limits.pop() if len(limits) == 1 else None
+        try:
+            packed = merge_packed_tokens([packed for (packed, request_limit, future) in batch])
+            results = await self.run(self.engine.search_packed, packed, limit)
+        except Exception as e:
+            for (packed, request_limit, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.scans = self.scans + 1
+        self.scanned_queries = self.scanned_queries + len(results)
+        start = 0
+        for (packed, request_limit, future) in batch:
+            matches = results[start:start + len(packed[0])]
+            start = start + len(packed[0])
+            if not future.done():
+                future.set_result([m if request_limit is None else m[:request_limit] for m in matches])
+
+
+class ServiceClient():
+    def __init__(self, reader, writer):
+        """
+        A connection to a QueryService; open one with connect_unix or
+        connect_tcp. Requests may be issued concurrently from several tasks,
+        they share the connection.
+        """
+        self.reader = reader
+        self.writer = writer
+        self.next_id = 0
+        self.pending = {}
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    @classmethod
+    async def connect_unix(cls, path):
+        (reader, writer) = await asyncio.open_unix_connection(path)
+        return cls(reader, writer)
+
+    @classmethod
+    async def connect_tcp(cls, host, port):
+        (reader, writer) = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def receive(self):
+        try:
+            while True:
+                (header, body) = await read_frame(self.reader)
+                future = self.pending.pop(header.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result((header, body))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            error = ConnectionError("Connection to the query service closed")
+        except Exception as e:
+            error = e
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending = {}
+
+    async def request(self, header, body=b""):
+        if self.receiver.done():
+            raise ConnectionError("Connection to the query service closed")
+        header["id"] = self.next_id
+        self.next_id = self.next_id + 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[header["id"]] = future
+        self.writer.write(encode_frame(header, body))
+        await self.writer.drain()
+        (result, result_body) = await future
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        return result, result_body
+
+    async def enroll(self, records):
+        """
+        Encrypts and adds records, returns their ids.
+        """
+        (result, body) = await self.request({"op": "enroll", "records": [list(r) for r in records]})
+        return result["ids"]
+
+    async def remove(self, record_ids):
+        await self.request({"op": "remove", "ids": list(record_ids)})
+
+    async def generate_query(self, template, distance):
+        """
+        Returns the query for template and distance, packed as by
+        ctstore.pack_tokens, to be passed to search.
+        """
+        (result, body) = await self.request({"op": "token", "template": list(template), "distance": distance})
+        return decode_query(result, body)
+
+    async def search(self, packed_queries, limit=None):
+        """
+        Returns one list of matching record ids per query of packed_queries,
+        from generate_query or ctstore.pack_tokens.
+        """
+        (fields, data) = encode_query(packed_queries)
+        fields["op"] = "search"
+        fields["limit"] = limit
+        (result, body) = await self.request(fields, data)
+        return result["matches"]
+
+    async def load_shard(self, start, path):
+        """
+        Has the service serve the records of the store file path, which it
+        must be able to read, as records start, start + 1, ...
+        """
+        (result, body) = await self.request({"op": "load", "start": start, "path": path})
+        return result["records"]
+
+    async def unload_shard(self, start, end):
+        await self.request({"op": "unload", "start": start, "end": end})
+
+    async def metrics(self, prometheus=False):
+        """
+        Returns the service's metrics snapshot, or its Prometheus text with
+        prometheus. They stay empty unless the service runs with metrics
+        enabled.
+        """
+        (result, body) = await self.request({"op": "metrics", "format": "prometheus" if prometheus else "json"})
+        return result["text"] if prometheus else result["metrics"]
+
+    async def info(self):
+        (result, body) = await self.request({"op": "info"})
+        del result["id"]
+        return result
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        self.receiver.cancel()
+
+
+async def serve(prox_scheme, unix_path=None, host=None, port=0, processes=None, shared_memory=False,
+                max_batch=DEFAULT_MAX_BATCH, max_pending=DEFAULT_MAX_PENDING, batch_delay=DEFAULT_BATCH_DELAY):
+    service = QueryService(prox_scheme, processes, shared_memory, max_batch, max_pending, batch_delay)
+    if unix_path is not None:
+        await service.listen_unix(unix_path)
+    if host is not None:
+        print("Listening on " + host + ":" + str(await service.listen_tcp(host, port)), flush=True)
+    try:
+        await service.serve_forever()
+    finally:
+        await service.close()
+
+
+if __name__ == "__main__":
+    from pse import predipe, multibasispredipe
+    from pse.prox_search import ProximitySearch
+
+    parser = argparse.ArgumentParser(description='Serve searches over an encrypted database.')
+    parser.add_argument('--vector_length', '-v', type=int, required=True, help='Length of the records')
+    parser.add_argument('--multi_basis', '-mb', action='store_true', help='Use MultiBasesPredScheme')
+    parser.add_argument('--group', '-g', default='MNT159', help='Pairing group of the key')
+    parser.add_argument('--matrix_file', '-mf', required=True, help='The file for the matrices')
+    parser.add_argument('--generator_file', '-gf', required=True, help='The file for the group generators')
+    parser.add_argument('--store', '-st', default=None,
+                        help='Store file from save_encrypted_data, a search node starts empty without it')
+    parser.add_argument('--unix', '-u', default=None, help='Path of the Unix socket to listen on')
+    parser.add_argument('--host', default=None, help='Address to listen on for TCP')
+    parser.add_argument('--port', type=int, default=0, help='TCP port, chosen by the system by default')
+    parser.add_argument('--processes', '-np', type=int, default=None,
+                        help='Number of shard workers, default cpu_count()')
+    parser.add_argument('--max_batch', type=int, default=DEFAULT_MAX_BATCH, help='Queries per scan')
+    parser.add_argument('--max_pending', type=int, default=DEFAULT_MAX_PENDING, help='Requests served at once')
+    parser.add_argument('--batch_delay', type=float, default=DEFAULT_BATCH_DELAY,
+                        help='Seconds to wait for more queries before a scan')
+    parser.add_argument('--metrics', action='store_true', help='Collect metrics, see pse.metrics')
+    args = parser.parse_args()
+    if args.unix is None and args.host is None:
+        parser.error("one of --unix and --host is required")
+
+    metrics.enable(args.metrics)
+    scheme = multibasispredipe.MultiBasesPredScheme if args.multi_basis else predipe.BarbosaIPEScheme
+    database = ProximitySearch(args.vector_length, scheme, args.group)
+    database.read_key_from_file(args.matrix_file, args.generator_file)
+    if args.store is not None:
+        database.open_encrypted_data(args.store)
+    else:
+        database.enc_data = {}
+    asyncio.run(serve(database, args.unix, args.host, args.port, args.processes, False, args.max_batch,
+                      args.max_pending, args.batch_delay))
@@ -0,0 +1,60 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Checks batch_search against search on sparse and dense match sets.
+"""
+
+import sys, os, random, argparse
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from pse import predipe, prox_search, multibasispredipe
+from pse.groups import SIMULATED_GROUP
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Test of the group-testing batch search.')
+    parser.add_argument('--vector_length', '-v', type=int, default=16, help='Length of the records')
+    parser.add_argument('--records', '-r', type=int, default=96, help='Number of records')
+    parser.add_argument('--group', '-g', default=SIMULATED_GROUP, help='Pairing group')
+    args = vars(parser.parse_args())
+
+    vector_length = args['vector_length']
+    num_records = args['records']
+    random.seed(0)
+    for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+        database = prox_search.ProximitySearch(vector_length, ipescheme, args['group'])
+        database.generate_keys()
+        templates = [[random.randint(0, 1) for j in range(vector_length)] for i in range(num_records)]
+        for num_matches in [1, 3, num_records // 2, num_records - 4]:
+            print("Testing " + ipescheme.__name__ + " batch search with " + str(num_matches) + " matches")
+            # the enrollments of the queried template come first and in a run
+            database.encrypt_dataset([templates[0]] * num_matches + templates[num_matches:])
+            for t in [0, 2]:
+                query = database.generate_query(templates[0], t)
+                expected = database.search(query)
+                assert(database.batch_search(query, 8) == expected)
+                assert(database.batch_false_negative_bound == 0)
+                if num_matches < 8:
+                    # no run long enough to aggregate, the scan is the one of search
+                    assert(database.batch_aggregates == 0)
+                elif t == 0:
+                    assert(database.batch_aggregates > 0 and database.batch_tests < num_records)
+                    assert(0 < database.batch_false_positive_bound <= database.batch_aggregates / 2 ** 40)
+                assert(database.batch_search(query, 8, verify=True) == expected)
+                assert(database.batch_false_positive_bound == 0)
+                assert(database.batch_search(query, 8, aggregate_after=2) == expected)
+    print("All batch search tests passed")
@@ -0,0 +1,29 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Benchmark suite of the proximity search on synthetic data.
+
+cases times setup, key generation, key save and load, encryption, token
+generation and serial and parallel search, and measures key, ciphertext, token
+and database sizes, over every combination of the vector lengths n, numbers of
+bases sigma, distances t, numbers of records N and worker counts asked for.
+results writes them as JSON next to the environment they ran in and compares
+them with a baseline. Run it from the repository root:
+
+    python3 -m tests.bench -v 64 256 -r 100 1000 -t 0 8 -np 1 4 -o results.json
+    python3 -m tests.bench -v 64 256 -r 100 1000 -t 0 8 -np 1 4 -b baseline.json --threshold 0.1
+"""
@@ -0,0 +1,115 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Runs the benchmark suite, writes its results and compares them with a
+baseline. Exits with status 1 when a result regressed by more than the
+threshold.
+"""
+
+import sys, os, shutil, argparse, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from pse.scheduler import DEFAULT_CHUNK_SIZE
+from tests.bench import cases, results, environment
+
+
+def report(result):
+    print(results.describe(result) + ", " + result["unit"] + ", " + str(result["value"]), flush=True)
+
+
+def compare_runs(run, baseline, threshold, statistic):
+    """
+    Prints the comparison of run with baseline, two results files, and
+    returns the regressions.
+    """
+    for (field, before, after) in environment.differences(run["environment"], baseline["environment"]):
+        print("Warning: baseline ran with " + field + " " + str(before) + ", this run with " + str(after))
+    comparisons = results.compare(run["results"], baseline["results"], threshold, statistic)
+    print(results.format_comparison(comparisons, statistic))
+    regressed = results.regressions(comparisons)
+    print(str(len(regressed)) + " regressions above " + str(100 * threshold) + "% in " + str(len(comparisons)) +
+          " benchmarks")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark suite of the proximity search on synthetic data.')
+    parser.add_argument('--vector_lengths', '-v', type=int, nargs='+', default=[64],
+                        help='Vector lengths n')
+    parser.add_argument('--bases', '-sb', type=int, nargs='+', default=[1],
+                        help='Numbers of bases sigma, with --multi_basis')
+    parser.add_argument('--distances', '-t', type=int, nargs='+', default=[0],
+                        help='Query distances t')
+    parser.add_argument('--records', '-r', type=int, nargs='+', default=[100],
+                        help='Numbers of records N')
+    parser.add_argument('--workers', '-np', type=int, nargs='+', default=[None],
+                        help='Worker counts of the parallel cases, default cpu_count()')
+    parser.add_argument('--chunk_size', '-cs', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Chunk size of the parallel cases')
+    parser.add_argument('--iterations', '-i', type=int, default=3,
+                        help='Repetitions of every timing')
+    parser.add_argument('--queries', '-q', type=int, default=5,
+                        help='Queries per token and search timing')
+    parser.add_argument('--group', '-g', default='MNT159',
+                        help='Pairing group, SIMULATED for a quick run')
+    parser.add_argument('--multi_basis', '-mb', action='store_true',
+                        help='Use MultiBasesPredScheme')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the synthetic records and queries')
+    parser.add_argument('--cases', '-c', nargs='+', choices=cases.CASES, default=cases.CASES,
+                        help='Cases to run, all by default')
+    parser.add_argument('--output', '-o', default='bench_results.json',
+                        help='File the results are written to')
+    parser.add_argument('--baseline', '-b', default=None,
+                        help='Results file to compare with')
+    parser.add_argument('--threshold', type=float, default=results.DEFAULT_THRESHOLD,
+                        help='Relative increase over the baseline counted as a regression')
+    parser.add_argument('--statistic', choices=['value', 'min', 'mean'], default='value',
+                        help='Statistic of the timings compared, value being the median')
+    parser.add_argument('--compare', default=None,
+                        help='Compare this results file with the baseline instead of running the suite')
+    parser.add_argument('--work_dir', '-wd', default=None,
+                        help='Directory for key and shard files, a temporary one by default')
+    args = vars(parser.parse_args())
+    if len(args['bases']) > 1 or args['bases'][0] != 1:
+        assert(args['multi_basis']), "ERROR: Numbers of bases need --multi_basis"
+
+    baseline = results.read_results(args['baseline']) if args['baseline'] is not None else None
+    if args['compare'] is not None:
+        assert(baseline is not None), "ERROR: --compare needs a --baseline"
+        run = results.read_results(args['compare'])
+    else:
+        configuration = {name: args[name] for name in ['vector_lengths', 'bases', 'distances', 'records', 'workers',
+                                                        'chunk_size', 'iterations', 'queries', 'group', 'multi_basis',
+                                                        'seed', 'cases']}
+        output = os.path.abspath(args['output'])
+        work_dir = args['work_dir'] if args['work_dir'] is not None else tempfile.mkdtemp()
+        current_dir = os.getcwd()
+        os.chdir(work_dir)
+        print("Benchmark, Unit, Value")
+        try:
+            run = {"environment": environment.environment(), "configuration": configuration,
+                   "results": cases.run_cases(configuration, args['cases'], report)}
+        finally:
+            os.chdir(current_dir)
+            if args['work_dir'] is None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        results.write_results(output, run["environment"], configuration, run["results"])
+        print("Results written to " + output)
+
+    if baseline is not None and compare_runs(run, baseline, args['threshold'], args['statistic']):
+        sys.exit(1)
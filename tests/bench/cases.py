@@ -0,0 +1,182 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+The benchmark cases. Every case is timed iterations times and gives one
+result per combination of the parameters it depends on:
+
+    setup             n, sigma                 ProximitySearch construction
+    keygen            n, sigma                 generate_keys
+    key_save          n, sigma                 write_key_to_file
+    key_load          n, sigma                 read_key_from_file
+    token             n, sigma, t              generate_query, per query
+    encrypt           n, sigma, N              encrypt_dataset
+    search            n, sigma, t, N           search, per query
+    parallel_encrypt  n, sigma, N, workers     encrypt_dataset_parallel
+    parallel_search   n, sigma, t, N, workers  parallel_search, per query
+
+The sizes case gives seckey_size and ciphertext_size for n and sigma,
+query_size, the t + 1 tokens of a query as packed for the workers, for t too
+and database_size for N too, in bytes.
+
+Records are random binary vectors from a seeded generator, so that two runs
+with the same seed encrypt the same data, and every query is a record with t
+bits flipped, so that searches have matches to return.
+"""
+
+import os, random, time
+
+from pse import predipe, multibasispredipe, prox_search
+from pse.ctstore import pack_tokens
+from tests.bench.results import timing, size
+
+CASES = ['setup', 'keygen', 'key_save', 'key_load', 'token', 'encrypt', 'search', 'parallel_encrypt',
+         'parallel_search', 'sizes']
+
+
+def time_calls(run, iterations):
+    samples = []
+    for i in range(iterations):
+        run_a = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - run_a)
+    return samples
+
+
+def synthetic_records(generator, num_records, n):
+    return [[generator.randint(0, 1) for j in range(n)] for i in range(num_records)]
+
+
+def synthetic_query(generator, record, t):
+    query = list(record)
+    for j in generator.sample(range(len(query)), min(t, len(query))):
+        query[j] = 1 - query[j]
+    return query
+
+
+def sample_queries(generator, records, count, t):
+    return [synthetic_query(generator, records[generator.randrange(len(records))], t) for i in range(count)]
+
+
+def new_database(scheme, n, sigma, group_name):
+    database = prox_search.ProximitySearch(n, scheme, group_name)
+    if scheme is multibasispredipe.MultiBasesPredScheme:
+        database.predinstance.set_number_bases(sigma)
+    return database
+
+
+def query_size(database, query):
+    (counts, (shape, tag, width, record_ids, data)) = pack_tokens(database.predinstance.group, [query])
+    return len(data)
+
+
+def run_cases(configuration, cases=CASES, report=None):
+    """
+    Runs cases over the parameters of configuration, a dict with the lists
+    vector_lengths (n), bases (sigma, with multi_basis only), distances (t),
+    records (N) and workers, and iterations, queries, group, multi_basis,
+    chunk_size and seed. Key and shard files are written to the working directory. Returns
+    the list of results, each also passed to report as it comes.
+    """
+    scheme = multibasispredipe.MultiBasesPredScheme if configuration['multi_basis'] else predipe.BarbosaIPEScheme
+    bases = configuration['bases'] if configuration['multi_basis'] else [1]
+    iterations = configuration['iterations']
+    group_name = configuration['group']
+    generator = random.Random(configuration['seed'])
+    results = []
+
+    def add(result):
+        results.append(result)
+        if report is not None:
+            report(result)
+
+    for n in configuration['vector_lengths']:
+        for sigma in bases:
+            params = {"scheme": scheme.__name__, "group": group_name, "n": n, "sigma": sigma}
+            if 'setup' in cases:
+                add(timing('setup', params, time_calls(lambda: new_database(scheme, n, sigma, group_name),
+                                                       iterations)))
+            database = new_database(scheme, n, sigma, group_name)
+            keygen_samples = time_calls(database.generate_keys, iterations)
+            if 'keygen' in cases:
+                add(timing('keygen', params, keygen_samples))
+            (matrix_file, generator_file) = ("bench.matrices", "bench.generators")
+            if 'key_save' in cases:
+                add(timing('key_save', params,
+                           time_calls(lambda: database.write_key_to_file(matrix_file, generator_file), iterations)))
+            if 'key_load' in cases:
+                database.write_key_to_file(matrix_file, generator_file)
+                loaded = new_database(scheme, n, sigma, group_name)
+                add(timing('key_load', params,
+                           time_calls(lambda: loaded.read_key_from_file(matrix_file, generator_file), iterations)))
+            if 'sizes' in cases:
+                add(size('seckey_size', params, database.get_seckey_size()))
+                add(size('ciphertext_size', params, database.get_ct_size()))
+            for path in [matrix_file, generator_file]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+            for t in configuration['distances']:
+                query_params = dict(params, t=t)
+                queries = sample_queries(generator, synthetic_records(generator, configuration['queries'], n),
+                                         configuration['queries'], t)
+                if 'token' in cases:
+                    token_samples = []
+                    for i in range(iterations):
+                        for query in queries:
+                            token_samples += time_calls(lambda: database.generate_query(query, t), 1)
+                    add(timing('token', query_params, token_samples))
+                if 'sizes' in cases:
+                    add(size('query_size', query_params, query_size(database, database.generate_query(queries[0], t))))
+
+            for num_records in configuration['records']:
+                records = synthetic_records(generator, num_records, n)
+                tokens = {t: [database.generate_query(query, t) for query in
+                              sample_queries(generator, records, configuration['queries'], t)]
+                          for t in configuration['distances']}
+
+                record_params = dict(params, N=num_records)
+                if 'encrypt' in cases or 'search' in cases or 'sizes' in cases:
+                    encrypt_samples = time_calls(lambda: database.encrypt_dataset(records), iterations)
+                    if 'encrypt' in cases:
+                        add(timing('encrypt', record_params, encrypt_samples))
+                if 'sizes' in cases:
+                    add(size('database_size', record_params, database.get_database_size()))
+                if 'search' in cases:
+                    for t in configuration['distances']:
+                        search_samples = []
+                        for i in range(iterations):
+                            for token in tokens[t]:
+                                search_samples += time_calls(lambda: database.search(token), 1)
+                        add(timing('search', dict(record_params, t=t), search_samples))
+
+                if 'parallel_encrypt' not in cases and 'parallel_search' not in cases:
+                    continue
+                for workers in configuration['workers']:
+                    database.set_scheduler(workers, configuration['chunk_size'])
+                    worker_params = dict(record_params, workers=database.scheduler.workers)
+                    parallel_samples = time_calls(lambda: database.encrypt_dataset_parallel(records), iterations)
+                    if 'parallel_encrypt' in cases:
+                        add(timing('parallel_encrypt', worker_params, parallel_samples))
+                    if 'parallel_search' in cases:
+                        for t in configuration['distances']:
+                            search_samples = []
+                            for i in range(iterations):
+                                for token in tokens[t]:
+                                    search_samples += time_calls(lambda: database.parallel_search(token), 1)
+                            add(timing('parallel_search', dict(worker_params, t=t), search_samples))
+                    database.remove_shard_files()
+    return results
@@ -0,0 +1,83 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Description of the machine and the code a benchmark ran on, stored with its
+results so that a comparison can tell when two runs are not alike.
+"""
+
+import os, sys, platform, datetime, subprocess
+from importlib import metadata
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# fields that make timings of two runs incomparable when they differ
+COMPARABLE_FIELDS = ['machine', 'cpu_model', 'cpu_count', 'python_version', 'python_implementation']
+
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or None
+
+
+def git(*args):
+    try:
+        return subprocess.run(['git'] + list(args), cwd=REPO_ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def package_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def environment():
+    """
+    Returns the host, interpreter, library versions and git revision of this
+    run as a dict.
+    """
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {"timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "hostname": platform.node(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_model": cpu_model(),
+            "cpu_count": os.cpu_count(),
+            "python_version": platform.python_version(),
+            "python_implementation": platform.python_implementation(),
+            "executable": sys.executable,
+            "packages": {name: package_version(name) for name in ['charm-crypto', 'numpy', 'pathos', 'dill']},
+            "git_commit": git('rev-parse', 'HEAD'),
+            "git_dirty": bool(status) if status is not None else None}
+
+
+def differences(current, baseline):
+    """
+    Returns the COMPARABLE_FIELDS on which two environments differ, as
+    (field, baseline value, current value) triples.
+    """
+    return [(field, baseline.get(field), current.get(field)) for field in COMPARABLE_FIELDS
+            if current.get(field) != baseline.get(field)]
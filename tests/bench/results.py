@@ -0,0 +1,125 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Benchmark results, their JSON file and the comparison with a baseline.
+
+A result is a dict with the case, the params it ran with, a unit and a value:
+the median of its samples for a timing, the number of bytes for a size. A
+results file holds a list of them with the environment and the configuration
+of the run:
+
+    {"format": 1, "environment": {...}, "configuration": {...}, "results": [
+        {"case": "search", "unit": "seconds",
+         "params": {"scheme": "BarbosaIPEScheme", "group": "MNT159", "n": 64, "sigma": 1, "t": 0, "N": 100},
+         "value": 0.41, "mean": 0.42, "min": 0.40, "stdev": 0.01, "samples": [...]}, ...]}
+
+Results of two runs are matched on their case and params. A result whose
+value grew by more than the threshold, a fraction of the baseline value, is a
+regression.
+"""
+
+import json
+from statistics import mean, median, pstdev
+
+FORMAT_VERSION = 1
+DEFAULT_THRESHOLD = 0.1
+
+REGRESSION = 'regression'
+IMPROVEMENT = 'improvement'
+UNCHANGED = 'unchanged'
+NEW = 'new'
+MISSING = 'missing'
+
+
+def timing(case, params, samples):
+    return {"case": case, "params": dict(params), "unit": "seconds", "value": median(samples),
+            "mean": mean(samples), "min": min(samples), "stdev": pstdev(samples), "samples": samples}
+
+
+def size(case, params, num_bytes):
+    return {"case": case, "params": dict(params), "unit": "bytes", "value": num_bytes}
+
+
+def result_key(result):
+    return (result["case"], tuple(sorted(result["params"].items(), key=lambda item: item[0])))
+
+
+def describe(result):
+    return " ".join([result["case"]] + [name + "=" + str(value) for (name, value) in sorted(result["params"].items())])
+
+
+def write_results(filename, environment, configuration, results):
+    with open(filename, "w") as results_file:
+        json.dump({"format": FORMAT_VERSION, "environment": environment, "configuration": configuration,
+                   "results": results}, results_file, indent=1, sort_keys=True)
+
+
+def read_results(filename):
+    with open(filename) as results_file:
+        run = json.load(results_file)
+    if run.get("format") != FORMAT_VERSION:
+        raise ValueError("ERROR: " + filename + " is not a results file of format " + str(FORMAT_VERSION))
+    return run
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD, statistic="value"):
+    """
+    Matches results with the baseline results and returns one
+    (status, result, baseline result, change) tuple per case and params of
+    either, change being the relative change of statistic ("value", the
+    median, or "min" or "mean" for timings) or None when a side is missing.
+    """
+    def measure(result):
+        return result.get(statistic, result["value"])
+
+    baseline_results = {result_key(result): result for result in baseline}
+    comparisons = []
+    for result in results:
+        before = baseline_results.pop(result_key(result), None)
+        if before is None:
+            comparisons.append((NEW, result, None, None))
+            continue
+        (old, new) = (measure(before), measure(result))
+        change = (new - old) / old if old else (0.0 if new == old else float('inf'))
+        if change > threshold:
+            status = REGRESSION
+        elif change < -threshold:
+            status = IMPROVEMENT
+        else:
+            status = UNCHANGED
+        comparisons.append((status, result, before, change))
+    comparisons.extend((MISSING, None, before, None) for before in baseline_results.values())
+    return comparisons
+
+
+def regressions(comparisons):
+    return [comparison for comparison in comparisons if comparison[0] == REGRESSION]
+
+
+def format_comparison(comparisons, statistic="value"):
+    """
+    Returns the comparisons as CSV lines: status, case and params, unit,
+    baseline, current and change in percent.
+    """
+    lines = ["Status, Benchmark, Unit, Baseline, Current, Change %"]
+    for (status, result, before, change) in comparisons:
+        either = result if result is not None else before
+        lines.append(status + ", " + describe(either) + ", " + either["unit"] + ", " +
+                     (str(before.get(statistic, before["value"])) if before is not None else "") + ", " +
+                     (str(result.get(statistic, result["value"])) if result is not None else "") + ", " +
+                     ("%.1f" % (100 * change) if change is not None else ""))
+    return "\n".join(lines)
@@ -0,0 +1,77 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Checks the comparison of benchmark results with a baseline on hand-built
+results.
+"""
+
+import sys, os
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from tests.bench import results
+
+
+def statuses(comparisons):
+    return {results.describe(result if result is not None else before): status
+            for (status, result, before, change) in comparisons}
+
+
+if __name__ == "__main__":
+    params = {"scheme": "BarbosaIPEScheme", "n": 64, "N": 100}
+    baseline = [results.timing("search", params, [1.0, 1.0, 1.0]),
+                results.timing("keygen", params, [1.0, 1.0, 1.0]),
+                results.timing("encrypt", params, [1.0, 1.0, 1.0]),
+                results.size("database_size", params, 1000),
+                results.timing("load_key", params, [1.0])]
+    run = [results.timing("search", params, [1.0, 1.5, 1.5]),
+           results.timing("keygen", params, [0.5, 0.5, 0.5]),
+           results.timing("encrypt", params, [1.0, 1.05, 1.05]),
+           results.size("database_size", params, 1000),
+           results.timing("search", dict(params, N=1000), [10.0])]
+
+    print("Testing Comparison Statuses")
+    comparisons = results.compare(run, baseline)
+    assert(len(comparisons) == 6)
+    assert(statuses(comparisons) == {
+        "search N=100 n=64 scheme=BarbosaIPEScheme": results.REGRESSION,
+        "keygen N=100 n=64 scheme=BarbosaIPEScheme": results.IMPROVEMENT,
+        "encrypt N=100 n=64 scheme=BarbosaIPEScheme": results.UNCHANGED,
+        "database_size N=100 n=64 scheme=BarbosaIPEScheme": results.UNCHANGED,
+        "search N=1000 n=64 scheme=BarbosaIPEScheme": results.NEW,
+        "load_key N=100 n=64 scheme=BarbosaIPEScheme": results.MISSING})
+    for (status, result, before, change) in comparisons:
+        assert((change is None) == (status in (results.NEW, results.MISSING)))
+    regressed = results.regressions(comparisons)
+    assert(len(regressed) == 1 and regressed[0][1]["case"] == "search" and abs(regressed[0][3] - 0.5) < 1e-9)
+
+    print("Testing Comparison Statistic")
+    # the median of search grew by half, its minimum did not move
+    comparisons = results.compare(run, baseline, statistic="min")
+    assert(statuses(comparisons)["search N=100 n=64 scheme=BarbosaIPEScheme"] == results.UNCHANGED)
+    assert(results.regressions(comparisons) == [])
+    # sizes have no minimum and are compared on their value
+    assert(statuses(comparisons)["database_size N=100 n=64 scheme=BarbosaIPEScheme"] == results.UNCHANGED)
+
+    print("Testing Comparison Threshold")
+    # encrypt grew by 5%, a regression only below that threshold
+    assert(statuses(results.compare(run, baseline, 0.01))["encrypt N=100 n=64 scheme=BarbosaIPEScheme"] ==
+           results.REGRESSION)
+    assert(statuses(results.compare(run, baseline, 0.1))["encrypt N=100 n=64 scheme=BarbosaIPEScheme"] ==
+           results.UNCHANGED)
+    assert(results.regressions(results.compare(run, baseline, 1.0)) == [])
+    print("All comparison tests passed")
@@ -19,16 +19,17 @@ Obtains micro-benchmarks for the running times and parameter sizes of IPE and
 two-input functional encryption.
 """
 
-from typing import List
 
 # Path hack.
-import sys, os, math, glob, numpy as np, argparse, asyncio
+import sys, os, math, glob, numpy as np, argparse, asyncio, multiprocessing, concurrent.futures
 
 sys.path.insert(0, os.path.abspath('.'))
 sys.path.insert(1, os.path.abspath('..'))
 
-import random, time, zlib
-from pse import predipe, prox_search, multibasispredipe
+import random, time, zlib, resource, pickle, json
+from pse import predipe, prox_search, multibasispredipe, search_engine, ctstore, keygen, groups, service, metrics
+from charm.toolbox.pairinggroup import PairingGroup, G1, G2, GT
+from fhipe.fhipe import ipe
 from statistics import pstdev
 from math import ceil
 
@@ -37,22 +38,6 @@ def list_average(L):
     return sum(L) / len(L)
 
 
-def get_ct_size(ct):
-    ct_sizeinbytes = 0
-    for elem in ct:
-        elem_sizeinbytes = 0
-        # extract integers from elem
-        str_rep = ''.join(filter(lambda c: c == ' ' or c.isdigit(), str(elem)))
-        delim_size = len(str(elem)) - len(str_rep)  # number of delimiter characters
-        elem_sizeinbytes += delim_size
-        L = [int(s) for s in str_rep.split()]
-        for x in L:
-            intsize = int(math.ceil(math.log2(x) / 8))
-            elem_sizeinbytes += intsize
-        ct_sizeinbytes += elem_sizeinbytes
-    return ct_sizeinbytes
-
-
 def bench_keygen(n, group_name, ipescheme, iterations=1, matrix_file=None, gen_file=None, simulated=False,
                  save_keys=False, num_bases=1):
     setup_time_list = []
@@ -98,8 +83,10 @@ def bench_enc_data(n, database, dataset, iterations=1, parallel=0):
         encrypt_b = time.time()
         encrypt_time_list.append(encrypt_b - encrypt_a)
         encdb_size.append(database.get_database_size())
+    shard_sizes = database.get_shard_sizes() if parallel is 1 else [database.get_database_size()]
     print(str(num_bases)+", "+str(parallel)+", "+str(list_average(encrypt_time_list))+", "+
-          str(pstdev(encrypt_time_list))+", "+str(list_average(encdb_size))+", "+str(pstdev(encdb_size)))
+          str(pstdev(encrypt_time_list))+", "+str(list_average(encdb_size))+", "+str(pstdev(encdb_size))+", "+
+          str(database.get_ct_size())+", "+str(max(shard_sizes)))
 
 def plaintext_inner_product(y, t, query_class):
     encodedy = [xi if xi == 1 else -1 for xi in y]
@@ -163,6 +150,679 @@ def bench_queries(n, database, queryset, iterations=1, t=0, parallel=0):
           str(pstdev(parallel_search_time_list))+", "+str(true_accept_rate)+", "
           +str(list_average(false_matches))+", "+str(pstdev(false_matches)))
 
+def bench_engine(n, database, queryset, iterations=1, t=0, processes=None):
+    parallel_search_time_list = []
+    engine_search_time_list = []
+    engine_start_a = time.time()
+    engine = search_engine.ProximitySearchEngine(database, processes)
+    engine.start()
+    engine_start_b = time.time()
+    num_shards = len(engine.executors)
+    for i in range(iterations):
+        query_class = random.randrange(0, len(queryset))
+        token = database.generate_query(queryset[query_class][0], t)
+
+        search_a = time.time()
+        parallel_indices = database.parallel_search(token)
+        search_b = time.time()
+        parallel_search_time_list.append(search_b - search_a)
+
+        search_a = time.time()
+        engine_indices = engine.search(token)
+        search_b = time.time()
+        engine_search_time_list.append(search_b - search_a)
+        assert sorted(parallel_indices) == sorted(engine_indices)
+    engine.close()
+
+    print(str(num_shards) + ", " + str(engine_start_b - engine_start_a) +
+          ", " + str(list_average(parallel_search_time_list)) + ", " + str(pstdev(parallel_search_time_list)) +
+          ", " + str(list_average(engine_search_time_list)) + ", " + str(pstdev(engine_search_time_list)))
+
+def bench_batch_search(n, database, templates, match_fraction=0.0, iterations=1, t=0, block_size=64,
+                       exponent_bits=40):
+    # the first match_fraction of the records are enrollments of the queried template
+    num_matches = max(1, int(match_fraction * len(templates)))
+    dataset = [templates[0]] * num_matches + templates[num_matches:]
+    database.encrypt_dataset(dataset)
+    search_time_list = []
+    batch_time_list = []
+    batch_tests_list = []
+    for i in range(iterations):
+        token = database.generate_query(templates[0], t)
+
+        search_a = time.time()
+        indices = database.search(token)
+        search_b = time.time()
+        search_time_list.append(search_b - search_a)
+
+        search_a = time.time()
+        batch_indices = database.batch_search(token, block_size, exponent_bits)
+        search_b = time.time()
+        batch_time_list.append(search_b - search_a)
+        batch_tests_list.append(database.batch_tests)
+        assert batch_indices == indices
+
+    print(str(len(dataset)) + ", " + str(num_matches) + ", " + str(block_size) + ", " +
+          str(list_average(search_time_list)) + ", " + str(pstdev(search_time_list)) + ", " +
+          str(list_average(batch_time_list)) + ", " + str(pstdev(batch_time_list)) + ", " +
+          str(list_average(batch_tests_list)) + ", " + str(database.batch_false_negative_bound) + ", " +
+          str(database.batch_false_positive_bound))
+
+def bench_search_many(n, database, queryset, num_queries=1, t=0, processes=None):
+    # database needs both the in-memory records (serial path) and the shard files (sharded path)
+    tokens = [database.generate_query(queryset[random.randrange(0, len(queryset))][0], t)
+              for i in range(num_queries)]
+
+    def queries_per_second(run):
+        run_a = time.time()
+        results = run()
+        run_b = time.time()
+        return (num_queries / (run_b - run_a), results)
+
+    (serial_loop_rate, loop_results) = queries_per_second(lambda: [database.search(token) for token in tokens])
+    (serial_many_rate, many_results) = queries_per_second(lambda: database.search_many(tokens))
+    (parallel_loop_rate, parallel_results) = queries_per_second(
+        lambda: [database.parallel_search(token) for token in tokens])
+    (parallel_many_rate, parallel_many_results) = queries_per_second(lambda: database.parallel_search_many(tokens))
+    with search_engine.ProximitySearchEngine(database, processes) as engine:
+        (engine_many_rate, engine_results) = queries_per_second(lambda: engine.search_many(tokens))
+    assert loop_results == many_results
+    assert [sorted(x) for x in parallel_results] == [sorted(x) for x in parallel_many_results]
+
+    print(str(num_queries) + ", " + str(serial_loop_rate) + ", " + str(serial_many_rate) + ", " +
+          str(parallel_loop_rate) + ", " + str(parallel_many_rate) + ", " + str(engine_many_rate))
+
+def bench_sign_path(n, group_name, iterations=1):
+    scheme = predipe.BarbosaIPEScheme(n + 1, group_name)
+    scheme.generate_keys()
+    column_sum_a = time.time()
+    scheme.signed_row_combination(scheme.Bstar, [1] * n + [-1], 'Bstar')
+    column_sum_b = time.time()
+    generic_time_list = []
+    signed_time_list = []
+    for i in range(iterations):
+        x = [random.choice([-1, 1]) for j in range(n)] + [-1]
+
+        generic_a = time.time()
+        generic = scheme.row_combination(scheme.Bstar, x)
+        generic_b = time.time()
+        generic_time_list.append(generic_b - generic_a)
+
+        signed_a = time.time()
+        signed = scheme.signed_row_combination(scheme.Bstar, x, 'Bstar')
+        signed_b = time.time()
+        signed_time_list.append(signed_b - signed_a)
+        assert generic == signed
+    print(str(n) + ", " + str(column_sum_b - column_sum_a) + ", " + str(list_average(generic_time_list)) + ", " +
+          str(pstdev(generic_time_list)) + ", " + str(list_average(signed_time_list)) + ", " +
+          str(pstdev(signed_time_list)))
+
+def bench_batch_encrypt(n, database, templates, iterations=1, parallel=0):
+    single_time_list = []
+    batch_time_list = []
+    for i in range(iterations):
+        for (batch, time_list) in [(False, single_time_list), (True, batch_time_list)]:
+            encrypt_a = time.time()
+            if parallel == 1:
+                database.encrypt_dataset_parallel(templates, batch)
+            else:
+                database.encrypt_dataset(templates, batch)
+            encrypt_b = time.time()
+            time_list.append(encrypt_b - encrypt_a)
+    print(str(n) + ", " + str(parallel) + ", " + str(len(templates) / list_average(single_time_list)) + ", " +
+          str(len(templates) / list_average(batch_time_list)))
+
+def bench_token_generation(n, database, query, t=0, iterations=1):
+    # per-threshold keygen as generate_query did before the tokens shared one product
+    encoded_query = [xi if xi == 1 else -1 for xi in query]
+    keygen_time_list = []
+    threshold_time_list = []
+    for i in range(iterations):
+        keygen_a = time.time()
+        [database.predinstance.keygen(encoded_query + [n - 2 * j]) for j in range(t + 1)]
+        keygen_b = time.time()
+        keygen_time_list.append(keygen_b - keygen_a)
+
+        keygen_a = time.time()
+        database.generate_query(query, t)
+        keygen_b = time.time()
+        threshold_time_list.append(keygen_b - keygen_a)
+    print(str(n) + ", " + str(t) + ", " + str(list_average(keygen_time_list)) + ", " +
+          str(pstdev(keygen_time_list)) + ", " + str(list_average(threshold_time_list)) + ", " +
+          str(pstdev(threshold_time_list)))
+
+def current_rss(pid="self"):
+    with open("/proc/" + str(pid) + "/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def bench_precomputation(n, database, queryset, iterations=1, t=0, table_records=0):
+    tokens = [database.generate_query(queryset[random.randrange(0, len(queryset))][0], t)
+              for i in range(iterations)]
+    num_records = len(database.enc_data)
+
+    def time_searches(search):
+        time_list = []
+        for token in tokens:
+            search_a = time.time()
+            search(token)
+            search_b = time.time()
+            time_list.append(search_b - search_a)
+        return time_list
+
+    database.set_precomputation(False)
+    batch_time_list = time_searches(database.batch_search)
+
+    rss_a = current_rss()
+    build_a = time.time()
+    database.set_precomputation(True, table_records)
+    database.build_precomputation()
+    build_b = time.time()
+    rss_b = current_rss()
+    index_batch_time_list = time_searches(database.batch_search)
+    database.set_precomputation(False)
+
+    print(str(num_records) + ", " + str(table_records) + ", " + str(build_b - build_a) + ", " +
+          str((rss_b - rss_a) / num_records) + ", " +
+          str(list_average(batch_time_list)) + ", " + str(list_average(index_batch_time_list)))
+
+def engine_rss(engine):
+    return sum(current_rss(pid) for executor in engine.executors for pid in executor._processes)
+
+def bench_shared_store(n, database, queryset, iterations=1, t=0, processes=None):
+    tokens = [database.generate_query(queryset[random.randrange(0, len(queryset))][0], t)
+              for i in range(iterations)]
+    file_bytes = sum(os.stat(database.shard_path(start, end)).st_size
+                     for (start, end) in database.shards)
+
+    def time_searches(search):
+        time_list = []
+        for token in tokens:
+            search_a = time.time()
+            search(token)
+            search_b = time.time()
+            time_list.append(search_b - search_a)
+        return time_list
+
+    file_search_time_list = time_searches(database.parallel_search)
+    file_engine = search_engine.ProximitySearchEngine(database, processes)
+    start_a = time.time()
+    file_engine.start()
+    start_b = time.time()
+    file_engine_start = start_b - start_a
+    file_engine_rss = engine_rss(file_engine)
+    file_engine_time_list = time_searches(file_engine.search)
+    file_engine.close()
+
+    share_a = time.time()
+    store = database.share_encrypted_data()
+    share_b = time.time()
+    shared_search_time_list = time_searches(database.parallel_search)
+    shared_engine = search_engine.ProximitySearchEngine(database, processes, shared_memory=True)
+    start_a = time.time()
+    shared_engine.start()
+    start_b = time.time()
+    shared_engine_start = start_b - start_a
+    shared_engine_rss = engine_rss(shared_engine)
+    shared_engine_time_list = time_searches(shared_engine.search)
+    shared_engine.close()
+    store_bytes = store.nbytes()
+    database.release_shared_data()
+
+    print(str(database.num_records) + ", " + str(file_bytes) + ", " + str(store_bytes) + ", " +
+          str(share_b - share_a) + ", " +
+          str(list_average(file_search_time_list)) + ", " + str(list_average(shared_search_time_list)) + ", " +
+          str(file_engine_start) + ", " + str(shared_engine_start) + ", " +
+          str(file_engine_rss) + ", " + str(shared_engine_rss) + ", " +
+          str(list_average(file_engine_time_list)) + ", " + str(list_average(shared_engine_time_list)))
+
+def bench_store_file(n, database, iterations=1, store_filename="ciphertexts.store"):
+    group = database.predinstance.group
+    enc_data = database.gather_encrypted_data()
+    num_records = len(enc_data)
+    record_ids = list(enc_data)
+    timings = {}
+
+    def timed(name, run):
+        time_list = []
+        for i in range(iterations):
+            run_a = time.time()
+            run()
+            run_b = time.time()
+            time_list.append(run_b - run_a)
+        timings[name] = list_average(time_list)
+
+    def write_blob():
+        with open(store_filename + ".blob", "wb") as blob_file:
+            blob_file.write(prox_search.objectToBytes(enc_data, group))
+            blob_file.close()
+
+    def read_blob():
+        with open(store_filename + ".blob", "rb") as blob_file:
+            prox_search.bytesToObject(blob_file.read(), group)
+            blob_file.close()
+
+    def read_store(order):
+        store = ctstore.CiphertextFile.open(store_filename, group, cache=False)
+        for x in order:
+            store[x]
+        store.close()
+
+    random_order = [random.choice(record_ids) for x in record_ids]
+    timed("blob write", write_blob)
+    timed("blob read", read_blob)
+    timed("store write", lambda: database.save_encrypted_data(store_filename))
+    timed("store open", lambda: ctstore.CiphertextFile.open(store_filename, group).close())
+    timed("store sequential read", lambda: read_store(record_ids))
+    timed("store random read", lambda: read_store(random_order))
+    blob_bytes = os.stat(store_filename + ".blob").st_size
+    store_bytes = os.stat(store_filename).st_size
+    os.remove(store_filename + ".blob")
+    os.remove(store_filename)
+
+    print(str(num_records) + ", " + str(blob_bytes) + ", " + str(store_bytes) + ", " +
+          ", ".join(str(num_records / timings[name]) for name in
+                    ["blob write", "blob read", "store write", "store sequential read", "store random read"]) +
+          ", " + str(timings["store open"]))
+
+def bench_element_encoding(n, database, templates, t=0, iterations=1, store_filename="encoding.store"):
+    group = database.predinstance.group
+    enc_data = database.gather_encrypted_data()
+    record_ids = list(enc_data)
+    tag = ctstore.ciphertext_tag(group, enc_data[record_ids[0]])
+    width = database.get_element_width()
+    serialized = [[group.serialize(e) for e in ctstore.flat_elements(enc_data[x])] for x in record_ids]
+    raw = [ctstore.encode_ciphertext(group, enc_data[x]) for x in record_ids]
+    serialized_size = sum(len(e) for e in serialized[0])
+    raw_size = database.get_ct_size()
+    queries = [database.generate_query(templates[0], t)]
+    token_sizes = [len(pickle.dumps(prox_search.objectToBytes(queries, group))),
+                   len(pickle.dumps(ctstore.pack_tokens(group, queries)))]
+
+    def timed(run):
+        time_list = []
+        for i in range(iterations):
+            run_a = time.time()
+            run()
+            run_b = time.time()
+            time_list.append(run_b - run_a)
+        return list_average(time_list) / len(record_ids)
+
+    serialized_decode = timed(lambda: [[group.deserialize(e) for e in record] for record in serialized])
+    raw_data = b"".join(raw)
+    raw_decode = timed(lambda: ctstore.decode_elements(group, tag, raw_data, width))
+    # below this read bandwidth, in bytes per second, the smaller raw records pay for their extra decoding
+    extra_decode = raw_decode - serialized_decode
+    break_even = (serialized_size - raw_size) / extra_decode if extra_decode > 0 else float("inf")
+
+    database.save_encrypted_data(store_filename)
+    database.open_encrypted_data(store_filename)
+    token = database.generate_query(templates[0], t)
+    search_a = time.time()
+    database.search(token)
+    search_b = time.time()
+    database.search(token)
+    search_c = time.time()
+    database.release_shared_data()
+    os.remove(store_filename)
+    database.enc_data = enc_data
+
+    print(str(len(record_ids)) + ", " + str(serialized_size) + ", " + str(raw_size) + ", " + str(token_sizes[0]) +
+          ", " + str(token_sizes[1]) + ", " + str(serialized_decode) + ", " + str(raw_decode) + ", " +
+          str(break_even) + ", " + str(search_b - search_a) + ", " + str(search_c - search_b), flush=True)
+
+def bench_group_backend(n, ipescheme, templates, group_names, num_queries=10, t=0, processes=None):
+    results = None
+    for group_name in group_names:
+        database = prox_search.ProximitySearch(n, ipescheme, group_name)
+        database.generate_keys()
+        if processes is not None:
+            database.set_scheduler(processes, database.scheduler.chunk_size)
+        encrypt_a = time.time()
+        database.encrypt_dataset_parallel(templates, batch=True)
+        encrypt_b = time.time()
+        queries = [database.generate_query(templates[i], t) for i in range(min(num_queries, len(templates)))]
+        search_a = time.time()
+        matches = [sorted(indices) for indices in database.parallel_search_many(queries)]
+        search_b = time.time()
+        if results is None:
+            results = matches
+        print(ipescheme.__name__ + ", " + group_name + ", " + str(len(templates)) + ", " + str(encrypt_b - encrypt_a) +
+              ", " + str((search_b - search_a) / len(queries)) + ", " + str(matches == results), flush=True)
+
+def bench_token_group(n, ipescheme, group_name, record_counts, num_queries=5, t=0, processes=None):
+    """
+    Per record search cost, serial and parallel, with tokens in G1 and in G2
+    as the number of records grows. The placement changes which group's
+    elements are stored, decoded and paired as the record side; the pairing
+    work per record is the same, no token side precomputation is done.
+    """
+    for token_group in [G1, G2]:
+        database = prox_search.ProximitySearch(n, ipescheme, group_name)
+        database.set_token_group(token_group)
+        database.generate_keys()
+        if processes is not None:
+            database.set_scheduler(processes, database.scheduler.chunk_size)
+        for num_records in record_counts:
+            templates = [[random.randint(0, 1) for j in range(n)] for i in range(num_records)]
+            database.encrypt_dataset(templates)
+            queries = [database.generate_query(templates[i % num_records], t) for i in range(num_queries)]
+            serial_a = time.time()
+            for query in queries:
+                database.search(query)
+            serial_b = time.time()
+            database.encrypt_dataset_parallel(templates, batch=True)
+            parallel_a = time.time()
+            for query in queries:
+                database.parallel_search(query)
+            parallel_b = time.time()
+            print(ipescheme.__name__ + ", " + ("G1" if token_group == G1 else "G2") + ", " + str(num_records) + ", " +
+                  str(database.get_ct_size()) + ", " + str((serial_b - serial_a) / (num_queries * num_records)) + ", " +
+                  str((parallel_b - parallel_a) / (num_queries * num_records)), flush=True)
+
+def bench_instrumentation(n, database, templates, num_queries=10, t=0, iterations=3):
+    """
+    Search time with instrumentation off and on, and the counters and timers
+    of one sharded search. database needs the in-memory records and the shard
+    files.
+    """
+    queries = [database.generate_query(templates[i % len(templates)], t) for i in range(num_queries)]
+
+    def search_time():
+        search_a = time.time()
+        for query in queries:
+            database.search(query)
+        return time.time() - search_a
+
+    metrics.enable(False)
+    disabled_time = min(search_time() for i in range(iterations))
+    metrics.enable(True)
+    enabled_time = min(search_time() for i in range(iterations))
+    metrics.enable(False)
+    with metrics.recording() as record:
+        database.parallel_search_many(queries)
+    counters = record.snapshot["counters"]
+    print(str(len(database.enc_data)) + ", " + str(disabled_time) + ", " + str(enabled_time) + ", " +
+          str(100 * (enabled_time - disabled_time) / disabled_time) + ", " +
+          str(counters.get("pairings", 0) / (num_queries * len(database.enc_data))) + ", " +
+          str(counters.get("deserializations", 0)), flush=True)
+    print(json.dumps(record.snapshot, indent=1, sort_keys=True))
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def bench_encrypt_stream(n, database, num_records, chunk_size=256, processes=None, store_filename="stream.store"):
+    templates = ([random.randint(0, 1) for j in range(n)] for i in range(num_records))
+    stream_a = time.time()
+    database.encrypt_stream(templates, store_filename, chunk_size, processes, batch=True)
+    stream_b = time.time()
+    (parent_rss, worker_rss) = peak_rss()
+    store_bytes = os.stat(store_filename).st_size
+    database.release_shared_data()
+    os.remove(store_filename)
+    print(str(num_records) + ", " + str(chunk_size) + ", " + str(num_records / (stream_b - stream_a)) + ", " +
+          str(store_bytes) + ", " + str(parent_rss) + ", " + str(worker_rss))
+
+def bench_add_records(n, num_records, inserts=20, processes=None, store_filename="enroll.store"):
+    database = prox_search.ProximitySearch(n, predipe.BarbosaIPEScheme, 'MNT159')
+    database.generate_keys()
+    templates = ([random.randint(0, 1) for j in range(n)] for i in range(num_records))
+    build_a = time.time()
+    database.encrypt_stream(templates, store_filename, processes=processes, batch=True)
+    build_b = time.time()
+
+    def insert_latencies(add_records):
+        time_list = []
+        for i in range(inserts):
+            insert_a = time.time()
+            add_records([[random.randint(0, 1) for j in range(n)]])
+            insert_b = time.time()
+            time_list.append(insert_b - insert_a)
+        return time_list
+
+    insert_time_list = insert_latencies(database.add_records)
+    remove_a = time.time()
+    database.remove_records(random.sample(range(num_records), inserts))
+    remove_b = time.time()
+    engine = search_engine.ProximitySearchEngine(database, processes)
+    engine.start()
+    engine_insert_time_list = insert_latencies(engine.add_records)
+    engine.close()
+    compact_a = time.time()
+    database.compact(background=True).join()
+    compact_b = time.time()
+    database.release_shared_data()
+    os.remove(store_filename)
+
+    print(str(num_records) + ", " + str(build_b - build_a) + ", " + str(list_average(insert_time_list)) + ", " +
+          str(pstdev(insert_time_list)) + ", " + str(list_average(engine_insert_time_list)) + ", " +
+          str(pstdev(engine_insert_time_list)) + ", " + str((remove_b - remove_a) / inserts) + ", " +
+          str(compact_b - compact_a))
+
+def bench_first_match(n, database, templates, iterations=1, t=0, processes=None):
+    # the records are random, so at t=0 only the enrolled template itself matches
+    cases = [("hit early", templates[0]), ("hit late", templates[-1]),
+             ("no hit", [random.randint(0, 1) for j in range(n)])]
+    engine = search_engine.ProximitySearchEngine(database, processes)
+    engine.start()
+
+    def average_time(search, token, **kwargs):
+        time_list = []
+        for i in range(iterations):
+            search_a = time.time()
+            search(token, **kwargs)
+            search_b = time.time()
+            time_list.append(search_b - search_a)
+        return list_average(time_list)
+
+    for (case, query) in cases:
+        token = database.generate_query(query, t)
+        timings = []
+        for search in [database.search, database.parallel_search, engine.search]:
+            timings.append(average_time(search, token))
+            timings.append(average_time(search, token, first_match=True))
+        print(case + ", " + ", ".join(str(timing) for timing in timings))
+    engine.close()
+
+def percentile(L, p):
+    ordered = sorted(L)
+    return ordered[min(len(ordered) - 1, int(ceil(p / 100 * len(ordered))) - 1)]
+
+def bench_service(n, database, templates, client_counts, requests_per_client=20, t=0, processes=None,
+                  socket_path="pse_service.sock"):
+    """
+    Closed-loop load on a QueryService over a Unix socket: every client sends
+    its next search as soon as the previous one is answered. Reports
+    throughput, latency percentiles and queries answered per scan.
+    """
+    packed = [ctstore.pack_tokens(database.predinstance.group, [database.generate_query(templates[i], t)])
+              for i in range(min(len(templates), 16))]
+
+    async def client_load(latencies):
+        client = await service.ServiceClient.connect_unix(socket_path)
+        for i in range(requests_per_client):
+            search_a = time.time()
+            await client.search(packed[random.randrange(0, len(packed))])
+            latencies.append(time.time() - search_a)
+        await client.close()
+
+    async def run_load():
+        query_service = service.QueryService(database, processes)
+        await query_service.listen_unix(socket_path)
+        for num_clients in client_counts:
+            latencies = []
+            (scans, scanned_queries) = (query_service.scans, query_service.scanned_queries)
+            load_a = time.time()
+            await asyncio.gather(*[client_load(latencies) for i in range(num_clients)])
+            load_b = time.time()
+            print(str(num_clients) + ", " + str(len(latencies) / (load_b - load_a)) + ", " +
+                  str(percentile(latencies, 50)) + ", " + str(percentile(latencies, 95)) + ", " +
+                  str(percentile(latencies, 99)) + ", " +
+                  str((query_service.scanned_queries - scanned_queries) / (query_service.scans - scans)), flush=True)
+        await query_service.close()
+        os.remove(socket_path)
+
+    asyncio.run(run_load())
+
+def burn_cpu():
+    while True:
+        pass
+
+def bench_scheduler(n, database, templates, iterations=1, t=0, workers=None, chunk_sizes=[None, 64],
+                    load_processes=0, label=""):
+    # busy processes stand in for the other tenants of a shared host
+    burners = [multiprocessing.Process(target=burn_cpu, daemon=True) for i in range(load_processes)]
+    for burner in burners:
+        burner.start()
+    token = database.generate_query(templates[0], t)
+    for chunk_size in chunk_sizes:
+        database.set_scheduler(workers, chunk_size)
+        encrypt_a = time.time()
+        database.encrypt_dataset_parallel(templates)
+        encrypt_b = time.time()
+        search_time_list = []
+        for i in range(iterations):
+            search_a = time.time()
+            database.parallel_search(token)
+            search_b = time.time()
+            search_time_list.append(search_b - search_a)
+        print(label + str(database.scheduler.workers) + ", " + str(chunk_size) + ", " + str(load_processes) + ", " +
+              str(encrypt_b - encrypt_a) + ", " + str(percentile(search_time_list, 50)) + ", " +
+              str(percentile(search_time_list, 95)) + ", " + str(percentile(search_time_list, 99)))
+    for burner in burners:
+        burner.terminate()
+
+def bench_setup(n, num_bases, group_name, iterations=1, workers=None):
+    database = prox_search.ProximitySearch(n, multibasispredipe.MultiBasesPredScheme, group_name)
+    database.predinstance.set_number_bases(num_bases)
+
+    def average_time(generate_keys):
+        time_list = []
+        for i in range(iterations):
+            keygen_a = time.time()
+            generate_keys()
+            keygen_b = time.time()
+            time_list.append(keygen_b - keygen_a)
+        return list_average(time_list)
+
+    with keygen.KeyGenerator(1) as key_generator:
+        one_worker = average_time(lambda: database.generate_keys(key_generator))
+    per_call = average_time(database.generate_keys)
+    with keygen.KeyGenerator(workers) as key_generator:
+        persistent = average_time(lambda: database.generate_keys(key_generator))
+    with keygen.KeyGenerator(workers, pool_size=num_bases) as key_generator:
+        pregenerated_list = []
+        for i in range(iterations):
+            concurrent.futures.wait(key_generator.prefill(database.predinstance.component_length,
+                                                          database.predinstance.group.order()))
+            keygen_a = time.time()
+            database.generate_keys(key_generator)
+            keygen_b = time.time()
+            pregenerated_list.append(keygen_b - keygen_a)
+        pregenerated = list_average(pregenerated_list)
+    print(str(n) + ", " + str(num_bases) + ", " + str(one_worker) + ", " + str(per_call) + ", " + str(persistent) +
+          ", " + str(pregenerated), flush=True)
+
+def bench_normalization(n, num_bases, group_name, iterations=1, workers=None):
+    database = prox_search.ProximitySearch(n, multibasispredipe.MultiBasesPredScheme, group_name)
+    database.predinstance.set_number_bases(num_bases)
+    group = database.predinstance.group
+    length = database.predinstance.component_length
+    order = int(group.order())
+    with keygen.KeyGenerator(workers) as key_generator:
+        bases = key_generator.generate(group, length, count=num_bases)
+        # divide B* by det(B) entry by entry in ZR, as generate_keys did before
+        legacy_a = time.time()
+        for (B, Bstar, detB) in bases:
+            for j in range(length):
+                for k in range(length):
+                    Bstar[j][k] = Bstar[j][k] * (1/detB)
+        legacy_b = time.time()
+        int_bases = [keygen.run_gen_matrices(length, order) for i in range(num_bases)]
+        bulk_a = time.time()
+        for (detB, B, Bstar) in int_bases:
+            keygen.normalize_dual(detB, Bstar, order)
+        bulk_b = time.time()
+        keygen_time_list = []
+        for i in range(iterations):
+            keygen_a = time.time()
+            database.generate_keys(key_generator)
+            keygen_b = time.time()
+            keygen_time_list.append(keygen_b - keygen_a)
+    print(str(n) + ", " + str(num_bases) + ", " + str(legacy_b - legacy_a) + ", " + str(bulk_b - bulk_a) + ", " +
+          str(list_average(keygen_time_list)) + ", " + str(pstdev(keygen_time_list)), flush=True)
+
+def legacy_serialize_key(predinstance):
+    # the text key format written before the binary one, generators repeated for every basis
+    matrix_str = str(predinstance.num_bases)
+    for binstance in predinstance.barbosa_vec:
+        g1bytes = prox_search.objectToBytes(binstance.g1, binstance.group)
+        g2bytes = prox_search.objectToBytes(binstance.g2, binstance.group)
+        matrix_str = matrix_str + "\n" + binstance.serialize_matrices() + "\n" + str(len(g1bytes)) + " " + \
+            str(len(g2bytes))
+    return matrix_str, g1bytes + g2bytes
+
+def bench_key_file(n, num_bases, group_name, iterations=1, matrix_file="key.matrix", gen_file="key.gen"):
+    database = prox_search.ProximitySearch(n, multibasispredipe.MultiBasesPredScheme, group_name)
+    database.predinstance.set_number_bases(num_bases)
+    database.generate_keys()
+
+    def timed(run):
+        time_list = []
+        for i in range(iterations):
+            run_a = time.time()
+            run()
+            run_b = time.time()
+            time_list.append(run_b - run_a)
+        return list_average(time_list)
+
+    def write_text_key():
+        (matrix_str, generator_bytes) = legacy_serialize_key(database.predinstance)
+        with open(matrix_file, "w") as key_file:
+            key_file.write(matrix_str)
+        with open(gen_file, "wb") as key_file:
+            key_file.write(generator_bytes)
+
+    def read_key():
+        loaded = prox_search.ProximitySearch(n, multibasispredipe.MultiBasesPredScheme, group_name)
+        loaded.read_key_from_file(matrix_file, gen_file)
+
+    results = []
+    for write_key in [write_text_key, lambda: database.write_key_to_file(matrix_file, gen_file)]:
+        save_time = timed(write_key)
+        load_time = timed(read_key)
+        results += [save_time, load_time, os.path.getsize(matrix_file) + os.path.getsize(gen_file)]
+    os.remove(matrix_file)
+    os.remove(gen_file)
+    print(str(n) + ", " + str(num_bases) + ", " + ", ".join(str(r) for r in results), flush=True)
+
+def legacy_decrypt(ct, token, group_name):
+    # decrypt as it was before the multi-pairing engine: one pairing and final exponentiation per
+    # coordinate and a fresh group for the identity on every call
+    return ipe.innerprod_pair(ct, token) == PairingGroup(group_name).init(GT, 1)
+
+def bench_decrypt(n, group_name, iterations=10):
+    scheme = predipe.BarbosaIPEScheme(n, group_name)
+    ct = [scheme.group.random(G2) for i in range(n)]
+    token = [scheme.group.random(G1) for i in range(n)]
+    legacy_time_list = []
+    multi_pairing_time_list = []
+    for i in range(iterations):
+        decrypt_a = time.time()
+        legacy_result = legacy_decrypt(ct, token, group_name)
+        decrypt_b = time.time()
+        legacy_time_list.append(decrypt_b - decrypt_a)
+
+        decrypt_a = time.time()
+        result = scheme.decrypt_prepared(ct, token)
+        decrypt_b = time.time()
+        multi_pairing_time_list.append(decrypt_b - decrypt_a)
+        assert result == legacy_result
+    print(str(n) + ", " + str(list_average(legacy_time_list)) + ", " + str(pstdev(legacy_time_list)) + ", " +
+          str(list_average(multi_pairing_time_list)) + ", " + str(pstdev(multi_pairing_time_list)) + ", " +
+          str(list_average(legacy_time_list) / list_average(multi_pairing_time_list)))
+
 def bench_accuracy(n, database, queryset, iterations=1, t=0, parallel=0):
     true_accept_rate = 0
     false_accept_rate = 0
@@ -246,11 +906,357 @@ if __name__ == "__main__":
                         default=0, help='Whether to run parallel algorithms, default yes')
     parser.add_argument('--full_timing', '-ft', const=1, type=int, nargs='?',
                         default=0, help='Full Timing Test for Multiple Vector sizes')
+    parser.add_argument('--benchmark_engine', '-bse', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark per-query latency of parallel_search against the resident '
+                                        'search engine (synthetic data)')
+    parser.add_argument('--benchmark_batch_search', '-bbs', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark group-testing batch search against search (synthetic data)')
+    parser.add_argument('--benchmark_precomputation', '-bpc', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark the precomputed-ciphertext index (synthetic data)')
+    parser.add_argument('--benchmark_decrypt', '-bd', const=1, type=int, nargs='?',
+                        default=0, help='Microbenchmark multi-pairing decrypt against the per-pairing path')
+    parser.add_argument('--benchmark_search_many', '-bsm', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark batched multi-query search throughput (synthetic data)')
+    parser.add_argument('--benchmark_sign_path', '-bsp', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark the sign-vector encryption path against the generic product')
+    parser.add_argument('--benchmark_batch_encrypt', '-bbe', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark batched dataset encryption throughput (synthetic data)')
+    parser.add_argument('--benchmark_tokens', '-bt', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark threshold token generation against per-threshold keygen')
+    parser.add_argument('--benchmark_shared_store', '-bss', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark memory and latency of the shared memory ciphertext store')
+    parser.add_argument('--benchmark_store_file', '-bsf', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark read and write throughput of the ciphertext store file')
+    parser.add_argument('--benchmark_encrypt_stream', '-bes', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark throughput and peak memory of streaming encryption')
+    parser.add_argument('--benchmark_add_records', '-bar', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark single record enrollment into a large encrypted database')
+    parser.add_argument('--benchmark_first_match', '-bfm', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark first-match search against full scans')
+    parser.add_argument('--benchmark_scheduler', '-bsc', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark tail latency of chunked scheduling under loaded cores')
+    parser.add_argument('--benchmark_setup', '-bsu', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark multi-basis key generation at the full timing sizes')
+    parser.add_argument('--benchmark_normalization', '-bnm', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark dual basis normalization and key generation for sigma 1 to 103')
+    parser.add_argument('--benchmark_key_file', '-bkf', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark save and load of the text and binary secret key formats')
+    parser.add_argument('--benchmark_element_encoding', '-bee', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark size and decoding cost of raw compressed elements')
+    parser.add_argument('--benchmark_group_backend', '-bgb', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark the pipeline on MNT159 against the simulated group backend')
+    parser.add_argument('--benchmark_token_group', '-btg', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark per record search cost with tokens in G1 and in G2')
+    parser.add_argument('--benchmark_service', '-bsv', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark query service throughput and latency under concurrent clients')
+    parser.add_argument('--benchmark_instrumentation', '-bin', const=1, type=int, nargs='?',
+                        default=0, help='Benchmark the overhead of pse.metrics and print a search breakdown')
+    parser.add_argument('--vector_length', '-v', type=int, default=64,
+                        help='Length of the synthetic vectors')
+    parser.add_argument('--records', '-r', type=int, default=356,
+                        help='Number of synthetic records')
+    parser.add_argument('--processes', '-np', type=int, default=None,
+                        help='Number of worker processes, default cpu_count()')
     args = vars(parser.parse_args())
 
     matrix_file = None
     gen_file = None
 
+    # benchmarks that run on synthetic data and do not need the features dataset
+    synthetic_benchmark = (args['benchmark_engine'] or args['benchmark_batch_search'] or
+                           args['benchmark_precomputation'] or args['benchmark_decrypt'] or
+                           args['benchmark_search_many'] or args['benchmark_sign_path'] or
+                           args['benchmark_batch_encrypt'] or args['benchmark_tokens'] or
+                           args['benchmark_shared_store'] or args['benchmark_store_file'] or
+                           args['benchmark_encrypt_stream'] or args['benchmark_add_records'] or
+                           args['benchmark_first_match'] or args['benchmark_scheduler'] or
+                           args['benchmark_setup'] or args['benchmark_normalization'] or
+                           args['benchmark_key_file'] or args['benchmark_element_encoding'] or
+                           args['benchmark_group_backend'] or args['benchmark_token_group'] or
+                           args['benchmark_service'] or args['benchmark_instrumentation'])
+
+    if args['benchmark_engine']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+        database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, group_name)
+        database.generate_keys()
+        database.encrypt_dataset_parallel(templates)
+
+        print("Benchmarking Resident Search Engine", flush=True)
+        print("Shards, Engine start time, Parallel search Avg, Parallel search STDev, Engine search Avg, "
+              "Engine search STDev")
+        bench_engine(n=vector_length, database=database, queryset=dataset, iterations=10, t=0,
+                     processes=args['processes'])
+
+    if args['benchmark_batch_search']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, group_name)
+        database.generate_keys()
+
+        print("Benchmarking Batch Search", flush=True)
+        print("Records, Matches, Block size, Search time Avg, Search time STDev, Batch search time Avg, "
+              "Batch search time STDev, Batch decryptions Avg, False negative bound, False positive bound")
+        for num_records in [64, 128, 256, 512, 1024]:
+            (dataset, templates) = generate_synthetic_data(num_records, vector_length)
+            for match_fraction in [0.0, 0.5, 0.9]:
+                bench_batch_search(n=vector_length, database=database, templates=templates,
+                                   match_fraction=match_fraction, iterations=1, t=0)
+
+    if args['benchmark_precomputation']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        print("Benchmarking Precomputed Ciphertext Index", flush=True)
+        print("Scheme, Records, Table records, Build time, Bytes per record, Batch search time, "
+              "Indexed batch search time")
+        (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+        for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+            database = prox_search.ProximitySearch(vector_length, ipescheme, group_name)
+            database.generate_keys()
+            database.encrypt_dataset(templates)
+            for table_records in [0, len(templates) // 4, None]:
+                print(ipescheme.__name__ + ", ", end="")
+                bench_precomputation(n=vector_length, database=database, queryset=dataset, iterations=5, t=0,
+                                     table_records=table_records)
+
+    if args['benchmark_decrypt']:
+        print("Benchmarking Decrypt", flush=True)
+        print("Vector Length, Per-pairing Avg, Per-pairing STDev, Multi-pairing Avg, Multi-pairing STDev, Speedup")
+        for vector_length in [64, 128, 256, 512, 1024, 2048, 4096]:
+            bench_decrypt(n=vector_length, group_name='MNT159', iterations=10)
+
+    if args['benchmark_search_many']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+        database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, group_name)
+        database.generate_keys()
+        database.encrypt_dataset_parallel(templates)
+        database.encrypt_dataset(templates)
+
+        print("Benchmarking Multi-query Search", flush=True)
+        print("Queries, Serial search q/s, Serial search_many q/s, Parallel search q/s, Parallel search_many q/s, "
+              "Engine search_many q/s")
+        for num_queries in [1, 2, 4, 8, 16, 32]:
+            bench_search_many(n=vector_length, database=database, queryset=dataset, num_queries=num_queries, t=0,
+                              processes=args['processes'])
+
+    if args['benchmark_sign_path']:
+        print("Benchmarking Sign-vector Encryption", flush=True)
+        print("Vector Length, Column sums time, Generic Avg, Generic STDev, Signed Avg, Signed STDev")
+        for vector_length in [1024, 2048, 4096]:
+            bench_sign_path(n=vector_length, group_name='MNT159', iterations=3)
+
+    if args['benchmark_batch_encrypt']:
+        group_name = 'MNT159'
+        print("Benchmarking Batched Encryption", flush=True)
+        print("Scheme, Vector Length, Parallel, Records/sec, Batched records/sec")
+        for vector_length in [64, 256, 1024]:
+            (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+            for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+                database = prox_search.ProximitySearch(vector_length, ipescheme, group_name)
+                database.generate_keys()
+                for parallel in [0, 1]:
+                    print(ipescheme.__name__ + ", ", end="")
+                    bench_batch_encrypt(n=vector_length, database=database, templates=templates, iterations=1,
+                                        parallel=parallel)
+
+    if args['benchmark_tokens']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        query = [random.randint(0, 1) for x in range(vector_length)]
+        print("Benchmarking Token Generation", flush=True)
+        print("Scheme, Vector Length, t, Per-threshold keygen Avg, Per-threshold keygen STDev, "
+              "Threshold tokens Avg, Threshold tokens STDev")
+        for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+            database = prox_search.ProximitySearch(vector_length, ipescheme, group_name)
+            database.generate_keys()
+            for t in sorted(set([0, 1, vector_length // 16, vector_length // 8, (3 * vector_length) // 10])):
+                print(ipescheme.__name__ + ", ", end="")
+                bench_token_generation(n=vector_length, database=database, query=query, t=t, iterations=3)
+
+    if args['benchmark_shared_store']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        print("Benchmarking Shared Memory Ciphertext Store", flush=True)
+        print("Records, Shard file bytes, Store bytes, Store build time, File parallel search, "
+              "Shared parallel search, File engine start, Shared engine start, File engine worker RSS, "
+              "Shared engine worker RSS, File engine search, Shared engine search")
+        for num_records in [args['records'], 4 * args['records']]:
+            (dataset, templates) = generate_synthetic_data(num_records, vector_length)
+            database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, group_name)
+            database.generate_keys()
+            database.encrypt_dataset_parallel(templates)
+            bench_shared_store(n=vector_length, database=database, queryset=dataset, iterations=5, t=0,
+                               processes=args['processes'])
+
+    if args['benchmark_store_file']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        print("Benchmarking Ciphertext Store File", flush=True)
+        print("Scheme, Records, Blob bytes, Store bytes, Blob write records/s, Blob read records/s, "
+              "Store write records/s, Store sequential read records/s, Store random read records/s, "
+              "Store open time")
+        (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+        for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+            database = prox_search.ProximitySearch(vector_length, ipescheme, group_name)
+            database.generate_keys()
+            database.encrypt_dataset(templates, batch=True)
+            print(ipescheme.__name__ + ", ", end="")
+            bench_store_file(n=vector_length, database=database, iterations=3)
+
+    if args['benchmark_encrypt_stream']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, group_name)
+        database.generate_keys()
+        print("Benchmarking Streaming Encryption", flush=True)
+        # peak RSS only grows, the in-memory runs come last so they do not hide the streaming ones
+        print("Records, Chunk size, Records/sec, Store bytes, Peak RSS KB, Peak worker RSS KB")
+        for num_records in [args['records'], 4 * args['records'], 16 * args['records']]:
+            bench_encrypt_stream(n=vector_length, database=database, num_records=num_records,
+                                 processes=args['processes'])
+        print("Records, In-memory records/sec, Peak RSS KB")
+        for num_records in [args['records'], 4 * args['records'], 16 * args['records']]:
+            (dataset, templates) = generate_synthetic_data(num_records, vector_length)
+            encrypt_a = time.time()
+            database.encrypt_dataset(templates, batch=True)
+            encrypt_b = time.time()
+            print(str(num_records) + ", " + str(num_records / (encrypt_b - encrypt_a)) + ", " + str(peak_rss()[0]))
+
+    if args['benchmark_add_records']:
+        vector_length = args['vector_length']
+        print("Benchmarking Incremental Enrollment", flush=True)
+        # the full re-encryption that add_records avoids takes about as long as the initial build
+        print("Records, Build time, Insert Avg, Insert STDev, Engine insert Avg, Engine insert STDev, "
+              "Remove per record, Compaction time")
+        for num_records in [1000, 10000, 100000]:
+            bench_add_records(n=vector_length, num_records=num_records, processes=args['processes'])
+
+    if args['benchmark_first_match']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+        database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, group_name)
+        database.generate_keys()
+        database.encrypt_dataset_parallel(templates)
+        database.share_encrypted_data()
+        print("Benchmarking First-match Search", flush=True)
+        print("Case, Search, First-match search, Parallel search, First-match parallel search, Engine search, "
+              "First-match engine search")
+        bench_first_match(n=vector_length, database=database, templates=templates, iterations=5,
+                          processes=args['processes'])
+        database.release_shared_data()
+
+    if args['benchmark_scheduler']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        workers = args['processes'] if args['processes'] is not None else multiprocessing.cpu_count()
+        (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+        print("Benchmarking Chunk Scheduler", flush=True)
+        print("Scheme, Workers, Chunk size, Loaded cores, Encrypt time, Search p50, Search p95, Search p99")
+        for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+            database = prox_search.ProximitySearch(vector_length, ipescheme, group_name)
+            database.generate_keys()
+            for load_processes in [0, max(1, workers // 4), max(1, workers // 2)]:
+                bench_scheduler(n=vector_length, database=database, templates=templates, iterations=20,
+                                workers=workers, chunk_sizes=[None, 64, 16], load_processes=load_processes,
+                                label=ipescheme.__name__ + ", ")
+
+    if args['benchmark_setup']:
+        group_name = 'MNT159'
+        vector_sizes = [128, 192, 256, 384, 512, 768, 1024, 2048, 4096]
+        vector_sigma = [3, 5, 7, 10, 13, 19, 25, 51, 103]
+        print("Benchmarking Key Generation", flush=True)
+        print("Vector Length, Number Bases, One worker, Pool per call, Persistent pool, Pre-generated bases")
+        for i in range(len(vector_sizes)):
+            bench_setup(n=vector_sizes[i], num_bases=vector_sigma[i], group_name=group_name, iterations=3,
+                        workers=args['processes'])
+
+    if args['benchmark_normalization']:
+        group_name = 'MNT159'
+        vector_length = max(args['vector_length'], 103)
+        print("Benchmarking Dual Basis Normalization", flush=True)
+        print("Vector Length, Number Bases, Per-entry normalization, Bulk normalization, KeyGen Time Avg, "
+              "KeyGen Time STDev")
+        for num_bases in [1, 3, 5, 7, 10, 13, 19, 25, 51, 103]:
+            bench_normalization(n=vector_length, num_bases=num_bases, group_name=group_name, iterations=3,
+                                workers=args['processes'])
+
+    if args['benchmark_key_file']:
+        group_name = 'MNT159'
+        vector_sizes = [128, 192, 256, 384, 512, 768, 1024, 2048, 4096]
+        vector_sigma = [3, 5, 7, 10, 13, 19, 25, 51, 103]
+        print("Benchmarking Secret Key Files", flush=True)
+        print("Vector Length, Number Bases, Text save, Text load, Text size, Binary save, Binary load, Binary size")
+        for i in range(len(vector_sizes)):
+            bench_key_file(n=vector_sizes[i], num_bases=vector_sigma[i], group_name=group_name, iterations=3)
+
+    if args['benchmark_element_encoding']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+        print("Benchmarking Element Encoding", flush=True)
+        print("Scheme, Records, Serialized record size, Raw record size, Serialized token size, Raw token size, "
+              "Serialized decode per record, Raw decode per record, Break-even read bandwidth, Cold search, "
+              "Cached search")
+        for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+            database = prox_search.ProximitySearch(vector_length, ipescheme, group_name)
+            database.generate_keys()
+            database.encrypt_dataset(templates)
+            print(ipescheme.__name__ + ", ", end="")
+            bench_element_encoding(n=vector_length, database=database, templates=templates, iterations=3)
+
+    if args['benchmark_group_backend']:
+        vector_length = args['vector_length']
+        (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+        print("Benchmarking Group Backends", flush=True)
+        print("Scheme, Group, Records, Encrypt time, Search time per query, Same matches as MNT159")
+        for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+            bench_group_backend(n=vector_length, ipescheme=ipescheme, templates=templates,
+                                group_names=['MNT159', groups.SIMULATED_GROUP], t=vector_length // 10,
+                                processes=args['processes'])
+
+    if args['benchmark_token_group']:
+        vector_length = args['vector_length']
+        print("Benchmarking Token Group", flush=True)
+        print("Scheme, Token group, Records, Record size, Serial search time per record, "
+              "Parallel search time per record")
+        record_counts = [args['records'] * k for k in [1, 2, 4, 8]]
+        for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+            bench_token_group(n=vector_length, ipescheme=ipescheme, group_name='MNT159', record_counts=record_counts,
+                              t=vector_length // 10, processes=args['processes'])
+
+    if args['benchmark_service']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+        database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, group_name)
+        database.generate_keys()
+        database.encrypt_dataset(templates)
+        print("Benchmarking Query Service", flush=True)
+        print("Clients, Requests/s, p50 latency, p95 latency, p99 latency, Queries per scan")
+        bench_service(n=vector_length, database=database, templates=templates, client_counts=[1, 4, 16, 64],
+                      t=vector_length // 10, processes=args['processes'])
+
+    if args['benchmark_instrumentation']:
+        group_name = 'MNT159'
+        vector_length = args['vector_length']
+        (dataset, templates) = generate_synthetic_data(args['records'], vector_length)
+        print("Benchmarking Instrumentation", flush=True)
+        print("Records, Search time disabled, Search time enabled, Overhead %, Pairings per query and record, "
+              "Deserializations")
+        for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+            database = prox_search.ProximitySearch(vector_length, ipescheme, group_name)
+            database.generate_keys()
+            database.encrypt_dataset_parallel(templates)
+            database.encrypt_dataset(templates)
+            bench_instrumentation(n=vector_length, database=database, templates=templates, t=vector_length // 10)
+
+    if synthetic_benchmark:
+        exit(0)
+
     if os.path.exists(os.getcwd() + "//features//ND_proximity_irisR_all_features_folders//"):
         (nd_dataset, nd_templates, class_labels) = process_full_dataset()
         #(nd_dataset, iitd_dataset) = process_dataset()
@@ -265,7 +1271,7 @@ if __name__ == "__main__":
         database = None
         parallel = args['parallel']
         if args['full_timing']:
-            vector_sizes = [128, 192, 256, 384, 512, 768, 1024, 2048, 4096]  # type: List[int]
+            vector_sizes = [128, 192, 256, 384, 512, 768, 1024, 2048, 4096]
             vector_sigma = [3, 5, 7, 10, 13, 19, 25, 51, 103]
             vector_t = [38, 57, 76, 115, 153, 230, 307, 614, 1228]
             for i in range(len(vector_sizes)):
@@ -278,7 +1284,7 @@ if __name__ == "__main__":
                                         matrix_file=matrix_file, gen_file=gen_file, save_keys=False,
                                         num_bases=vector_sigma[i])
                 print("Encryption", flush=True)
-                print("Number Bases, Parallel, Time Avg, Time StDev, Size Avg, Size StDev")
+                print("Number Bases, Parallel, Time Avg, Time StDev, Size Avg, Size StDev, Record Size, Largest Shard Size")
                 bench_enc_data(n=vector_sizes[i], database=database, dataset=templates, iterations=1,
                                    parallel=parallel)
                 print("Search", flush=True)
@@ -322,7 +1328,7 @@ if __name__ == "__main__":
                 exit(1)
 
             print("Benchmarking Multibasis Encryption", flush=True)
-            print("Number Bases, Parallel, Time Avg, Time StDev, Size Avg, Size StDev")
+            print("Number Bases, Parallel, Time Avg, Time StDev, Size Avg, Size StDev, Record Size, Largest Shard Size")
             for i in range(66):
                 bench_enc_data(n=vector_length, database=database[i], dataset=nd_templates, iterations=10,
                                parallel=parallel)
@@ -0,0 +1,62 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Runs the benchmarks that read the shard files of encrypt_dataset_parallel on a
+few records of the simulated group, in a scratch directory, so that a change
+to where the shards are written breaks here rather than in a long run.
+"""
+
+import sys, os, shutil, tempfile
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+sys.path.insert(2, os.path.join(os.path.dirname(os.path.abspath(__file__))))
+
+from pse import predipe, prox_search
+from pse.groups import SIMULATED_GROUP
+import benchprox
+
+if __name__ == "__main__":
+    vector_length = 8
+    work_dir = tempfile.mkdtemp()
+    current_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        (dataset, templates) = benchprox.generate_synthetic_data(24, vector_length)
+        database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, SIMULATED_GROUP)
+        database.generate_keys()
+        database.set_scheduler(2, 8)
+        database.encrypt_dataset_parallel(templates)
+        assert(database.shard_dir is not None and not os.path.exists(
+            prox_search.ProximitySearch.shard_filename(*database.shards[0])))
+
+        print("Smoke Testing Shared Store Benchmark")
+        benchprox.bench_shared_store(n=vector_length, database=database, queryset=dataset, iterations=1, t=0,
+                                     processes=2)
+
+        print("Smoke Testing Engine Benchmark")
+        benchprox.bench_engine(n=vector_length, database=database, queryset=dataset, iterations=1, t=0,
+                               processes=2)
+
+        print("Smoke Testing Search Many Benchmark")
+        database.encrypt_dataset(templates)
+        benchprox.bench_search_many(n=vector_length, database=database, queryset=dataset, num_queries=2, t=0,
+                                    processes=2)
+        database.remove_shard_files()
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print("All benchmark smoke tests passed")
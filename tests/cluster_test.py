@@ -0,0 +1,156 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Runs search nodes as local processes on localhost and checks a coordinated
+search against the single machine search, through a node failure and a node
+joining.
+"""
+
+import sys, os, random, signal, asyncio, argparse, subprocess, tempfile
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from pse import predipe, prox_search, multibasispredipe, cluster
+from pse.ctstore import pack_tokens
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_node(vector_length, multi_basis, group_name, matrix_file, generator_file):
+    """
+    Starts an empty search node on a free localhost port and returns the
+    process and its (host, port) address.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    command = [sys.executable, '-m', 'pse.service', '-v', str(vector_length), '-g', group_name,
+               '-mf', matrix_file, '-gf', generator_file, '--host', '127.0.0.1', '-np', '1']
+    if multi_basis:
+        command.append('-mb')
+    # in a session of its own, so that the node and its shard workers can be killed together
+    process = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=subprocess.PIPE, text=True,
+                               start_new_session=True)
+    line = process.stdout.readline()
+    assert line.startswith("Listening on "), "ERROR: Node did not start"
+    (host, port) = line.strip()[len("Listening on "):].rsplit(":", 1)
+    return process, (host, int(port))
+
+
+def kill_node(process, workers=True):
+    """
+    Kills a node, with its shard workers unless workers is False. The workers
+    share the node's sockets, so the node then stops answering without its
+    connections being closed, as when its host goes down.
+    """
+    try:
+        if workers:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+async def check_cluster(database, tokens, expected, processes, addresses, start_new_node):
+    shards = cluster.shard_files(database)
+    coordinator = cluster.ClusterCoordinator(shards, health_interval=0.5, health_timeout=5)
+    for address in addresses:
+        await coordinator.add_node(address)
+    await coordinator.assign_shards()
+    assert(len(coordinator.assignment) == len(shards))
+    packed = pack_tokens(database.predinstance.group, tokens)
+
+    print("Testing Coordinated Search")
+    assert([sorted(indices) for indices in await coordinator.search(packed)] == expected)
+    limited = await coordinator.search(packed, limit=1)
+    assert(all(len(l) == min(1, len(e)) and set(l) <= set(e) for (l, e) in zip(limited, expected)))
+
+    print("Testing Node Failure")
+    lost = addresses[0]
+    kill_node(processes[0])
+    assert([sorted(indices) for indices in await coordinator.search(packed)] == expected)
+    assert(lost not in coordinator.nodes)
+    assert(len(coordinator.assignment) == len(shards) and lost not in coordinator.assignment.values())
+
+    print("Testing Health Checks")
+    kill_node(processes[1], workers=False)
+    coordinator.start_health_checks()
+    for i in range(50):
+        if addresses[1] not in coordinator.nodes:
+            break
+        await asyncio.sleep(0.2)
+    assert(addresses[1] not in coordinator.nodes)
+    assert(len(coordinator.assignment) == len(shards))
+    assert([sorted(indices) for indices in await coordinator.search(packed)] == expected)
+
+    print("Testing Search on an Unresponsive Node")
+    kill_node(processes[2], workers=False)
+    assert([sorted(indices) for indices in await coordinator.search(packed)] == expected)
+    assert(addresses[2] not in coordinator.nodes)
+
+    print("Testing Rebalance")
+    (process, address) = start_new_node()
+    processes.append(process)
+    await coordinator.add_node(address)
+    await coordinator.rebalance()
+    assert(address in coordinator.assignment.values())
+    assert([sorted(indices) for indices in await coordinator.search(packed)] == expected)
+    await coordinator.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Test of the search over several nodes.')
+    parser.add_argument('--nodes', '-n', type=int, default=4, help='Number of search nodes to start')
+    parser.add_argument('--records', '-r', type=int, default=200, help='Number of records')
+    parser.add_argument('--vector_length', '-v', type=int, default=16, help='Length of the records')
+    parser.add_argument('--multi_basis', '-mb', action='store_true', help='Use MultiBasesPredScheme')
+    parser.add_argument('--group', '-g', default='MNT159', help='Pairing group, SIMULATED for a quick run')
+    args = vars(parser.parse_args())
+    assert(args['nodes'] >= 4), "ERROR: The test loses three nodes"
+
+    vector_length = args['vector_length']
+    scheme = multibasispredipe.MultiBasesPredScheme if args['multi_basis'] else predipe.BarbosaIPEScheme
+    work_dir = tempfile.mkdtemp()
+    os.chdir(work_dir)
+
+    database = prox_search.ProximitySearch(vector_length, scheme, args['group'])
+    database.generate_keys()
+    (matrix_file, generator_file) = (os.path.join(work_dir, 'key.matrices'), os.path.join(work_dir, 'key.generators'))
+    database.write_key_to_file(matrix_file, generator_file)
+    templates = [[random.randint(0, 1) for j in range(vector_length)] for i in range(args['records'])]
+    # every fourth record repeats another, so that queries have several matches
+    for i in range(0, len(templates), 4):
+        templates[i] = templates[random.randrange(0, len(templates))]
+    database.set_scheduler(2, 16)
+    database.encrypt_dataset_parallel(templates)
+
+    tokens = [database.generate_query(templates[random.randrange(0, len(templates))], 1) for i in range(8)]
+    expected = [sorted(indices) for indices in database.parallel_search_many(tokens)]
+
+    def start_new_node():
+        return start_node(vector_length, args['multi_basis'], args['group'], matrix_file, generator_file)
+
+    nodes = [start_new_node() for i in range(args['nodes'])]
+    processes = [process for (process, address) in nodes]
+    try:
+        asyncio.run(check_cluster(database, tokens, expected, processes, [address for (process, address) in nodes],
+                                  start_new_node))
+    finally:
+        for process in processes:
+            kill_node(process)
+    print("All cluster tests passed")
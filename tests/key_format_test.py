@@ -0,0 +1,115 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Checks the round trip of secret keys through the binary PSEKEY format, the
+rejection of damaged keys and the loading of keys in the older text format.
+"""
+
+import sys, os, random, shutil, tempfile
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from charm.core.engine.util import objectToBytes
+from pse import predipe, prox_search, multibasispredipe, keygen
+from pse.groups import SIMULATED_GROUP
+
+
+def bases_of(scheme):
+    if hasattr(scheme, 'barbosa_vec'):
+        return [(b.B, b.Bstar) for b in scheme.barbosa_vec]
+    return [(scheme.B, scheme.Bstar)]
+
+
+def check_same_key(loaded, database, templates):
+    """
+    Checks that the database loaded, keyed from a serialization of the key of
+    database, has the same key and searches database's ciphertexts the same.
+    """
+    assert(bases_of(loaded.predinstance) == bases_of(database.predinstance))
+    assert(loaded.predinstance.g1 == database.predinstance.g1)
+    assert(loaded.predinstance.g2 == database.predinstance.g2)
+    loaded.enc_data = database.enc_data
+    loaded.num_records = database.num_records
+    for i in range(0, len(templates), 3):
+        assert(loaded.search(loaded.generate_query(templates[i], 1)) ==
+               database.search(database.generate_query(templates[i], 1)))
+
+
+def expect_error(group, matrix_data, message):
+    try:
+        keygen.decode_key(group, matrix_data)
+        assert(False)
+    except ValueError as e:
+        assert(str(e).startswith(message))
+
+
+if __name__ == "__main__":
+    vector_length = 8
+    random.seed(0)
+    templates = [[random.randint(0, 1) for j in range(vector_length)] for i in range(12)]
+    work_dir = tempfile.mkdtemp()
+    try:
+        for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+            database = prox_search.ProximitySearch(vector_length, ipescheme, SIMULATED_GROUP)
+            database.generate_keys()
+            database.encrypt_dataset(templates)
+            group = database.predinstance.group
+            bases = bases_of(database.predinstance)
+
+            print("Testing " + ipescheme.__name__ + " binary key layout")
+            (matrix_data, generator_bytes) = database.serialize_key()
+            assert(keygen.is_binary_key(matrix_data))
+            width = keygen.int_width(group.order())
+            dimension = len(bases[0][0])
+            assert(keygen.KEY_HEADER.unpack_from(matrix_data) ==
+                   (keygen.KEY_MAGIC, keygen.KEY_VERSION, len(bases), dimension, width))
+            assert(len(matrix_data) == keygen.KEY_HEADER.size + 2 * len(bases) * dimension * dimension * width)
+            assert(keygen.decode_key(group, matrix_data) == bases)
+            assert(keygen.decode_generators(group, generator_bytes) ==
+                   (database.predinstance.g1, database.predinstance.g2))
+
+            print("Testing " + ipescheme.__name__ + " binary key round trip")
+            loaded = prox_search.ProximitySearch(vector_length, ipescheme, SIMULATED_GROUP)
+            loaded.deserialize_key(matrix_data, generator_bytes)
+            check_same_key(loaded, database, templates)
+            (matrix_file, generator_file) = (os.path.join(work_dir, "key.bin"), os.path.join(work_dir, "gen.bin"))
+            database.write_key_to_file(matrix_file, generator_file)
+            loaded = prox_search.ProximitySearch(vector_length, ipescheme, SIMULATED_GROUP)
+            loaded.read_key_from_file(matrix_file, generator_file)
+            check_same_key(loaded, database, templates)
+
+            print("Testing " + ipescheme.__name__ + " damaged keys")
+            expect_error(group, b"NOTKEY" + matrix_data[6:], "Not a secret key")
+            expect_error(group, matrix_data[:6] + (keygen.KEY_VERSION + 1).to_bytes(2, 'little') + matrix_data[8:],
+                         "Unsupported secret key version")
+            expect_error(group, matrix_data[:-1], "Truncated secret key")
+
+        print("Testing text key")
+        database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, SIMULATED_GROUP)
+        database.generate_keys()
+        database.encrypt_dataset(templates)
+        scheme = database.predinstance
+        # the format serialize_key wrote before the binary one
+        (g1_bytes, g2_bytes) = (objectToBytes(scheme.g1, scheme.group), objectToBytes(scheme.g2, scheme.group))
+        matrix_str = scheme.serialize_matrices() + "\n" + str(len(g1_bytes)) + " " + str(len(g2_bytes))
+        assert(not keygen.is_binary_key(matrix_str.encode()))
+        loaded = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, SIMULATED_GROUP)
+        loaded.deserialize_key(matrix_str.encode(), g1_bytes + g2_bytes)
+        check_same_key(loaded, database, templates)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print("All key format tests passed")
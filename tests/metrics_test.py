@@ -0,0 +1,109 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Checks the group operations counted for known encrypt, keygen and decrypt
+calls, that a failing measured call leaves instrumentation as it was, and the
+Prometheus export.
+"""
+
+import sys, os
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from pse import metrics, predipe
+from pse.groups import SIMULATED_GROUP
+
+
+def counted(fn, *args):
+    """
+    Returns (fn(*args), the counters it recorded).
+    """
+    with metrics.recording() as record:
+        result = fn(*args)
+    return result, record.snapshot["counters"]
+
+
+def failing_chunk(start, end):
+    raise RuntimeError("chunk failed")
+
+
+if __name__ == "__main__":
+    n = 8
+    scheme = predipe.BarbosaIPEScheme(n, SIMULATED_GROUP)
+    scheme.generate_keys()
+    x = [1, -1, 1, -1, 1, -1, 1, -1]
+    y = [2, 2, 2, 2, 2, 2, 2, 2]
+    # generic vectors, none of the sign-vector shortcuts apply
+    x_generic = [2, 3, 2, 3, 2, 3, 2, 3]
+    y_generic = [3, -2, 3, -2, 3, -2, 3, -2]
+
+    print("Testing Encrypt Counters")
+    (ct, counters) = counted(scheme.encrypt, x_generic)
+    # x * B* then the beta scaling
+    assert(counters == {"zr_multiplications": n * n + n, "g2_exponentiations": n})
+    (ct_sign, counters) = counted(scheme.encrypt, x)
+    # the last coordinate is -1, one scaled row of B* then the beta scaling
+    assert(counters == {"zr_multiplications": n + n, "g2_exponentiations": n})
+    (cts, counters) = counted(scheme.encrypt_batch, [x_generic, x])
+    # the integer product X * B* is not counted
+    assert(counters == {"zr_multiplications": 2 * n, "g2_exponentiations": 2 * n})
+
+    print("Testing Keygen Counters")
+    (token, counters) = counted(scheme.keygen, y_generic)
+    assert(counters == {"zr_multiplications": n * n + n, "g1_exponentiations": n})
+    (tokens, counters) = counted(scheme.keygen_thresholds, y_generic[:-1], [0, 1, 2])
+    assert(counters == {"zr_multiplications": n * n + 3 * n + 3 * n, "g1_exponentiations": 3 * n})
+
+    print("Testing Decrypt Counters")
+    (match, counters) = counted(scheme.decrypt_prepared, ct, token)
+    assert(match and counters == {"pairings": n, "pairing_products": 1})
+    (match, counters) = counted(predipe.BarbosaIPEScheme.decrypt, None, ct_sign, token, SIMULATED_GROUP)
+    assert(not match and counters == {"pairings": n, "pairing_products": 1})
+    (match, counters) = counted(scheme.decrypt_prepared, cts[0], token)
+    assert(match)
+
+    print("Testing Instrumentation Flag Restored")
+    for enabled in [False, True]:
+        metrics.enable(enabled)
+        try:
+            metrics.run_measured(failing_chunk, 0, 1)
+            assert(False)
+        except RuntimeError:
+            pass
+        assert(metrics.ENABLED == enabled)
+        try:
+            with metrics.recording():
+                failing_chunk(0, 1)
+            assert(False)
+        except RuntimeError:
+            pass
+        assert(metrics.ENABLED == enabled)
+    metrics.enable(False)
+
+    print("Testing Prometheus Export")
+    metrics.reset()
+    metrics.count("pairings", 3)
+    metrics.add_time("search", 0.5)
+    metrics.add_time("search", 0.25)
+    lines = metrics.to_prometheus().splitlines()
+    assert(lines == ["# TYPE pse_pairings_total counter", "pse_pairings_total 3",
+                     "# TYPE pse_calls_total counter", 'pse_calls_total{operation="search"} 2',
+                     "# TYPE pse_seconds_total counter", 'pse_seconds_total{operation="search"} 0.75',
+                     "# TYPE pse_max_seconds gauge", 'pse_max_seconds{operation="search"} 0.5'])
+    metrics.reset()
+    assert(metrics.to_prometheus() == "\n")
+    print("All metrics tests passed")
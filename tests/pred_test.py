@@ -85,6 +85,26 @@ if __name__ == "__main__":
         relevant_indices = database.search(encrypted_query)
         assert (len(relevant_indices) == 0)
 
+        print("Testing Parallel Search")
+        data = [[i % 2, (i // 2) % 2, (i // 4) % 2, (i // 8) % 2] for i in range(16)] * 2
+        database.set_scheduler(2, 4)
+        database.encrypt_dataset(data)
+        queries = [database.generate_query(data[i], t) for i in [0, 5, 10] for t in [0, 1]]
+        expected = [database.search(query) for query in queries]
+        database.encrypt_dataset_parallel(data)
+        assert([sorted(database.parallel_search(query)) for query in queries] == expected)
+
+        print("Testing Precomputed Batch Search")
+        # a run of enrollments of data[0] long enough for batch_search to aggregate over the tables
+        database.set_precomputation(True, None)
+        database.encrypt_dataset([data[0]] * 8 + data)
+        assert(len(database.ct_index) == 40)
+        queries = [database.generate_query(data[i], t) for i in [0, 5] for t in [0, 1]]
+        for query in queries:
+            assert(database.batch_search(query, 4) == database.search(query))
+        assert(database.batch_search(queries[0], 4) == database.search(queries[0]) and database.batch_aggregates > 0)
+        database.set_precomputation(False)
+
 
 
         print("Testing multi basis scheme")
@@ -0,0 +1,82 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Checks how the chunk scheduler cuts work and how many workers it runs, and
+that parallel encryption and search give the same records and matches for any
+worker count and chunk size.
+"""
+
+import sys, os, random, shutil, tempfile
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from pathos.multiprocessing import cpu_count
+from pse import predipe, prox_search
+from pse.groups import SIMULATED_GROUP
+from pse.scheduler import ChunkScheduler, chunk_ranges, DEFAULT_CHUNK_SIZE
+
+
+def worker_pid(start, end):
+    return os.getpid()
+
+
+if __name__ == "__main__":
+    print("Testing Chunk Ranges")
+    assert(chunk_ranges(0, 10, 4) == [(0, 4), (4, 8), (8, 10)])
+    assert(chunk_ranges(5, 13, 4) == [(5, 9), (9, 13)])
+    assert(chunk_ranges(3, 3, 4) == [])
+    assert(ChunkScheduler(3, 4).chunks(0, 10) == [(0, 4), (4, 8), (8, 10)])
+    # without a chunk size every worker gets one equal share
+    assert(ChunkScheduler(3, None).chunks(0, 10) == [(0, 4), (4, 8), (8, 10)])
+    assert(ChunkScheduler(4, None).chunks(0, 2) == [(0, 1), (1, 2)])
+    assert(ChunkScheduler(4, None).chunks(0, 0) == [])
+
+    print("Testing Worker Counts")
+    scheduler = ChunkScheduler()
+    assert(scheduler.workers == cpu_count() and scheduler.chunk_size == DEFAULT_CHUNK_SIZE)
+    scheduler = ChunkScheduler(2, 1)
+    chunks = scheduler.chunks(0, 12)
+    with scheduler.executor() as executor:
+        pids = [future.result() for future in scheduler.submit(executor, worker_pid, chunks)]
+    assert(len(pids) == 12 and len(set(pids)) <= 2 and os.getpid() not in pids)
+
+    vector_length = 8
+    random.seed(0)
+    templates = [[random.randint(0, 1) for j in range(vector_length)] for i in range(30)]
+    work_dir = tempfile.mkdtemp()
+    try:
+        database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, SIMULATED_GROUP)
+        database.generate_keys()
+        database.set_shard_directory(work_dir)
+        database.encrypt_dataset(templates)
+        queries = [database.generate_query(templates[i], 1) for i in range(0, 30, 5)]
+        expected = [sorted(database.search(query)) for query in queries]
+        for (workers, chunk_size) in [(1, 7), (2, 4), (3, None), (2, 64)]:
+            print("Testing " + str(workers) + " workers with chunks of " + str(chunk_size))
+            database.set_scheduler(workers, chunk_size)
+            database.encrypt_dataset_parallel(templates)
+            # one shard file per chunk
+            assert(database.shards == database.scheduler.chunks(0, len(templates)))
+            assert(all(os.path.exists(database.shard_path(start, end)) for (start, end) in database.shards))
+            assert([sorted(database.parallel_search(query)) for query in queries] == expected)
+            database.share_encrypted_data()
+            assert([sorted(database.parallel_search(query)) for query in queries] == expected)
+            database.release_shared_data()
+            database.remove_shard_files()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print("All scheduler tests passed")
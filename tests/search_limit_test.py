@@ -0,0 +1,86 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Checks the limit and first_match early termination of the serial, sharded and
+engine searches.
+"""
+
+import sys, os, random, multiprocessing
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from pse import predipe, prox_search, search_engine
+from pse.groups import SIMULATED_GROUP
+
+
+def check_limited(matches, full, limit):
+    """
+    Checks that matches, from a sharded search with limit, are limit distinct
+    matches of full, or all of them when there are fewer.
+    """
+    assert(len(matches) == min(limit, len(full)) and len(set(matches)) == len(matches))
+    assert(set(matches) <= set(full))
+
+
+if __name__ == "__main__":
+    vector_length = 8
+    random.seed(0)
+    templates = [[random.randint(0, 1) for j in range(vector_length)] for i in range(40)]
+    # the first template is enrolled at records 3, 17, 18 and 35
+    data = list(templates)
+    for i in [3, 17, 18, 35]:
+        data[i] = templates[0]
+    database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, SIMULATED_GROUP)
+    database.generate_keys()
+    database.encrypt_dataset(data)
+    query = database.generate_query(templates[0], 0)
+    full = database.search(query)
+    assert(full == [0, 3, 17, 18, 35])
+    missing = database.generate_query([1 - b for b in templates[0]], 0)
+    assert(database.search(missing) == [])
+
+    print("Testing Serial Search Limits")
+    assert(database.search(query, first_match=True) == [0])
+    assert(database.search(query, limit=3) == [0, 3, 17])
+    assert(database.search(query, limit=10) == full)
+    assert(database.search(missing, first_match=True) == [])
+    # a query is dropped once it has enough matches, the others go on
+    assert(database.search_many([query, database.generate_query(templates[35], 0)], 2) ==
+           [[0, 3], database.search(database.generate_query(templates[35], 0), limit=2)])
+    stop_event = multiprocessing.Event()
+    stop_event.set()
+    assert(database.search_many([query], 1, stop_event) == [[]])
+
+    print("Testing Sharded Search Limits")
+    database.set_scheduler(2, 4)
+    database.share_encrypted_data()
+    assert(sorted(database.parallel_search(query)) == full)
+    for limit in [1, 2, 5, 6]:
+        check_limited(database.parallel_search(query, limit), full, limit)
+    check_limited(database.parallel_search(query, first_match=True), full, 1)
+    assert(database.parallel_search(missing, 1) == [])
+
+    print("Testing Engine Search Limits")
+    with search_engine.ProximitySearchEngine(database, 2) as engine:
+        assert(sorted(engine.search(query)) == full)
+        check_limited(engine.search(query, first_match=True), full, 1)
+        check_limited(engine.search(query, 3), full, 3)
+        # the stop event of one search does not end the next one
+        assert(sorted(engine.search(query)) == full)
+        assert(engine.search(missing, 1) == [])
+    database.release_shared_data()
+    print("All search limit tests passed")
@@ -0,0 +1,73 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Runs a query service on a Unix socket and checks that a malformed query sent
+together with valid ones fails alone.
+"""
+
+import sys, os, random, asyncio, tempfile
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from pse import predipe, prox_search, multibasispredipe, service
+from pse.ctstore import pack_tokens, ciphertext_tag
+from pse.groups import SIMULATED_GROUP
+
+
+def malformed_queries(packed, group, ct):
+    """
+    Returns variants of packed, a valid packed query, whose lengths add up
+    but whose tokens the service cannot scan.
+    """
+    (counts, (shape, tag, width, record_ids, data)) = packed
+    num_elements = len(data) // width
+    return [(counts, (shape, ciphertext_tag(group, ct), width, record_ids, data)),
+            (counts, (shape, tag, width + 1, record_ids, data + bytes(num_elements))),
+            (counts, ((not shape[0], shape[1]), tag, width, record_ids, data))]
+
+
+async def check_service(database, templates, socket_path):
+    query_service = service.QueryService(database, 2, batch_delay=0.1)
+    await query_service.listen_unix(socket_path)
+    client = await service.ServiceClient.connect_unix(socket_path)
+    query = database.generate_query(templates[5], 0)
+    expected = [sorted(database.search(query))]
+    packed = pack_tokens(database.predinstance.group, [query])
+    for bad in malformed_queries(packed, database.predinstance.group, database.enc_data[0]):
+        # sent together, both wait for the same scan
+        results = await asyncio.gather(client.search(bad), client.search(packed), return_exceptions=True)
+        assert(isinstance(results[0], RuntimeError))
+        assert([sorted(m) for m in results[1]] == expected)
+    assert([sorted(m) for m in await client.search(packed)] == expected)
+    await client.close()
+    await query_service.close()
+
+
+if __name__ == "__main__":
+    vector_length = 16
+    random.seed(0)
+    templates = [[random.randint(0, 1) for j in range(vector_length)] for i in range(24)]
+    for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+        print("Testing " + ipescheme.__name__ + " malformed queries")
+        database = prox_search.ProximitySearch(vector_length, ipescheme, SIMULATED_GROUP)
+        database.generate_keys()
+        database.encrypt_dataset(templates)
+        socket_path = os.path.join(tempfile.mkdtemp(), "pse_service.sock")
+        asyncio.run(check_service(database, templates, socket_path))
+        os.remove(socket_path)
+        os.rmdir(os.path.dirname(socket_path))
+    print("All service tests passed")
@@ -0,0 +1,111 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Checks that the simulated group behaves as a pairing group: the group laws,
+bilinearity, the serialization shared with Charm's, and that searches on it
+find the matches found on a real curve.
+"""
+
+import sys, os, random, argparse
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from charm.toolbox.pairinggroup import ZR, G1, G2, GT
+from pse import predipe, prox_search, multibasispredipe, ctstore
+from pse.groups import SIMULATED_GROUP, SIMULATED_WIDTH, pairing_group, element_type
+
+
+def distance(x, y):
+    return sum(1 for (a, b) in zip(x, y) if a != b)
+
+
+def expect_type_error(fn):
+    try:
+        fn()
+        assert(False)
+    except TypeError:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Test of the simulated pairing group.')
+    parser.add_argument('--group', '-g', default='MNT159', help='Real pairing group to compare searches with')
+    args = vars(parser.parse_args())
+
+    group = pairing_group(SIMULATED_GROUP)
+    p = int(group.order())
+
+    print("Testing Simulated Group Laws")
+    for i in range(20):
+        (a, b) = (group.random(ZR), group.random(ZR))
+        assert(a * (1 / a) == 1 and (a / b) * b == a and a - a == 0 and (a + b) - b == a)
+        for source_group in [G1, G2]:
+            g = group.random(source_group)
+            identity = group.init(source_group)
+            assert(g * identity == g and g / g == identity)
+            assert((g ** a) * (g ** b) == g ** (a + b) and (g ** a) ** b == g ** (a * b))
+            assert(g ** p == identity and g ** int(a) == g ** a)
+    expect_type_error(lambda: group.random(G1) * group.random(G2))
+    expect_type_error(lambda: group.random(ZR) * group.random(G1))
+
+    print("Testing Simulated Pairing")
+    for i in range(20):
+        (a, b) = (group.random(ZR), group.random(ZR))
+        (g1, g2) = (group.random(G1), group.random(G2))
+        base = group.pair_prod([g1], [g2])
+        assert(element_type(group, base) == GT and base != group.init(GT, 1))
+        assert(group.pair_prod([g1 ** a], [g2 ** b]) == base ** (a * b))
+        assert(group.pair_prod([g1 ** a], [g2]) == group.pair_prod([g1], [g2 ** a]))
+        # a multi-pairing is the product of its pairings
+        (h1, h2) = (group.random(G1), group.random(G2))
+        assert(group.pair_prod([g1, h1], [g2, h2]) == base * group.pair_prod([h1], [h2]))
+        assert(group.pair_prod([g1, g1 ** (-1)], [g2, g2]) == group.init(GT, 1))
+
+    print("Testing Simulated Serialization")
+    for element in [group.random(ZR), group.random(G1), group.random(G2), group.pair_prod([g1], [g2])]:
+        data = group.serialize(element)
+        assert(group.deserialize(data) == element and element_type(group, element) == element.type)
+        assert(len(ctstore.encode_element(group, element)) == SIMULATED_WIDTH)
+        assert(ctstore.decode_elements(group, ctstore.element_tag(group, element),
+                                       ctstore.encode_element(group, element), SIMULATED_WIDTH) == [element])
+    g = group.random(G1)
+    assert(g.initPP())
+    try:
+        g.initPP()
+        assert(False)
+    except ValueError:
+        pass
+
+    vector_length = 8
+    random.seed(0)
+    templates = [[random.randint(0, 1) for j in range(vector_length)] for i in range(16)]
+    # near copies of the first template, one and two bits away
+    templates[5] = [1 - templates[0][0]] + templates[0][1:]
+    templates[9] = [1 - b for b in templates[0][:2]] + templates[0][2:]
+    for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+        print("Testing " + ipescheme.__name__ + " simulated and " + args['group'] + " searches")
+        results = []
+        for group_name in [SIMULATED_GROUP, args['group']]:
+            database = prox_search.ProximitySearch(vector_length, ipescheme, group_name)
+            database.generate_keys()
+            database.encrypt_dataset(templates)
+            results.append([sorted(database.search(database.generate_query(templates[i], t)))
+                            for i in [0, 3, 9] for t in [0, 1, 2]])
+        assert(results[0] == results[1])
+        assert(results[0] == [[j for j in range(len(templates)) if distance(templates[i], templates[j]) <= t]
+                              for i in [0, 3, 9] for t in [0, 1, 2]])
+    print("All simulated group tests passed")
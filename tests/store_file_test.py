@@ -0,0 +1,116 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Checks the layout of the indexed store file, random access to its records by
+id, its views and shard ranges, and searching a database opened from it.
+"""
+
+import sys, os, random, shutil, tempfile
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from pse import predipe, prox_search, multibasispredipe, ctstore
+from pse.groups import SIMULATED_GROUP
+
+
+if __name__ == "__main__":
+    vector_length = 8
+    random.seed(0)
+    templates = [[random.randint(0, 1) for j in range(vector_length)] for i in range(24)]
+    work_dir = tempfile.mkdtemp()
+    store_file = os.path.join(work_dir, "ciphertexts.store")
+    try:
+        for ipescheme in [predipe.BarbosaIPEScheme, multibasispredipe.MultiBasesPredScheme]:
+            database = prox_search.ProximitySearch(vector_length, ipescheme, SIMULATED_GROUP)
+            database.generate_keys()
+            database.encrypt_dataset(templates)
+            group = database.predinstance.group
+            # ids out of order and with gaps, as left by removed records
+            record_ids = random.sample(range(100), len(templates))
+            enc_data = {record_ids[i]: database.enc_data[i] for i in range(len(templates))}
+
+            print("Testing " + ipescheme.__name__ + " store file layout")
+            ctstore.write_store_file(store_file, group, enc_data, database.store_metadata())
+            store = ctstore.CiphertextFile.open(store_file, group)
+            record_size = len(ctstore.encode_ciphertext(group, enc_data[record_ids[0]]))
+            assert(store.record_size == record_size and store.record_ids == record_ids)
+            assert(store.metadata['next_id'] == max(record_ids) + 1 and store.next_id() == max(record_ids) + 1)
+            (magic, version, flags, element_width, size, metadata_length, count, data_offset, index_offset,
+             metadata_offset) = ctstore.FILE_HEADER.unpack_from(store.mapping, 0)
+            assert((magic, version, flags, count) == (ctstore.FILE_MAGIC, ctstore.FILE_VERSION, 0, len(record_ids)))
+            assert(data_offset == ctstore.FILE_HEADER_SIZE and index_offset == data_offset + count * record_size)
+            assert(size == record_size and record_size % element_width == 0)
+            assert(metadata_offset == index_offset + 8 * count)
+            assert(os.path.getsize(store_file) == metadata_offset + metadata_length)
+            store.close()
+
+            print("Testing " + ipescheme.__name__ + " random access")
+            for cache in [True, False, 3]:
+                store = ctstore.CiphertextFile.open(store_file, group, cache)
+                for x in random.sample(record_ids, len(record_ids)) + record_ids[:4]:
+                    assert(x in store and store[x] == enc_data[x])
+                assert(100 not in store and len(store) == len(record_ids))
+                try:
+                    store[100]
+                    assert(False)
+                except KeyError:
+                    pass
+                if cache is not True:
+                    assert(len(store.decoded) == (cache or 0))
+                store.close()
+            assert(ctstore.read_store_file(store_file, group) == enc_data)
+
+            print("Testing " + ipescheme.__name__ + " views and shard ranges")
+            store = ctstore.CiphertextFile.open(store_file, group)
+            for num_shards in [1, 5, len(record_ids), len(record_ids) + 3]:
+                ranges = store.shard_ranges(num_shards)
+                assert(ranges[0][0] == 0 and ranges[-1][1] == len(record_ids))
+                assert(all(ranges[j][1] == ranges[j + 1][0] for j in range(len(ranges) - 1)))
+                assert(len(ranges) == min(num_shards, len(record_ids)))
+                for (start, end) in ranges:
+                    view = store.view(start, end)
+                    assert(list(view) == record_ids[start:end])
+                    assert(all(view[x] == enc_data[x] for x in view))
+            store.close()
+
+            print("Testing " + ipescheme.__name__ + " search of an opened store")
+            queries = [database.generate_query(templates[i], 1) for i in range(0, len(templates), 4)]
+            expected = [sorted(record_ids[x] for x in database.search(query)) for query in queries]
+            database.open_encrypted_data(store_file, cache=5)
+            assert(database.num_records == len(record_ids))
+            assert([sorted(database.search(query)) for query in queries] == expected)
+            database.set_scheduler(2, 5)
+            assert([sorted(database.parallel_search(query)) for query in queries] == expected)
+            database.release_shared_data()
+
+            other = prox_search.ProximitySearch(vector_length + 1, ipescheme, SIMULATED_GROUP)
+            other.generate_keys()
+            try:
+                other.open_encrypted_data(store_file)
+                assert(False)
+            except ValueError:
+                pass
+        with open(store_file, "wb") as not_a_store:
+            not_a_store.write(bytes(ctstore.FILE_HEADER_SIZE))
+        try:
+            ctstore.CiphertextFile.open(store_file, group)
+            assert(False)
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print("All store file tests passed")
@@ -0,0 +1,120 @@
+"""
+Copyright (c) 2021, Benjamin Fuller
+
+Permission to use, copy, modify, and/or distribute this software for any
+purpose with or without fee is hereby granted, provided that the above
+copyright notice and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM
+LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+"""
+
+"""
+Checks adding, removing and overwriting records of a database opened from a
+store file, its compaction and reopening the compacted file.
+"""
+
+import sys, os, random, shutil, tempfile
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(1, os.path.abspath('..'))
+
+from pse import predipe, prox_search
+from pse.ctstore import LayeredStore
+from pse.groups import SIMULATED_GROUP
+
+
+def check_layered(layered, expected):
+    """
+    Checks that layered iterates, counts and returns the records of expected,
+    a dict of ciphertexts, and nothing else.
+    """
+    assert(sorted(layered) == sorted(expected))
+    assert(len(layered) == len(expected) and len(layered.keys()) == len(expected))
+    assert(all(x in layered and layered[x] == expected[x] for x in expected))
+    assert(dict(layered.items()) == expected)
+
+
+if __name__ == "__main__":
+    vector_length = 8
+    random.seed(0)
+    templates = [[random.randint(0, 1) for j in range(vector_length)] for i in range(20)]
+    work_dir = tempfile.mkdtemp()
+    store_file = os.path.join(work_dir, "ciphertexts.store")
+    database = prox_search.ProximitySearch(vector_length, predipe.BarbosaIPEScheme, SIMULATED_GROUP)
+    database.generate_keys()
+    queries = [database.generate_query(templates[i], 0) for i in range(20)]
+
+    def matches():
+        return [sorted(database.search(query)) for query in queries]
+
+    try:
+        print("Testing Layered Store")
+        base = {0: "a", 1: "b", 2: "c"}
+        layered = LayeredStore(base)
+        layered[3] = "d"
+        layered[1] = "B"
+        del layered[2]
+        check_layered(layered, {0: "a", 1: "B", 3: "d"})
+        layered[2] = "C"
+        check_layered(layered, {0: "a", 1: "B", 2: "C", 3: "d"})
+        del layered[1]
+        del layered[3]
+        check_layered(layered, {0: "a", 2: "C"})
+
+        print("Testing Add and Remove Records")
+        database.encrypt_dataset(templates[:10])
+        database.save_encrypted_data(store_file)
+        database.open_encrypted_data(store_file)
+        assert(database.add_records(templates[10:12]) == [10, 11])
+        database.remove_records([0, 11])
+        assert(database.num_records == 10 and len(database.enc_data) == 10)
+        assert(database.search(queries[10]) == [10] and database.search(queries[0]) == [])
+        assert(database.store_changes() == ({10: database.enc_data[10]}, [0, 11]))
+
+        print("Testing Overwrite Records")
+        # a stored record given a new ciphertext, and a tombstoned one brought back
+        database.insert_ciphertexts({1: database.predinstance.encrypt(database.encode_record(templates[12])),
+                                     0: database.predinstance.encrypt(database.encode_record(templates[13]))})
+        assert(database.num_records == 11 and len(database.enc_data) == 11)
+        assert(sorted(database.enc_data) == list(range(11)))
+        assert(database.search(queries[12]) == [1] and database.search(queries[1]) == [])
+        assert(database.search(queries[13]) == [0])
+        expected = matches()
+
+        print("Testing Compaction")
+        database.compact()
+        assert(not isinstance(database.enc_data, LayeredStore) and database.store_changes() == ({}, []))
+        assert(matches() == expected and database.num_records == 11)
+        assert(database.add_records([templates[14]]) == [12])
+        database.remove_records([2])
+        expected = matches()
+        database.compact(background=True).join()
+        assert(matches() == expected)
+
+        print("Testing Reopening")
+        database.release_shared_data()
+        database.open_encrypted_data(store_file)
+        assert(matches() == expected and database.num_records == 11)
+        # ids of removed records are not handed out again
+        assert(database.add_records([templates[15]]) == [13])
+
+        print("Testing Append to Store")
+        try:
+            database.encrypt_stream(templates[16:18], store_file, processes=0, append=True)
+            assert(False)
+        except ValueError:
+            pass
+        assert(not os.path.exists(store_file + ".stream") and database.search(queries[15]) == [13])
+        database.compact()
+        assert(database.encrypt_stream(templates[16:18], store_file, processes=0, append=True) == 2)
+        assert(database.search(queries[16]) == [14] and database.search(queries[17]) == [15])
+        assert(database.search(queries[15]) == [13] and database.num_records == 14)
+        database.release_shared_data()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print("All store tests passed")